@@ -0,0 +1,238 @@
+"""
+Cache of build artifacts between builds
+
+Many builds rebuild exactly the same GROMACS configuration as an earlier
+build on the same node (e.g., when only regressiontests or releng changes).
+This module stores the build and install trees of a configuration in a
+node-local cache after the targets have been built, and restores them in
+later builds with the same key, so that configuring and building can be
+skipped and the build can go straight to running the tests.  Problems with
+the cache (e.g., a full disk) only print a note: a failed restore falls back
+to a normal build, and a failed save leaves the configuration uncached.
+
+Only targets that produce build artifacts are recorded as built in the cached
+trees (and skipped after a restore); targets that, e.g., run checks or
+generate documentation still run in every build.
+"""
+from __future__ import print_function
+
+import json
+import os
+import tarfile
+
+from remotecache import pack_tree, unpack_tree
+
+_TREES = ('build', 'install')
+
+# Targets that are considered to produce build artifacts unless the build
+# script specifies otherwise.
+_ARTIFACT_TARGETS = ('all', 'tests', 'install')
+
+class ArtifactCache(object):
+    """Build and install trees of one configuration in the artifact cache.
+
+    Attributes:
+        restored (bool): Whether the trees were restored from the cache.
+    """
+
+    def __init__(self, executor, cache_dir, build_dir, install_dir,
+            remote=None, remote_key=None):
+        """Creates the cache for a configuration.
+
+        Args:
+            executor (Executor): Executor to access the file system.
+            cache_dir (str): Node-local cache directory for the configuration.
+            build_dir (str): Build directory of the workspace.
+            install_dir (str): Install directory of the workspace.
+            remote (Optional[RemoteCacheClient]): If given, the trees are
+                also shared through this remote cache.
+            remote_key (Optional[str]): Action cache key for the remote cache.
+        """
+        self._executor = executor
+        self._cache_dir = cache_dir
+        self._remote = remote
+        self._remote_key = remote_key
+        self._build_dir = build_dir
+        self._install_dir = install_dir
+        self._info_path = os.path.join(cache_dir, 'artifacts.json')
+        self._targets = []
+        self._saved = False
+        self.restored = False
+
+    def restore(self):
+        """Restores the build and install trees if they are in the cache.
+
+        If copying the trees fails, the partially restored trees are removed
+        so that the build can continue as if the cache was empty.
+
+        Returns:
+            bool: Whether the trees were restored.
+        """
+        info = self._read_info()
+        if info is None and self._remote:
+            info = self._fetch_remote()
+        if info is None:
+            return False
+        console = self._executor.console
+        print('Restoring build and install trees from artifact cache: ' + self._cache_dir,
+                file=console)
+        try:
+            self._executor.copy_tree(os.path.join(self._cache_dir, 'build'), self._build_dir)
+            self._executor.copy_tree(os.path.join(self._cache_dir, 'install'), self._install_dir)
+        except EnvironmentError as e:
+            print('Restoring from artifact cache failed ({0}), building normally'.format(e),
+                    file=console)
+            self._executor.ensure_dir_exists(self._build_dir, ensure_empty=True)
+            self._executor.remove_path(self._install_dir)
+            return False
+        self._targets = info['targets']
+        self.restored = True
+        return True
+
+    def _read_info(self):
+        try:
+            return json.loads(''.join(self._executor.read_file(self._info_path)))
+        except (IOError, ValueError):
+            return None
+
+    def is_target_restored(self, target):
+        """Whether a target was built as part of the restored trees."""
+        return self.restored and self._get_target_name(target) in self._targets
+
+    def add_target(self, target, artifact=None):
+        """Records that a target has been built (before save()).
+
+        Args:
+            target (str or None): Name of the target (None for the default).
+            artifact (Optional[bool]): Whether the target produces build
+                artifacts.  If not given, only the default target, ``tests``,
+                and ``install`` are assumed to.  Other targets are not
+                recorded, and are built again after a restore.
+        """
+        name = self._get_target_name(target)
+        if artifact is None:
+            artifact = name in _ARTIFACT_TARGETS
+        if artifact and not self.restored and name not in self._targets:
+            self._targets.append(name)
+
+    def _get_target_name(self, target):
+        if target is None:
+            return 'all'
+        return target
+
+    def save(self):
+        """Stores the build and install trees into the cache.
+
+        Does nothing if the trees were restored from the cache or already
+        saved, or if another build is saving or has already saved the same
+        configuration.
+        """
+        if self.restored or self._saved:
+            return
+        self._saved = True
+        lock = self._executor.lock_file(os.path.join(self._cache_dir, 'save.lock'),
+                blocking=False)
+        if lock is None:
+            return
+        try:
+            if self._read_info() is not None:
+                return
+            print('Saving build and install trees to artifact cache: ' + self._cache_dir,
+                    file=self._executor.console)
+            # The info file is written last, so that a partially written
+            # cache does not get used if the build gets killed while saving.
+            try:
+                self._executor.copy_tree(self._build_dir, os.path.join(self._cache_dir, 'build'))
+                self._executor.copy_tree(self._install_dir, os.path.join(self._cache_dir, 'install'))
+                info = {'targets': self._targets}
+                self._executor.write_file(self._info_path, json.dumps(info))
+            except EnvironmentError as e:
+                print('Saving to artifact cache failed: {0}'.format(e),
+                        file=self._executor.console)
+                for name in _TREES:
+                    self._executor.remove_path(os.path.join(self._cache_dir, name))
+                return
+            if self._remote:
+                try:
+                    self._push_remote()
+                except EnvironmentError as e:
+                    print('Uploading to remote artifact cache failed: {0}'.format(e),
+                            file=self._executor.console)
+        finally:
+            lock.release()
+
+    def _get_archive_path(self, name):
+        return os.path.join(self._cache_dir, name + '.tar')
+
+    def _fetch_remote(self):
+        """Fetches the trees from the remote cache into the local cache.
+
+        The fetch holds the same lock as save(), so that concurrent builds do
+        not unpack into the same trees.  Each tree is unpacked into a
+        temporary directory and renamed into place; any error while fetching
+        or unpacking is treated as a cache miss.
+
+        Returns:
+            Dict or None: The info for the fetched trees, or None if the
+                remote cache does not have them.
+        """
+        entry = self._remote.get_entry(self._remote_key)
+        if not entry or 'targets' not in entry:
+            return None
+        lock = self._executor.lock_file(os.path.join(self._cache_dir, 'save.lock'))
+        try:
+            # Another build may have fetched or saved the trees while this
+            # one was waiting for the lock.
+            info = self._read_info()
+            if info is not None:
+                return info
+            blobs = dict()
+            for name in _TREES:
+                if entry.get(name):
+                    blobs[entry[name]] = self._get_archive_path(name)
+            try:
+                if not self._remote.get_blobs(blobs):
+                    return None
+                for name in _TREES:
+                    if entry.get(name):
+                        self._unpack_archive(name)
+            except (tarfile.TarError, EnvironmentError) as e:
+                print('Fetching from remote artifact cache failed: {0}'.format(e),
+                        file=self._executor.console)
+                return None
+            finally:
+                for path in blobs.itervalues():
+                    self._executor.remove_path(path)
+            info = {'targets': entry['targets']}
+            self._executor.write_file(self._info_path, json.dumps(info))
+            return info
+        finally:
+            lock.release()
+
+    def _unpack_archive(self, name):
+        """Unpacks a fetched archive and renames it into place as a tree."""
+        tree = os.path.join(self._cache_dir, name)
+        temp_path = tree + '.tmp'
+        unpack_tree(self._get_archive_path(name), temp_path)
+        self._executor.remove_path(tree)
+        os.rename(temp_path, tree)
+
+    def _push_remote(self):
+        """Uploads the trees from the local cache to the remote cache."""
+        archives = dict()
+        try:
+            for name in _TREES:
+                tree = os.path.join(self._cache_dir, name)
+                if os.path.isdir(tree):
+                    archives[name] = self._get_archive_path(name)
+                    pack_tree(tree, archives[name])
+            digests = self._remote.put_blobs(archives.values())
+            if digests is None:
+                return
+            entry = {'targets': self._targets}
+            for name, path in archives.iteritems():
+                entry[name] = digests[path]
+            self._remote.put_entry(self._remote_key, entry)
+        finally:
+            for path in archives.itervalues():
+                self._executor.remove_path(path)
@@ -0,0 +1,244 @@
+"""
+Node-local cache management
+
+Several parts of the build keep data on the build node between builds, such as
+git object stores, compiler caches, or cached results of configuration probes.
+This module keeps an index of all such caches, with their size and time of last
+use, and keeps their total size within a disk budget by evicting the least
+recently used caches.
+
+The index is shared between all builds running on the node, and access to it
+is serialized with a lock file.  Caches used by a running build are protected
+from eviction by a shared lock held on a per-cache lock file until the build
+finishes.  On Windows, where only exclusive locks are available, only one of
+the builds using a cache holds the lock; the others rely on the cache being
+recently used, which keeps it away from eviction in practice.
+"""
+from __future__ import print_function
+
+import datetime
+import json
+import os.path
+import time
+
+from common import CacheKind
+import slaves
+import utils
+
+class CacheEntry(object):
+    """Information about a single cache in the index.
+
+    Attributes:
+        kind (CacheKind): Kind of the cache.
+        name (str): Name identifying the cache within its kind.
+        size (int): Size of the cache in bytes (when last measured).
+        last_used (float): Time of last use (seconds since the epoch).
+    """
+
+    def __init__(self, kind, name, size=0, last_used=0):
+        self.kind = kind
+        self.name = name
+        self.size = size
+        self.last_used = last_used
+
+    @property
+    def key(self):
+        return '{0}/{1}'.format(self.kind, self.name)
+
+    def to_dict(self):
+        return {
+                'kind': self.kind,
+                'name': self.name,
+                'size': self.size,
+                'last_used': self.last_used
+            }
+
+    @staticmethod
+    def from_dict(data):
+        return CacheEntry(data['kind'], data['name'], data['size'], data['last_used'])
+
+def evict_least_recently_used(entries, budget, evict):
+    """Evicts caches until their total size is within a budget.
+
+    Least recently used caches are evicted first.
+
+    Args:
+        entries (List[CacheEntry]): All caches.
+        budget (int): Maximum total size in bytes.
+        evict (function): Called with a CacheEntry to evict it.  Should return
+            ``False`` if the cache could not be evicted (e.g., because it is
+            in use).
+
+    Returns:
+        List[CacheEntry]: Caches that were evicted.
+    """
+    total = sum([x.size for x in entries])
+    evicted = []
+    for entry in sorted(entries, key=lambda x: (x.last_used, x.key)):
+        if total <= budget:
+            break
+        if evict(entry):
+            evicted.append(entry)
+            total -= entry.size
+    return evicted
+
+class CacheManager(object):
+    """Manages node-local caches shared between builds.
+
+    Attributes:
+        root (str): Root directory for all caches on the node.
+        budget (int): Maximum total size of the caches in bytes.
+    """
+
+    def __init__(self, factory):
+        self.root = os.path.join(factory.jenkins.node_dir, 'caches')
+        self._executor = factory.executor
+        budget = factory.env.get('RELENG_CACHE_BUDGET', None)
+        if budget:
+            budget = float(budget)
+        else:
+            budget = slaves.get_cache_disk_budget(factory.jenkins.node_name)
+        self.budget = int(budget * 1024**3)
+        self._index_path = os.path.join(self.root, 'index.json')
+        self._index_lock_path = os.path.join(self.root, 'index.lock')
+        self._used = dict()
+        self._locks = []
+
+    def get_cache_dir(self, kind, name):
+        """Returns the directory for a given cache, creating it if necessary.
+
+        The cache is marked as used by the current build, which protects it
+        from eviction until the build finishes (see the module documentation
+        for the limitations on Windows).
+
+        Args:
+            kind (CacheKind): Kind of the cache.
+            name (str): Name identifying the cache within its kind.  Needs to
+                be a valid file name.
+
+        Returns:
+            str: Absolute path to the cache directory.
+        """
+        CacheKind.validate(kind)
+        path = self._get_cache_path(kind, name)
+        entry = CacheEntry(kind, name)
+        if entry.key in self._used:
+            return path
+        with self._lock_index():
+            index = self._read_index()
+            if entry.key in index:
+                entry = index[entry.key]
+            entry.last_used = time.time()
+            index[entry.key] = entry
+            self._executor.ensure_dir_exists(path)
+            # Never wait for the lock here: the index lock is held, and a
+            # shared lock only fails if it is exclusive (on Windows) or the
+            # cache is being evicted (which needs the index lock).
+            self._locks.append(self._executor.lock_file(path + '.lock',
+                shared=True, blocking=False))
+            self._write_index(index)
+        self._used[entry.key] = entry
+        return path
+
+    def _get_cache_path(self, kind, name):
+        return os.path.join(self.root, kind, name)
+
+    def _lock_index(self):
+        self._executor.ensure_dir_exists(self.root)
+        return self._executor.lock_file(self._index_lock_path)
+
+    def _read_index(self):
+        """Reads the index, adding any caches that are missing from it.
+
+        Must be called with the index lock held.
+        """
+        index = dict()
+        try:
+            data = json.loads(''.join(self._executor.read_file(self._index_path)))
+            for item in data['entries']:
+                entry = CacheEntry.from_dict(item)
+                index[entry.key] = entry
+        except (IOError, ValueError, KeyError):
+            pass
+        # Caches may be missing from the index if a build has been killed
+        # in the middle of writing it, so also check the directories.
+        for kind in CacheKind._values:
+            kind_dir = os.path.join(self.root, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for name in os.listdir(kind_dir):
+                path = os.path.join(kind_dir, name)
+                entry = CacheEntry(kind, name)
+                if entry.key in index or not os.path.isdir(path):
+                    continue
+                entry.size = int(self._executor.get_disk_usage(path))
+                entry.last_used = os.path.getmtime(path)
+                index[entry.key] = entry
+        return index
+
+    def _write_index(self, index):
+        entries = [index[key].to_dict() for key in sorted(index.iterkeys())]
+        contents = json.dumps({'entries': entries}, indent=2)
+        self._executor.write_file(self._index_path, contents)
+
+    def _evict(self, entry):
+        """Removes a cache from the disk if it is not in use.
+
+        Must be called with the index lock held.
+        """
+        path = self._get_cache_path(entry.kind, entry.name)
+        lock = self._executor.lock_file(path + '.lock', blocking=False)
+        if lock is None:
+            return False
+        self._executor.remove_path(path)
+        lock.release()
+        self._executor.remove_path(path + '.lock')
+        return True
+
+    def _finish_build(self):
+        """Updates the index at the end of the build and enforces the budget.
+
+        Sizes of the caches used in this build are updated, and least recently
+        used caches are evicted until the total size is within the budget.
+        Usage statistics are printed to the build log.
+        """
+        if not self._used:
+            return
+        with self._lock_index():
+            index = self._read_index()
+            for key, entry in self._used.iteritems():
+                path = self._get_cache_path(entry.kind, entry.name)
+                entry.size = int(self._executor.get_disk_usage(path))
+                if key in index:
+                    entry.last_used = max(entry.last_used, index[key].last_used)
+                index[key] = entry
+            for lock in self._locks:
+                if lock is not None:
+                    lock.release()
+            self._locks = []
+            evicted = evict_least_recently_used(index.values(), self.budget, self._evict)
+            for entry in evicted:
+                del index[entry.key]
+            self._write_index(index)
+        self._used = dict()
+        self._print_usage_statistics(index, evicted)
+
+    def _print_usage_statistics(self, index, evicted):
+        console = self._executor.console
+        by_kind = dict()
+        for entry in index.itervalues():
+            count, size = by_kind.get(entry.kind, (0, 0))
+            by_kind[entry.kind] = (count + 1, size + entry.size)
+        total = sum([x.size for x in index.itervalues()])
+        print('-----------------------------------------------------------', file=console)
+        print('Node-local caches in {0}:'.format(self.root), file=console)
+        for kind in sorted(by_kind.iterkeys()):
+            count, size = by_kind[kind]
+            print('  {0:16} {1:4} {2:>12}'.format(kind + ':', count, utils.format_size(size)), file=console)
+        print('  {0:16} {1:4} {2:>12} (budget {3})'.format('total:', len(index),
+            utils.format_size(total), utils.format_size(self.budget)), file=console)
+        for entry in evicted:
+            last_used = datetime.datetime.fromtimestamp(entry.last_used)
+            print('  evicted {0} ({1}, last used {2:%Y-%m-%d %H:%M})'.format(
+                entry.key, utils.format_size(entry.size), last_used), file=console)
+        print('-----------------------------------------------------------', file=console)
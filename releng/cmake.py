@@ -1,12 +1,20 @@
 """
 Helper routines for parsing CMake-related stuff.
 """
+import hashlib
 import os.path
 import re
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
 
 from common import BuildError, ConfigurationError
 
+# Output of passing tests longer than this (in characters) is truncated in the
+# JUnit XML produced from CTest results.
+DEFAULT_MAX_PASSED_OUTPUT = 64 * 1024
+
+_CTEST_OUTPUT_DIR = 'Testing/Temporary/CTestOutput'
+
 def read_cmake_variable_file(executor, path):
     """Reads a file with CMake variable declarations (set commands).
 
@@ -43,19 +51,236 @@ def get_cmake_version(cmd_runner, cmake_executable):
         return match.group(1)
     raise ConfigurationError('Could not parse CMake version:\n' + output)
 
-def process_ctest_xml(executor, memcheck):
+# Cache entries that store results of configure checks (try_compile() and
+# friends), which can be reused between builds with the same toolchain.
+_CHECK_RESULT_RE = re.compile(
+        r'^HAVE_|_COMPILE_RESULT|_FLAG_ACCEPTED$|^C(XX)?_FLAG|^C(XX)?FLAGS_|_COMPILES$|_RUNS$|_WORKS$')
+
+def read_cmake_cache(executor, path):
+    """Reads entries from a CMakeCache.txt file.
+
+    Args:
+        path (str): Path to the file to read.
+
+    Returns:
+        List[Tuple[str, str, str]]: Name, type, and value of each entry.
+    """
+    entries = []
+    entry_re = r'^([^#/][^:=]*):([A-Z]+)=(.*)$'
+    for line in executor.read_file(path):
+        match = re.match(entry_re, line.rstrip('\r\n'))
+        if match:
+            entries.append((match.group(1), match.group(2), match.group(3)))
+    return entries
+
+def select_check_results(entries, excluded_paths):
+    """Selects cache entries that store results of configure checks.
+
+    Args:
+        entries (List[Tuple[str, str, str]]): Entries from read_cmake_cache().
+        excluded_paths (List[str]): Entries whose value contains any of these
+            paths are skipped, since they are specific to a workspace.
+
+    Returns:
+        List[Tuple[str, str, str]]: Selected entries.
+    """
+    result = []
+    for name, entry_type, value in entries:
+        if name.startswith('CMAKE_') or not _CHECK_RESULT_RE.search(name):
+            continue
+        if any([path in value for path in excluded_paths]):
+            continue
+        result.append((name, entry_type, value))
+    return result
+
+def write_cmake_initial_cache(executor, path, entries):
+    """Writes cache entries as an initial cache file for ``cmake -C``.
+
+    The file is written to a temporary file and renamed into place, so that
+    concurrent builds never read a partially written file.
+
+    Args:
+        path (str): Path to the file to write.
+        entries (List[Tuple[str, str, str]]): Entries to write.
+    """
+    lines = []
+    for name, entry_type, value in entries:
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        lines.append('set({0} "{1}" CACHE {2} "")\n'.format(name, value, entry_type))
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    executor.write_file(temp_path, ''.join(lines))
+    executor.rename_file(temp_path, path)
+
+def get_ctest_xml_path(executor, memcheck):
+    """Returns path to the CTest XML file with results of the latest run."""
     tag = _read_ctest_tag_name(executor)
-    xml_name, test_xpath, suite_name = _get_properties(memcheck)
-    ctest_root = _read_ctest_xml(executor, tag, xml_name)
-    junit_root = ET.Element('testsuites')
-    junit_suite = ET.SubElement(junit_root, 'testsuite', {'name': suite_name})
-    for test in ctest_root.findall(test_xpath):
-        if memcheck:
-            _create_junit_testcase_memcheck(test, junit_suite, suite_name)
-        else:
-            _create_junit_testcase(test, junit_suite, suite_name)
-    contents = ET.tostring(junit_root)
+    xml_name, container, suite_name = _get_properties(memcheck)
+    return os.path.join('Testing', tag, xml_name)
+
+def process_ctest_xml(executor, memcheck, max_passed_output=DEFAULT_MAX_PASSED_OUTPUT,
+        attempt_paths=None, results=None, prior_paths=None):
+    """Converts CTest XML results to JUnit XML for Jenkins.
+
+    The CTest XML is parsed incrementally, and the JUnit XML is written as the
+    tests are processed, so that memory usage does not depend on the number of
+    tests (memcheck runs in particular produce very large files).  The results
+    are collected in a first pass over the tests, before the JUnit XML is
+    generated in a second pass.
+
+    If failed tests have been rerun, the results of all attempts are merged.
+    A test that passes in a rerun is reported as passing, with the earlier
+    failures as ``flakyFailure`` elements; a test that fails in all attempts
+    is reported as failing, with the rerun failures as ``rerunFailure``
+    elements (as in the Maven Surefire format understood by Jenkins).
+
+    Args:
+        executor (Executor): Executor to access the files.
+        memcheck (bool): Whether to process results of a memcheck run.
+        max_passed_output (Optional[int]): Output of passing tests longer
+            than this many characters is truncated in the JUnit XML, and the
+            full output is written to a separate file under
+            :file:`Testing/Temporary/CTestOutput/`.  If ``None``, the output
+            is never truncated.
+        attempt_paths (Optional[List[str]]): Paths to CTest XML files from
+            a run and the reruns of its failed tests, in order.  If not
+            given, the results of the latest run are processed.
+        results (Optional[List[Tuple[str, str, float]]]): If given, the name,
+            status (``passed``, ``failed``, ``flaky``, or ``notrun``), and
+            duration in seconds (``None`` for memcheck) of each test are
+            appended to this list.
+        prior_paths (Optional[List[str]]): Paths to CTest XML files from
+            earlier runs of other tests (e.g., tests run first by priority),
+            whose results are reported before those of the run.
+
+    Returns:
+        Tuple[List[str], List[str]]: Names of flaky tests (failed, but
+            passed in a rerun) and of failed tests.
+    """
+    xml_name, container, suite_name = _get_properties(memcheck)
+    reruns = dict()
+    if attempt_paths:
+        xml_path = attempt_paths[0]
+        for path in attempt_paths[1:]:
+            for test in _iterate_ctest_tests(executor, path, container):
+                junit_case = _create_junit_testcase_any(test, memcheck, suite_name)
+                reruns.setdefault(junit_case.get('name'), []).append(junit_case)
+    else:
+        xml_path = get_ctest_xml_path(executor, memcheck)
+    paths = list(prior_paths or []) + [xml_path]
+    flaky = []
+    failed = []
+    for test in _iterate_ctest_tests_in_files(executor, paths, container):
+        junit_case, status = _convert_test(test, memcheck, suite_name, reruns)
+        name = junit_case.get('name')
+        if status == 'flaky':
+            flaky.append(name)
+        elif status != 'passed':
+            failed.append(name)
+        if results is not None:
+            results.append((name, status, _get_duration(junit_case)))
+    tests = _iterate_ctest_tests_in_files(executor, paths, container)
+    contents = _generate_junit_xml(executor, tests, memcheck, suite_name, max_passed_output,
+            reruns)
     executor.write_file('Testing/Temporary/CTest.xml', contents)
+    return flaky, failed
+
+def read_ctest_cost_data(lines):
+    """Parses test timings from a CTest cost data file.
+
+    Args:
+        lines (Iterable[str]): Contents of :file:`CTestCostData.txt`.
+
+    Returns:
+        Dict[str, float]: Average duration for each test with timing data.
+    """
+    costs = dict()
+    for line in lines:
+        if line.startswith('---'):
+            # Names of tests that failed in the last run follow.
+            break
+        parts = line.strip().rsplit(None, 2)
+        if len(parts) != 3:
+            continue
+        try:
+            costs[parts[0]] = float(parts[2])
+        except ValueError:
+            continue
+    return costs
+
+def parse_ctest_test_list(text):
+    """Parses test names from the output of ``ctest -N``.
+
+    Used to list the tests with CTest versions that do not support
+    ``--show-only=json-v1``.
+
+    Returns:
+        List[str]: Names of the tests, in the order CTest lists them.
+    """
+    return [x.rstrip() for x in re.findall(r'^\s*Test\s+#\d+: (.+)$', text, re.MULTILINE)]
+
+def split_ctest_tests(tests, costs, count):
+    """Splits tests into shards with balanced total duration.
+
+    Tests are assigned longest first to the shard with the smallest total
+    duration so far, with ties broken by name and by shard index, so the
+    result only depends on the arguments.  Tests without timing data are
+    assumed to take the average time of the others (or all equally long if
+    there is no timing data).
+
+    Args:
+        tests (Iterable[str]): Names of the tests.
+        costs (Dict[str, float]): Test durations from read_ctest_cost_data().
+        count (int): Number of shards.
+
+    Returns:
+        List[List[str]]: Sorted test names for each shard.
+    """
+    tests = list(tests)
+    known = [costs[x] for x in tests if x in costs]
+    default = sum(known) / len(known) if known else 1.0
+    shards = [[] for i in range(count)]
+    totals = [0.0] * count
+    for test in sorted(tests, key=lambda x: (-costs.get(x, default), x)):
+        index = min(range(count), key=lambda i: (totals[i], i))
+        shards[index].append(test)
+        totals[index] += costs.get(test, default)
+    return [sorted(x) for x in shards]
+
+def select_ctest_tests_for_budget(tests, ordered, costs, budget, jobs):
+    """Selects tests that fit into a wall-clock time budget.
+
+    Tests in ``ordered`` are considered first, in the given order, and then
+    the remaining tests shortest first.  A test that does not fit is skipped,
+    but later (shorter) tests can still be selected.  The wall-clock time is
+    estimated as the total duration divided by the number of parallel jobs.
+
+    Args:
+        tests (Iterable[str]): Names of the tests that can be run.
+        ordered (List[str]): Tests to consider first (others are ignored).
+        costs (Dict[str, float]): Test durations from read_ctest_cost_data().
+            Tests without timing data are assumed to take the average time.
+        budget (float): Budget in seconds.
+        jobs (int): Number of tests run in parallel.
+
+    Returns:
+        List[str]: Sorted names of the selected tests.
+    """
+    tests = set(tests)
+    known = [costs[x] for x in tests if x in costs]
+    default = sum(known) / len(known) if known else 0.0
+    candidates = [x for x in ordered if x in tests]
+    rest = tests.difference(candidates)
+    candidates.extend(sorted(rest, key=lambda x: (costs.get(x, default), x)))
+    selected = set()
+    total = 0.0
+    for test in candidates:
+        if test in selected:
+            continue
+        cost = costs.get(test, default)
+        if (total + cost) / jobs <= budget:
+            selected.add(test)
+            total += cost
+    return sorted(selected)
 
 def _read_ctest_tag_name(executor):
     lines = list(executor.read_file('Testing/TAG'))
@@ -68,35 +293,162 @@ def _get_properties(memcheck):
         # TODO: If the tests pass, they do not create Test entries at all (at
         # least, not for ASAN)...
         # It would be nice to still get the same list of tests always.
-        return 'DynamicAnalysis.xml', './DynamicAnalysis/Test', 'CTest_MemCheck'
+        return 'DynamicAnalysis.xml', 'DynamicAnalysis', 'CTest_MemCheck'
     else:
-        return 'Test.xml', './Testing/Test', 'CTest'
+        return 'Test.xml', 'Testing', 'CTest'
+
+class _BlockReader(object):
+    """File-like object for reading from an iterable of strings."""
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._buffer = ''
 
-def _read_ctest_xml(executor, tag, xml_name):
-    xml_path = os.path.join('Testing', tag, xml_name)
-    xml_lines = executor.read_file(xml_path)
-    return ET.fromstring(''.join(xml_lines))
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._blocks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        result = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return result
+
+def _iterate_ctest_tests(executor, xml_path, container):
+    """Iterates over Test elements in a CTest XML file.
+
+    Each element is cleared after it has been processed, so only a single
+    test is kept in memory at a time.
+    """
+    stream = _BlockReader(executor.read_file(xml_path, binary=True))
+    parents = []
+    for event, elem in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == 'Test' and len(parents) == 2 and parents[1].tag == container:
+            yield elem
+            parents[1].clear()
+
+def _convert_test(test, memcheck, suite_name, reruns):
+    """Converts a CTest test to a JUnit test case, merging any reruns.
+
+    Returns:
+        Tuple[Element, str]: The test case, and the status of the test
+            (``passed``, ``failed``, ``flaky``, or ``notrun``).
+    """
+    junit_case = _create_junit_testcase_any(test, memcheck, suite_name)
+    if junit_case.find('failure') is None:
+        return junit_case, 'passed'
+    junit_case = _merge_reruns(junit_case, reruns.get(junit_case.get('name'), []))
+    if junit_case.find('failure') is None:
+        return junit_case, 'flaky'
+    return junit_case, 'notrun' if test.get('Status') == 'notrun' else 'failed'
+
+def _iterate_ctest_tests_in_files(executor, paths, container):
+    """Iterates over Test elements in several CTest XML files in order."""
+    for path in paths:
+        for test in _iterate_ctest_tests(executor, path, container):
+            yield test
+
+def _generate_junit_xml(executor, tests, memcheck, suite_name, max_passed_output, reruns):
+    """Generates JUnit XML in chunks, one test case at a time."""
+    yield '<testsuites><testsuite name={0}>'.format(quoteattr(suite_name))
+    for test in tests:
+        junit_case, status = _convert_test(test, memcheck, suite_name, reruns)
+        output = junit_case.find('system-out')
+        if junit_case.find('failure') is None:
+            output.text = _limit_output(executor, junit_case.get('name'), output.text,
+                    max_passed_output)
+        yield ET.tostring(junit_case)
+    yield '</testsuite></testsuites>'
+
+def _get_duration(junit_case):
+    time = junit_case.get('time')
+    try:
+        return float(time)
+    except (TypeError, ValueError):
+        return None
+
+def _merge_reruns(junit_case, reruns):
+    """Merges results from reruns of a failed test into its test case."""
+    attempts = [junit_case] + reruns
+    passing = [x for x in attempts if x.find('failure') is None]
+    if passing:
+        result = ET.Element('testcase', passing[0].attrib)
+        for attempt in attempts[:attempts.index(passing[0])]:
+            _add_attempt_failure(result, 'flakyFailure', attempt)
+        result.append(passing[0].find('system-out'))
+    else:
+        result = ET.Element('testcase', junit_case.attrib)
+        result.append(junit_case.find('failure'))
+        for attempt in reruns:
+            _add_attempt_failure(result, 'rerunFailure', attempt)
+        result.append(junit_case.find('system-out'))
+    return result
+
+def _add_attempt_failure(parent, tag, attempt):
+    attrs = {'message': attempt.find('failure').get('message')}
+    if attempt.get('time') is not None:
+        attrs['time'] = attempt.get('time')
+    element = ET.SubElement(parent, tag, attrs)
+    output = ET.SubElement(element, 'system-out')
+    output.text = attempt.find('system-out').text
+
+def _limit_output(executor, name, text, max_output):
+    """Truncates test output, writing the full output to a separate file."""
+    if text is None or max_output is None or len(text) <= max_output:
+        return text
+    path = os.path.join(_CTEST_OUTPUT_DIR, _get_output_file_name(name))
+    executor.ensure_dir_exists(_CTEST_OUTPUT_DIR)
+    contents = text
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    executor.write_file(path, contents)
+    return text[:max_output] + '\n[output truncated; full output in {0}]'.format(path)
+
+def _get_output_file_name(name):
+    """Returns a file name for the full output of a test.
+
+    If the test name needs to be sanitized, a hash of the original name is
+    added, so that different tests do not get the same file.
+    """
+    result = re.sub(r'[^\w.-]', '_', name)
+    if result != name:
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        result += '-' + hashlib.sha1(name).hexdigest()[:8]
+    return result + '.log'
+
+def _create_junit_testcase_any(test, memcheck, suite_name):
+    if memcheck:
+        return _create_junit_testcase_memcheck(test, suite_name)
+    return _create_junit_testcase(test, suite_name)
 
-def _create_junit_testcase(test, parent, suite_name):
+def _create_junit_testcase(test, suite_name):
     name = test.find('Name').text
     time = _get_named_measurement(test, 'Execution Time')
     passed = (test.get('Status') == 'passed')
     attrs = {'name': name, 'classname': suite_name, 'time': time}
-    junit_case = ET.SubElement(parent, 'testcase', attrs)
+    junit_case = ET.Element('testcase', attrs)
     if not passed:
         reason = _get_named_measurement(test, 'Exit Code')
         failure = ET.SubElement(junit_case, 'failure', {'message': reason})
     output = ET.SubElement(junit_case, 'system-out')
     output.text = test.find('./Results/Measurement/Value').text
+    return junit_case
 
 def _get_named_measurement(test, name):
     return test.find("./Results/NamedMeasurement[@name='{0}']/Value".format(name)).text
 
-def _create_junit_testcase_memcheck(test, parent, suite_name):
+def _create_junit_testcase_memcheck(test, suite_name):
     name = test.find('Name').text
     passed = (test.get('Status') == 'passed')
     attrs = {'name': name, 'classname': suite_name}
-    junit_case = ET.SubElement(parent, 'testcase', attrs)
+    junit_case = ET.Element('testcase', attrs)
     if not passed:
         # TODO: This will produce an empty message if the test fails normally,
         # not because of an ASAN error...
@@ -105,3 +457,4 @@ def _create_junit_testcase_memcheck(test, parent, suite_name):
         failure = ET.SubElement(junit_case, 'failure', {'message': reason})
     output = ET.SubElement(junit_case, 'system-out')
     output.text = test.find('Log').text
+    return junit_case
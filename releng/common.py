@@ -136,7 +136,24 @@ Simd = Enum.create('Simd',
     'ARM_NEON', 'ARM_NEON_ASIMD',
     doc="""Enum to identify the SIMD instruction set to use""")
 
+# The CMake generator names corresponding to these are in environment.py.
+Generator = Enum.create('Generator',
+    'make', 'ninja', 'jom',
+    doc="""Enum to identify the build tool (CMake generator) to use""")
+
+# The linker is selected with -fuse-ld=<value>.
+Linker = Enum.create('Linker',
+    'gold', 'lld',
+    doc="""Enum to identify the linker to use instead of the default one""")
+
 # There is no special significance with these strings.
 FftLibrary = Enum.create('FftLibrary',
     'fftpack', 'fftw3', 'mkl',
     doc="""Enum to identify the FFT library to use""")
+
+# The string values are used as directory names for the caches on the build
+# node.
+CacheKind = Enum.create('CacheKind',
+    'git-mirror', 'tarball', 'build-dir', 'compiler-cache', 'probe-cache',
+    'artifacts', 'test-cost', 'test-impact', 'test-history', 'coverage',
+    doc="""Enum to identify the kind of a node-local cache managed by releng""")
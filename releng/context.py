@@ -1,20 +1,53 @@
 """
 Top-level interface for build scripts to the releng package.
 """
+from __future__ import print_function
+
 import os
 import glob
 import hashlib
 import re
 import shutil
+import sqlite3
 import subprocess
 
 from common import BuildError, CommandError, ConfigurationError
-from common import JobType, Project
+from artifacts import ArtifactCache
+from common import CacheKind, JobType, Project
+from diagnostics import WarningCollector
 from options import BuildConfig, process_build_options, select_build_hosts
 from script import BuildScript
+from testimpact import TestImpactSelector
 import cmake
+import testimpact
 import utils
 
+# Test timings that CTest uses to schedule the longest tests first.
+_CTEST_COST_DATA = 'Testing/Temporary/CTestCostData.txt'
+# Results of the CTest run of prioritized tests (see run_ctest()).
+_CTEST_PRIORITY_XML = 'Testing/Temporary/CTestPriority.xml'
+
+# CTest arguments that select the tests to run.
+_CTEST_SELECTION_ARGS = ('-R', '-E', '-L', '-LE', '-I', '--tests-regex', '--exclude-regex',
+        '--label-regex', '--label-exclude', '--tests-information')
+# Arguments that select tests by name or number (not by label).
+_CTEST_NAME_SELECTION_ARGS = ('-R', '-E', '-I', '--tests-regex', '--exclude-regex',
+        '--tests-information')
+
+def _get_ctest_selection_args(args, selection_args=_CTEST_SELECTION_ARGS):
+    """Returns the arguments (with their values) that select tests in ``args``."""
+    result = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in selection_args:
+            result.append(arg)
+            if args:
+                result.append(args.pop(0))
+        elif arg.split('=', 1)[0] in selection_args:
+            result.append(arg)
+    return result
+
 class BuildContext(object):
     """Top-level interface for build scripts to the releng package.
 
@@ -41,6 +74,16 @@ class BuildContext(object):
         self._cwd = factory.cwd
         self._cmd_runner = factory.cmd_runner
         self._executor = factory.executor
+        self._job_slots = factory.job_slots
+        self._caches = factory.caches
+        self._remote_cache = factory.remote_cache
+        # The test history is opened on first use, since many builds do not
+        # run tests.
+        self._factory = factory
+        self._gerrit = factory.gerrit
+        self._timeline = factory.timeline
+        self._warnings = WarningCollector(factory.workspace.root, factory.cwd)
+        self._artifacts = None
         self._projects = factory.projects
         self._version = None
         self.workspace = factory.workspace
@@ -113,6 +156,14 @@ class BuildContext(object):
         The working directory should be the build directory.
         Currently, does not support running CMake multiple times.
 
+        Unless disabled with the ``no-configure-cache`` option, results of
+        configure checks are cached between builds that use the same
+        toolchain, and used to pre-seed the configuration.
+
+        With the ``artifact-cache`` option, the build and install trees are
+        restored from the artifact cache if the same configuration has been
+        built before on the node, and CMake is not run at all.
+
         Args:
             options (Dict[str,str]): Dictionary of macro definitions to pass to
                 CMake using ``-D``.
@@ -120,23 +171,141 @@ class BuildContext(object):
         Raises:
             BuildError: If CMake fails to configure the build system.
         """
-        options = options.copy()
-        options['CMAKE_C_COMPILER'] = self.env.c_compiler
-        options['CMAKE_CXX_COMPILER'] = self.env.cxx_compiler
-        options['CMAKE_INSTALL_PREFIX'] = self.workspace.install_dir
-        options.update(self.env.extra_cmake_options)
-        cmake_args = [self.env.cmake_command, self.workspace.get_project_dir(Project.GROMACS)]
-        if self.env.cmake_generator is not None:
-            cmake_args.extend(['-G', self.env.cmake_generator])
-        cmake_args.extend(
-                ['-D{0}={1}'.format(key, value)
-                    for key, value in sorted(options.iteritems())
-                    if value is not None])
-        self.run_cmd([self.env.cmake_command, '--version'])
-        self.run_cmd(cmake_args, failure_message='CMake configuration failed')
+        with self._timeline.span('run_cmake'):
+            options = options.copy()
+            options['CMAKE_C_COMPILER'] = self.env.c_compiler
+            options['CMAKE_CXX_COMPILER'] = self.env.cxx_compiler
+            options['CMAKE_INSTALL_PREFIX'] = self.workspace.install_dir
+            options.update(self.env.extra_cmake_options)
+            self.env._apply_debug_info_options(options.get('CMAKE_BUILD_TYPE'))
+            cmake_args = [self.env.cmake_command, self.workspace.get_project_dir(Project.GROMACS)]
+            if self.env.cmake_generator is not None:
+                cmake_args.extend(['-G', self.env.cmake_generator])
+            cmake_args.extend(
+                    ['-D{0}={1}'.format(key, value)
+                        for key, value in sorted(options.iteritems())
+                        if value is not None])
+            self.run_cmd([self.env.cmake_command, '--version'])
+            if self.opts.artifact_cache:
+                self._artifacts = self._create_artifact_cache(cmake_args)
+                if self._artifacts and self._artifacts.restore():
+                    return
+            initial_cache = None
+            fetched = False
+            if self.opts.configure_cache is not False:
+                initial_cache = self._get_configure_cache_file(options)
+            if initial_cache and not os.path.isfile(initial_cache) and self._remote_cache:
+                fetched = self._remote_cache.get_file(
+                        self._get_remote_key(initial_cache), initial_cache)
+            if initial_cache and os.path.isfile(initial_cache):
+                try:
+                    self.run_cmd(cmake_args + ['-C', initial_cache],
+                            failure_message='CMake configuration failed')
+                except BuildError:
+                    # The cached results may be the reason for the failure, so
+                    # retry from scratch.
+                    print('CMake configuration failed with cached check results, retrying without them',
+                            file=self._executor.console)
+                    self._executor.remove_path(initial_cache)
+                    self._executor.remove_path('CMakeCache.txt')
+                    self._executor.remove_path('CMakeFiles')
+                    self.run_cmd(cmake_args, failure_message='CMake configuration failed')
+            else:
+                self.run_cmd(cmake_args, failure_message='CMake configuration failed')
+            if initial_cache:
+                self._save_configure_cache(initial_cache)
+                if self._remote_cache and not fetched and os.path.isfile(initial_cache):
+                    self._remote_cache.put_file(
+                            self._get_remote_key(initial_cache), initial_cache)
+
+    def _get_remote_key(self, path):
+        """Returns the remote cache key for a file in a node-local cache."""
+        return os.path.basename(os.path.dirname(path))
+
+    def _get_configure_cache_file(self, options):
+        """Returns path to the initial cache file with cached check results.
+
+        The file is in a node-local cache that is specific to the toolchain
+        and to the CMake options (other than the install prefix, which is
+        specific to the workspace), since options such as SIMD, GPU, or MPI
+        support change which checks run and what they find.
+
+        Returns:
+            str or None: Path to the file (it may not exist), or None if the
+                toolchain could not be identified.
+        """
+        fingerprint = self.env._get_toolchain_fingerprint()
+        if fingerprint is None:
+            return None
+        for key, value in sorted(options.iteritems()):
+            if value is not None and key != 'CMAKE_INSTALL_PREFIX':
+                fingerprint.append('{0}={1}'.format(key, value))
+        key = hashlib.sha1('\n'.join(fingerprint)).hexdigest()[:16]
+        cache_dir = self._caches.get_cache_dir(CacheKind.PROBE_CACHE, 'configure-' + key)
+        return os.path.join(cache_dir, 'InitialCache.cmake')
+
+    def _save_configure_cache(self, path):
+        """Saves results of configure checks from CMakeCache.txt."""
+        try:
+            entries = cmake.read_cmake_cache(self._executor, 'CMakeCache.txt')
+        except IOError:
+            return
+        # The build directory is always under the workspace root.
+        entries = cmake.select_check_results(entries, [self.workspace.root])
+        if entries:
+            cmake.write_cmake_initial_cache(self._executor, path, entries)
+
+    def _create_artifact_cache(self, cmake_args):
+        """Creates the artifact cache for the configuration being built.
+
+        The cache is keyed by the source tree, the CMake command line, the
+        build options, the environment variables set for the build (e.g., by
+        the options), and the toolchain.  The build tree contains absolute
+        paths, so the workspace root is also part of the key.
+
+        Returns:
+            ArtifactCache or None: The cache, or None if the configuration
+                cannot be cached.
+        """
+        console = self._executor.console
+        if not self.workspace._out_of_source:
+            print('Artifact cache is only supported for out-of-source builds', file=console)
+            return None
+        fingerprint = self.env._get_toolchain_fingerprint()
+        if fingerprint is None:
+            print('Artifact cache disabled: could not identify the toolchain', file=console)
+            return None
+        try:
+            tree = self.workspace._get_git_tree_hash(Project.GROMACS)
+        except CommandError:
+            tree = None
+        if tree is None:
+            print('Artifact cache disabled: could not identify the source tree', file=console)
+            return None
+        fingerprint.append('tree=' + tree)
+        fingerprint.append('root=' + self.workspace.root)
+        fingerprint.extend(cmake_args)
+        for name, value in sorted(self.opts._opts.iteritems()):
+            if value is not None:
+                fingerprint.append('opt:{0}={1}'.format(name, value))
+        for name, value in sorted(self._cmd_runner.get_changed_env_vars().iteritems()):
+            fingerprint.append('env:{0}={1}'.format(name, value))
+        key = hashlib.sha1('\n'.join(fingerprint)).hexdigest()[:16]
+        cache_dir = self._caches.get_cache_dir(CacheKind.ARTIFACTS, key)
+        return ArtifactCache(self._executor, cache_dir,
+                self.workspace.build_dir, self.workspace.install_dir,
+                remote=self._remote_cache, remote_key='artifacts-' + key)
+
+    def _save_artifact_cache(self):
+        """Saves the built trees to the artifact cache if the build succeeded."""
+        if self._artifacts is None or self._status_reporter.failed:
+            return
+        with self._timeline.span('save_artifact_cache'):
+            self._artifacts.save()
 
     def build_target(self, target=None, parallel=True, keep_going=False,
-            target_descr=None, failure_string=None, continue_on_failure=False):
+            target_descr=None, failure_string=None, continue_on_failure=False,
+            artifact=None):
         """Builds a given target.
 
         run_cmake() must have been called to generate the build system.
@@ -156,51 +325,497 @@ class BuildContext(object):
             continue_on_failure (Optional[bool]): If ``True`` and the target
                 fails to build, the failure is only reported and
                 ``self.failed`` is set to ``True``.
+            artifact (Optional[bool]): Whether the target produces build
+                artifacts, i.e., does not need to be built again if the trees
+                are restored from the artifact cache.  By default, only the
+                default target, ``tests``, and ``install`` are assumed to.
 
         Raises:
             BuildError: If the target fails to build, and
                 ``continue_on_failure`` is not specified.
         """
-        cmd = self.env._get_build_cmd(target=target, parallel=parallel, keep_going=keep_going)
+        if self._artifacts and self._artifacts.is_target_restored(target):
+            return
         try:
-            self.run_cmd(cmd)
+            self._run_build_cmd(target, parallel, keep_going)
+            if self._artifacts:
+                self._artifacts.add_target(target, artifact)
         except BuildError:
             if failure_string is None:
-                if target_descr is not None:
-                    what = target_descr
-                elif target is None:
-                    what = 'Default (all) target'
-                else:
-                    what = target + ' target'
-                failure_string = '{0} failed to build'.format(what)
+                failure_string = self._get_build_failure_string(target, target_descr)
             if continue_on_failure:
                 self._status_reporter.mark_failed(failure_string)
             else:
                 raise BuildError(failure_string)
 
-    def run_ctest(self, args, memcheck=False, failure_string=None):
+    def build_targets(self, targets, parallel=True, keep_going=False,
+            target_descrs=None, failure_strings=None, continue_on_failure=False,
+            artifacts=None):
+        """Builds several targets with a single build tool invocation.
+
+        Avoids the overhead of separate build_target() calls (each of which
+        needs to check the whole dependency graph).  Failures are reported in
+        the same way as for build_target(): if building the targets together
+        fails, they are built one by one to find out which target failed.
+        If the build tool cannot build several targets at once, the targets
+        are always built one by one.
+
+        Args:
+            targets (List[str]): Names of the targets to build, in the order
+                that they would be built with build_target().
+            parallel (Optional[bool]): Whether parallel building is supported.
+            keep_going (Optional[bool]): Whether to continue building after
+                first error.
+            target_descrs (Optional[Dict[str, str]]): Values for
+                ``target_descr`` of build_target(), keyed by target name.
+            failure_strings (Optional[Dict[str, str]]): Values for
+                ``failure_string`` of build_target(), keyed by target name.
+            continue_on_failure (Optional[bool]): As for build_target().
+            artifacts (Optional[Dict[str, bool]]): Values for ``artifact`` of
+                build_target(), keyed by target name.
+
+        Raises:
+            BuildError: If a target fails to build, and
+                ``continue_on_failure`` is not specified.
+        """
+        if target_descrs is None:
+            target_descrs = dict()
+        if failure_strings is None:
+            failure_strings = dict()
+        if artifacts is None:
+            artifacts = dict()
+        if self._artifacts:
+            targets = [x for x in targets if not self._artifacts.is_target_restored(x)]
+        if len(targets) > 1 and self.env._supports_multiple_targets():
+            try:
+                self._run_build_cmd(list(targets), parallel, keep_going)
+                if self._artifacts:
+                    for target in targets:
+                        self._artifacts.add_target(target, artifacts.get(target))
+                return
+            except BuildError:
+                print('Building the targets together failed, building them one by one',
+                        file=self._executor.console)
+        for target in targets:
+            self.build_target(target, parallel=parallel, keep_going=keep_going,
+                    target_descr=target_descrs.get(target),
+                    failure_string=failure_strings.get(target),
+                    continue_on_failure=continue_on_failure,
+                    artifact=artifacts.get(target))
+
+    def _run_build_cmd(self, target, parallel, keep_going):
+        if target is None:
+            name = 'build'
+        elif isinstance(target, list):
+            name = 'build ' + ' '.join(target)
+        else:
+            name = 'build ' + target
+        jobs = self.env._build_jobs if parallel else 1
+        with self._timeline.span(name):
+            with self._job_slots.acquire(jobs) as slots:
+                cmd = self.env._get_build_cmd(target=target, parallel=parallel,
+                        keep_going=keep_going, jobs=slots.count)
+                self.run_cmd(cmd, output_handler=self._warnings.process_line)
+
+    def _get_build_failure_string(self, target, target_descr):
+        if target_descr is not None:
+            what = target_descr
+        elif target is None:
+            what = 'Default (all) target'
+        else:
+            what = target + ' target'
+        return '{0} failed to build'.format(what)
+
+    def run_ctest(self, args, memcheck=False, failure_string=None,
+            max_passed_output=cmake.DEFAULT_MAX_PASSED_OUTPUT, rerun_failed=0,
+            smoke_tests=testimpact.DEFAULT_SMOKE_TESTS):
         """Runs tests using CTest.
 
         The build is marked unstable if any test fails.
 
+        Unless ``args`` specify the parallelism, the tests are run in
+        parallel with the number of jobs determined from the node resources.
+        Test timings from earlier runs of the same configuration (on the same
+        branch) are kept in a node-local cache and restored before the run,
+        so that CTest can start the longest tests first.
+
+        For Gerrit builds of GROMACS changes, only tests that can be
+        affected by the change (plus ``smoke_tests``) are run, unless disabled
+        with the ``no-test-impact`` option or ``args`` select the tests.
+
+        With the ``test-shard=K/N`` option, the tests (after the above
+        selection) are split into N shards with balanced durations, and only
+        shard K is run.  The split needs to be identical in all the shards, so
+        it only uses timing data from the remote cache (pinned per GROMACS
+        revision when the first shard starts); without a remote cache, the
+        tests are split evenly by count.
+
+        For Gerrit builds, tests that have recently failed in the same
+        configuration or whose executables depend on the changed files are
+        run first, in a separate CTest run before the other tests, so that
+        likely failures are reported quickly.  The ``no-test-priority``
+        option disables this, and it is not done if ``rerun_failed`` is
+        given or ``args`` select the tests.  With ``test-budget=MINUTES``,
+        only tests that are estimated to fit into the budget are run,
+        selected in the same priority order (followed by ``smoke_tests`` and
+        then the shortest tests).  Nightly and release builds always run all
+        tests without a budget.
+
+        With the ``test-fail-fast`` option, CTest stops at the first failure
+        (if it supports it and ``rerun_failed`` is not given), and the other
+        tests are not run if a prioritized test fails.
+
+        If ``rerun_failed`` is given, failed tests are rerun (only those,
+        with ``--rerun-failed``) up to that many times.  Tests that pass in a
+        rerun are reported as flaky in the JUnit XML and do not make the
+        build unstable.
+
+        With the ``artifact-cache`` option, the built trees are saved to the
+        artifact cache before running the tests for the first time, so that
+        test output does not end up in the cache.
+
         Args:
             args (List[str]): Additional arguments to pass to CTest.
             memcheck (Optional[bool]): If ``true``, run CTest with a memory checker.
             failure_string (Optional[str]): If give, this message is used as
                 the failure message reported to Gerrit if the tests fail.
+            max_passed_output (Optional[int]): Output of passing tests
+                longer than this many characters is truncated in the JUnit
+                XML for Jenkins, with the full output written to
+                :file:`Testing/Temporary/CTestOutput/`.  ``None`` disables
+                the truncation.
+            rerun_failed (Optional[int]): Maximum number of times to rerun
+                failed tests.
+            smoke_tests (Optional[List[str]]): Tests that are always run when
+                tests are selected based on the change.
         """
         dtype = 'ExperimentalTest'
         if memcheck:
             dtype = 'ExperimentalMemCheck'
         cmd = [self.env.ctest_command, '-D', dtype]
         cmd.extend(args)
-        try:
-            self._cmd_runner.check_call(cmd)
-        except CommandError as e:
+        jobs = 1
+        parallel = not any(x.startswith(('-j', '--parallel')) for x in args)
+        if parallel:
+            jobs = self.env.test_jobs
+        cost_data_file = self._get_test_cost_data_file(memcheck)
+        tests = None
+        affected = None
+        if self._should_select_tests(args):
+            tests, affected = self._select_impacted_tests(smoke_tests)
+        if self.opts.test_shard:
+            tests = self._select_shard_tests(args, memcheck, tests)
+        priority = []
+        if self._should_prioritize_tests():
+            priority = self._get_priority_tests(memcheck, affected)
+            if self.opts.test_budget:
+                tests = self._select_tests_for_budget(args, tests, priority + list(smoke_tests),
+                        cost_data_file, jobs)
+        fail_fast = self.opts.test_fail_fast and not rerun_failed
+        if fail_fast and self.env._supports_ctest_stop_on_failure():
+            cmd.append('--stop-on-failure')
+        if rerun_failed or _get_ctest_selection_args(args, _CTEST_NAME_SELECTION_ARGS):
+            # --rerun-failed only knows about the latest CTest run, and the
+            # selection would conflict with the one from the build script.
+            priority = []
+        if tests is not None:
+            priority = [x for x in priority if x in tests]
+        self._save_artifact_cache()
+        self._restore_test_cost_data(cost_data_file)
+        prior_paths = None
+        error = None
+        run_others = True
+        if priority:
+            # CTest has no way to order the tests it runs, so the prioritized
+            # tests are run first in a separate run.
+            priority_regex = testimpact.format_test_regex(priority)
+            error = self._run_ctest_attempt('run_priority_tests',
+                    cmd + ['-R', priority_regex], jobs, parallel)
+            prior_paths = [_CTEST_PRIORITY_XML]
+            self._executor.copy_file(cmake.get_ctest_xml_path(self._executor, memcheck),
+                    _CTEST_PRIORITY_XML)
+            cmd = cmd + ['-E', priority_regex]
+            if tests is not None:
+                tests = [x for x in tests if x not in priority]
+                run_others = bool(tests)
+            if error is not None and fail_fast:
+                print('Not running the other tests after a prioritized test failed',
+                        file=self._executor.console)
+                run_others = False
+        if tests is not None:
+            cmd.extend(['-R', testimpact.format_test_regex(tests)])
+        if run_others:
+            error = self._run_ctest_attempt('run_ctest', cmd, jobs, parallel) or error
+        else:
+            # The latest results are from the run of the prioritized tests.
+            prior_paths = None
+        first_error = error
+        attempt_paths = None
+        attempt = 0
+        while error is not None and attempt < rerun_failed:
+            if attempt_paths is None:
+                attempt_paths = [self._save_ctest_attempt(memcheck, attempt)]
+            attempt += 1
+            print('Rerunning failed tests (attempt {0} of {1})'.format(attempt, rerun_failed),
+                    file=self._executor.console)
+            error = self._run_ctest_attempt('rerun_ctest', cmd + ['--rerun-failed'],
+                    jobs, parallel)
+            attempt_paths.append(self._save_ctest_attempt(memcheck, attempt))
+        self._save_test_cost_data(cost_data_file)
+        if self.opts.test_shard and self._remote_cache and os.path.isfile(cost_data_file):
+            self._remote_cache.put_file(self._get_remote_key(cost_data_file), cost_data_file)
+        results = []
+        with self._timeline.span('process_ctest_xml'):
+            flaky, failed = cmake.process_ctest_xml(self._executor, memcheck,
+                    max_passed_output, attempt_paths, results, prior_paths)
+        self._record_test_history(memcheck, results)
+        if flaky:
+            print('Flaky tests (failed, but passed when rerun): ' + ', '.join(flaky),
+                    file=self._executor.console)
+            self._status_reporter.statistics.setdefault('flaky_tests', []).extend(flaky)
+        if error is not None:
             if failure_string is None:
-                failure_string = 'failed test: ' + e.cmd
+                failure_string = 'failed test: ' + first_error.cmd
             self.mark_unstable(failure_string)
-        cmake.process_ctest_xml(self._executor, memcheck)
+
+    def _record_test_history(self, memcheck, results):
+        """Stores test results into the history, and reports the slowest tests.
+
+        The history is only used for statistics, so any problem with it is
+        reported on the console, but does not affect the build.
+        """
+        if not results:
+            return
+        history = self._factory.test_history
+        if history is None:
+            return
+        config = self._get_test_history_config(memcheck)
+        revision = self._get_gromacs_revision()
+        try:
+            history.add_build(config, revision, results,
+                    branch=self._gerrit.get_triggering_branch(), job_type=self.job_type)
+            history.remove_old_builds()
+            slowest = history.get_slowest_tests(config)
+        except sqlite3.Error as e:
+            print('Failed to update test history: {0}'.format(e), file=self._executor.console)
+            return
+        self._status_reporter.statistics['slowest_tests'] = [
+                {'name': name, 'duration': round(duration, 2), 'runs': runs}
+                for name, duration, runs in slowest]
+
+    def _get_test_history_config(self, memcheck):
+        """Returns the configuration under which test results are stored."""
+        opts = []
+        for name, value in sorted(self.opts._opts.iteritems()):
+            if name in ('test-shard', 'test-fail-fast'):
+                continue
+            if value is True:
+                opts.append(name)
+            elif value is False:
+                opts.append('no-' + name)
+            elif value is not None:
+                opts.append('{0}={1}'.format(name, value))
+        if memcheck:
+            opts.append('memcheck')
+        return ' '.join(opts)
+
+    def _get_gromacs_revision(self):
+        """Returns the GROMACS commit being built, or None if not known."""
+        try:
+            return self._projects.get_project_info(Project.GROMACS).head_hash
+        except ConfigurationError:
+            return None
+
+    def _should_select_tests(self, args):
+        """Whether tests should be selected based on the change."""
+        if self.job_type != JobType.GERRIT or self.opts.test_impact is False:
+            return False
+        if self._gerrit.get_triggering_project() != Project.GROMACS:
+            return False
+        return not _get_ctest_selection_args(args)
+
+    def _select_shard_tests(self, args, memcheck, tests):
+        """Returns the tests to run in the shard selected with ``test-shard``.
+
+        Args:
+            tests (List[str] or None): Tests selected otherwise, or None if
+                all tests (selected by ``args``) would be run.
+        """
+        index, count = self.opts.test_shard
+        with self._timeline.span('select_shard_tests'):
+            if tests is None:
+                tests = self._list_ctest_tests(args)
+                if tests is None:
+                    raise BuildError('failed to list tests for test sharding')
+            costs = self._get_shard_cost_data(memcheck)
+            shard = cmake.split_ctest_tests(tests, costs, count)[index - 1]
+        print('Running test shard {0}/{1}: {2} of {3} tests'.format(
+            index, count, len(shard), len(tests)), file=self._executor.console)
+        return shard
+
+    def _list_ctest_tests(self, args):
+        """Returns names of the tests that CTest would run with ``args``.
+
+        With CTest older than 3.14, the human-readable output of ``ctest -N``
+        is parsed instead of the JSON listing.
+
+        Returns:
+            List[str] or None: Sorted test names, or None if the tests could
+            not be listed.
+        """
+        json_listing = self.env._supports_ctest_json_listing()
+        if json_listing:
+            cmd = [self.env.ctest_command, '--show-only=json-v1']
+        else:
+            cmd = [self.env.ctest_command, '-N']
+        cmd.extend(_get_ctest_selection_args(args))
+        try:
+            output = self._cmd_runner.check_output(cmd)
+            if json_listing:
+                return sorted(testimpact.parse_ctest_tests(output).keys())
+            return sorted(cmake.parse_ctest_test_list(output))
+        except (CommandError, TypeError, ValueError):
+            return None
+
+    def _get_shard_cost_data(self, memcheck):
+        """Returns test timings to use for splitting the tests into shards.
+
+        All shards of a build need to use the same timings, so node-local
+        data is not used.  The timings are taken from the remote cache, and
+        the first shard that starts pins a copy for the GROMACS revision, so
+        that shards starting later do not see timings updated by shards that
+        have already finished.  Shards on the same node share the local copy
+        of the pinned data, which is only written under a lock and renamed
+        into place.  If shards on different nodes pin the data concurrently,
+        each reads back the pinned copy after storing it.
+        """
+        revision = self._get_gromacs_revision()
+        if not self._remote_cache or revision is None:
+            return dict()
+        cost_data_file = self._get_test_cost_data_file(memcheck)
+        key = self._get_remote_key(cost_data_file)
+        pinned_key = key + '-' + revision
+        path = os.path.join(os.path.dirname(cost_data_file), 'shard-' + revision + '.txt')
+        with self._executor.lock_file(path + '.lock'):
+            if not os.path.isfile(path):
+                temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+                if not self._remote_cache.get_file(pinned_key, temp_path):
+                    if not self._remote_cache.get_file(key, temp_path):
+                        # Pin the absence of timings as well.
+                        self._executor.write_file(temp_path, '')
+                    self._remote_cache.put_file(pinned_key, temp_path)
+                    self._remote_cache.get_file(pinned_key, temp_path)
+                self._executor.rename_file(temp_path, path)
+            try:
+                return cmake.read_ctest_cost_data(self._executor.read_file(path))
+            except IOError:
+                return dict()
+
+    def _select_impacted_tests(self, smoke_tests):
+        with self._timeline.span('select_tests'):
+            branch = self._gerrit.get_triggering_branch() or 'unknown'
+            name = 'deps-' + hashlib.sha1(branch).hexdigest()[:16]
+            cache_dir = self._caches.get_cache_dir(CacheKind.TEST_IMPACT, name)
+            selector = TestImpactSelector(self._executor, self._cmd_runner, self.env,
+                    self.workspace.get_project_dir(Project.GROMACS), self._cwd.cwd,
+                    os.path.join(cache_dir, 'deps.json'))
+            tests = selector.select(smoke_tests)
+            return tests, selector.affected_tests
+
+    def _should_prioritize_tests(self):
+        """Whether tests likely to fail should be run first."""
+        return self.job_type == JobType.GERRIT and self.opts.test_priority is not False
+
+    def _get_priority_tests(self, memcheck, affected):
+        """Returns tests to run first: recent failures, then affected tests."""
+        priority = []
+        history = self._factory.test_history
+        if history is not None:
+            config = self._get_test_history_config(memcheck)
+            try:
+                priority.extend(history.get_recently_failed_tests(config))
+            except sqlite3.Error as e:
+                print('Failed to query test history: {0}'.format(e),
+                        file=self._executor.console)
+        if affected:
+            priority.extend([x for x in affected if x not in priority])
+        return priority
+
+    def _select_tests_for_budget(self, args, tests, ordered, cost_data_file, jobs):
+        """Returns the tests that fit into the time budget from ``test-budget``.
+
+        If the tests cannot be listed, ``tests`` is returned unchanged and
+        the budget is ignored.
+        """
+        budget = self.opts.test_budget
+        with self._timeline.span('select_tests_for_budget'):
+            all_tests = tests
+            if tests is None:
+                tests = self._list_ctest_tests(args)
+                if tests is None:
+                    print('Failed to list tests, ignoring the test budget',
+                            file=self._executor.console)
+                    return all_tests
+            try:
+                costs = cmake.read_ctest_cost_data(self._executor.read_file(cost_data_file))
+            except IOError:
+                costs = dict()
+            selected = cmake.select_ctest_tests_for_budget(tests, ordered, costs,
+                    budget * 60, jobs)
+        print('Running {0} of {1} tests within the test budget of {2} min'.format(
+            len(selected), len(tests), budget), file=self._executor.console)
+        self._status_reporter.statistics['tests_skipped_for_budget'] = len(tests) - len(selected)
+        return selected
+
+    def _run_ctest_attempt(self, span_name, cmd, jobs, parallel):
+        """Runs CTest once.
+
+        Returns:
+            CommandError or None: The error if CTest failed.
+        """
+        try:
+            with self._timeline.span(span_name):
+                with self._job_slots.acquire(jobs) as slots:
+                    if parallel:
+                        cmd = cmd + ['-j', str(slots.count)]
+                    self._cmd_runner.check_call(cmd)
+        except CommandError as e:
+            return e
+        return None
+
+    def _save_ctest_attempt(self, memcheck, attempt):
+        """Saves the CTest XML from a run, since a rerun overwrites it."""
+        path = 'Testing/Temporary/CTestAttempt{0}.xml'.format(attempt)
+        self._executor.copy_file(cmake.get_ctest_xml_path(self._executor, memcheck), path)
+        return path
+
+    def _get_test_cost_data_file(self, memcheck):
+        """Returns path to the cached CTest cost data for the configuration.
+
+        The data is kept per target branch and build options, since test
+        timings differ between branches and configurations.
+        """
+        branch = self._gerrit.get_triggering_branch() or 'unknown'
+        key = ['branch=' + branch, 'memcheck={0}'.format(memcheck)]
+        for name, value in sorted(self.opts._opts.iteritems()):
+            # All shards of the configuration share the data, and stopping
+            # early does not change the timings.
+            if value is not None and name not in ('test-shard', 'test-fail-fast'):
+                key.append('opt:{0}={1}'.format(name, value))
+        name = 'ctest-' + hashlib.sha1('\n'.join(key)).hexdigest()[:16]
+        cache_dir = self._caches.get_cache_dir(CacheKind.TEST_COST, name)
+        return os.path.join(cache_dir, 'CTestCostData.txt')
+
+    def _restore_test_cost_data(self, path):
+        """Copies cached CTest cost data into the build tree (if it exists)."""
+        self._executor.ensure_dir_exists(os.path.dirname(_CTEST_COST_DATA))
+        with self._executor.lock_file(path + '.lock', shared=True):
+            self._executor.copy_file(path, _CTEST_COST_DATA)
+
+    def _save_test_cost_data(self, path):
+        """Copies CTest cost data from the build tree into the cache."""
+        with self._executor.lock_file(path + '.lock'):
+            self._executor.copy_file(_CTEST_COST_DATA, path)
 
     def compute_md5(self, path):
         """Computes MD5 hash of a file.
@@ -280,32 +895,33 @@ class BuildContext(object):
             root_dir (str): Root directory from which the archive should be
                 created.
         """
-        if prefix:
-            prefix += '/'
-        if use_git:
-            if root_dir:
-                raise ConfigurationError("archiving with root dir with git not implemented")
-            cmd = ['git', 'archive', '-o', path + '.tar.gz']
-            cmd.append('--prefix=' + prefix)
-            cmd.extend(['-9', 'HEAD'])
-            self.run_cmd(cmd)
-        else:
-            # TODO: Check that root_dir is a subdirectory of the workspace
-            # (this all does not work if it is the workspace itself).
-            if not os.path.isabs(root_dir):
-                root_dir = os.path.join(self._cwd.cwd, root_dir)
-            org_dir = root_dir
-            root_dir, base_dir = os.path.split(root_dir)
-            # TODO: Instead of renaming the directory twice, we could use
-            # tarfile directly to create the archive.
-            if prefix:
-                base_dir = prefix
-                shutil.move(org_dir, os.path.join(root_dir, prefix))
-            if not base_dir:
-                base_dir = '.'
-            shutil.make_archive(path, 'gztar', root_dir, base_dir)
+        with self._timeline.span('make_archive'):
             if prefix:
-                shutil.move(os.path.join(root_dir, prefix), org_dir)
+                prefix += '/'
+            if use_git:
+                if root_dir:
+                    raise ConfigurationError("archiving with root dir with git not implemented")
+                cmd = ['git', 'archive', '-o', path + '.tar.gz']
+                cmd.append('--prefix=' + prefix)
+                cmd.extend(['-9', 'HEAD'])
+                self.run_cmd(cmd)
+            else:
+                # TODO: Check that root_dir is a subdirectory of the workspace
+                # (this all does not work if it is the workspace itself).
+                if not os.path.isabs(root_dir):
+                    root_dir = os.path.join(self._cwd.cwd, root_dir)
+                org_dir = root_dir
+                root_dir, base_dir = os.path.split(root_dir)
+                # TODO: Instead of renaming the directory twice, we could use
+                # tarfile directly to create the archive.
+                if prefix:
+                    base_dir = prefix
+                    shutil.move(org_dir, os.path.join(root_dir, prefix))
+                if not base_dir:
+                    base_dir = '.'
+                shutil.make_archive(path, 'gztar', root_dir, base_dir)
+                if prefix:
+                    shutil.move(os.path.join(root_dir, prefix), org_dir)
 
     def publish_logs(self, logs, category=None):
         """Copies provided log(s) to Jenkins.
@@ -403,7 +1019,10 @@ class BuildContext(object):
         """Processes results from coverage runs.
 
         Uses gcovr to process all coverage files found in the workspace
-        (from running a build compiled with --coverage).
+        (from running a build compiled with --coverage).  gcov is run in
+        parallel, using as many processes as the build would, and only for
+        objects whose coverage data or sources have changed since the results
+        were cached in an earlier build.
 
         Args:
             exclude (List[str]): Exclusions to pass to gcovr -e (regexs).
@@ -414,11 +1033,30 @@ class BuildContext(object):
         self.chdir(self.workspace.build_dir)
         gcovr = os.path.join(releng_dir, 'scripts', 'gcovr-3.2')
         cmd = [gcovr, '--xml', '-r', gromacs_dir, '-o', output_path, '.',
-                '--gcov-executable=' + self.env.gcov_command]
+                '--gcov-executable=' + self.env.gcov_command,
+                '--cache-dir', self._get_coverage_cache_dir()]
         if exclude:
             for x in exclude:
                 cmd.extend(['-e', x])
-        self.run_cmd(cmd, failure_message='gcovr failed')
+        with self._timeline.span('process_coverage_results'):
+            with self._job_slots.acquire(self.env._build_jobs) as slots:
+                self.run_cmd(cmd + ['-j', str(slots.count)],
+                        failure_message='gcovr failed')
+
+    def _get_coverage_cache_dir(self):
+        """Returns the node-local cache directory for gcovr results.
+
+        gcovr removes the entries that a run does not use, so the cache is
+        kept per target branch and build options (like the CTest cost data),
+        so that different configurations do not evict each other's entries.
+        """
+        branch = self._gerrit.get_triggering_branch() or 'unknown'
+        key = ['branch=' + branch]
+        for name, value in sorted(self.opts._opts.iteritems()):
+            if value is not None:
+                key.append('opt:{0}={1}'.format(name, value))
+        name = 'gcovr-' + hashlib.sha1('\n'.join(key)).hexdigest()[:16]
+        return self._caches.get_cache_dir(CacheKind.COVERAGE, name)
 
     def set_version_info(self, version, regtest_md5sum):
         """Provides source version information from a build script.
@@ -435,15 +1073,69 @@ class BuildContext(object):
         assert self._version
         return self._version, self._regtest_md5sum
 
+    def _write_warning_summary(self):
+        """Writes compiler warnings from build_target() calls into logs/."""
+        path = self.workspace.get_path_for_logfile('compiler-warnings.json')
+        self._warnings.write_summary(self._executor, path)
+
+    def _report_ccache_stats(self, before):
+        """Reports compiler cache hits and misses during the build.
+
+        The counters are shared by all builds on the node, so concurrent
+        builds also contribute to the reported numbers.
+
+        Args:
+            before (Dict[str, int]): Counters from before the build.
+        """
+        console = self._executor.console
+        after = self.env._get_ccache_stats(console)
+        if after is None:
+            return
+        stats = dict([(key, after[key] - before.get(key, 0)) for key in after])
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = 100.0 * stats['hits'] / lookups if lookups else 0.0
+        print('Compiler cache (ccache) statistics for the build:', file=console)
+        print('  hits: {0}, misses: {1}, uncacheable: {2}, hit rate: {3:.1f} %'.format(
+            stats['hits'], stats['misses'], stats['uncacheable'], hit_rate), file=console)
+        stats['before'] = before
+        stats['after'] = after
+        self._status_reporter.statistics['ccache'] = stats
+
+    def _report_remote_cache_stats(self):
+        """Reports data transferred from/to the remote cache."""
+        remote = self._remote_cache
+        print('Remote cache: downloaded {0}, uploaded {1}{2}'.format(
+            utils.format_size(remote.bytes_downloaded),
+            utils.format_size(remote.bytes_uploaded),
+            '' if remote.available else ' (unavailable)'), file=self._executor.console)
+        self._status_reporter.statistics['remote_cache'] = {
+                'downloaded': remote.bytes_downloaded,
+                'uploaded': remote.bytes_uploaded,
+                'available': remote.available
+            }
+
     @staticmethod
     def _run_build(factory, build, job_type, opts):
         """Runs the actual build.
 
-        This method is the top-level driver for the build."""
+        This method is the top-level driver for the build.  The phases of the
+        build are recorded into logs/timeline.json."""
+        workspace = factory.workspace
+        timeline = factory.timeline
+        try:
+            with timeline.span('run_build', args={'script': build}):
+                return BuildContext._run_build_steps(factory, build, job_type, opts)
+        finally:
+            timeline.write(workspace.get_path_for_logfile('timeline.json'))
+
+    @staticmethod
+    def _run_build_steps(factory, build, job_type, opts):
         projects = factory.projects
         workspace = factory.workspace
+        timeline = factory.timeline
         workspace._clear_workspace_dirs()
-        projects.checkout_project(factory.default_project)
+        with timeline.span('checkout ' + factory.default_project):
+            projects.checkout_project(factory.default_project)
         build_script_path = workspace._resolve_build_input_file(build, '.py')
         script = BuildScript(factory.executor, build_script_path)
         if script.build_opts:
@@ -451,17 +1143,35 @@ class BuildContext(object):
                 opts = []
             opts.extend(script.build_opts)
         context = factory.create_context(job_type, opts, script.extra_options)
+        context.env._print_parallelism(factory.executor.console)
         for project in script.extra_projects:
-            projects.checkout_project(project)
+            with timeline.span('checkout ' + project):
+                projects.checkout_project(project)
         projects.print_project_info()
         projects.check_projects()
         out_of_source = script.build_out_of_source or context.opts.out_of_source
         workspace._init_build_dir(out_of_source)
+        version = None
         if factory.default_project == Project.GROMACS:
             gromacs_dir = workspace.get_project_dir(Project.GROMACS)
             version = cmake.read_cmake_minimum_version(factory.executor, gromacs_dir)
-            context.env._set_cmake_minimum_version(version)
-        script.do_build(context, factory.cwd)
+        # Also checks CMake versions required by the build options.
+        context.env._set_cmake_minimum_version(version)
+        ccache_stats = context.env._get_ccache_stats(factory.executor.console)
+        try:
+            with timeline.span('do_build'):
+                script.do_build(context, factory.cwd)
+            # For builds that do not run CTest; no-op if already saved.
+            context._save_artifact_cache()
+        finally:
+            with timeline.span('finish_build'):
+                context._write_warning_summary()
+                if ccache_stats is not None:
+                    context._report_ccache_stats(ccache_stats)
+                if factory.remote_cache:
+                    context._report_remote_cache_stats()
+                workspace._prune_worktrees()
+                factory.caches._finish_build()
         return context
 
     @staticmethod
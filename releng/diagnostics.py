@@ -0,0 +1,146 @@
+"""
+Extraction of compiler warnings from build output
+
+The build output is parsed line by line while the build runs, and the
+warnings are collected into a compact summary that Jenkins can read instead of
+rescanning the full console log.  Warnings from headers are reported by the
+compiler for every source file that includes the header, so warnings are
+deduplicated based on their location and message.
+
+Recognized formats are those of gcc, clang, and icc (``file:line[:col]:
+warning: message``), and of MSVC, icc on Windows, and nvcc
+(``file(line[,col]): warning CODE: message``).
+"""
+
+import json
+import os.path
+import re
+
+_GNU_RE = re.compile(
+        r'^(?P<file>[^\s:][^:]*|[A-Za-z]:[^:]*):(?P<line>\d+):(?:(?P<column>\d+):)?\s*'
+        r'warning\s*(?:#(?P<icc_code>\d+))?:\s*(?P<message>.*?)\s*(?:\[(?P<flag>-W[^\]]+)\])?\s*$')
+_PAREN_RE = re.compile(
+        r'^\s*(?P<file>[^\s(][^(]*)\((?P<line>\d+)(?:,(?P<column>\d+))?\)\s*:\s*'
+        r'warning\s*(?P<code>#?[A-Z]*\d+)?\s*:\s*(?P<message>.*?)\s*$')
+
+class CompilerWarning(object):
+    """A single (deduplicated) compiler warning.
+
+    Attributes:
+        path (str): Path to the file where the warning is.
+        line (int): Line number of the warning.
+        column (int or None): Column of the warning, if known.
+        message (str): Warning message.
+        category (str or None): Warning flag or code (e.g., ``-Wunused``
+            or ``C4996``), if known.
+        count (int): Number of times the warning was emitted.
+    """
+
+    def __init__(self, path, line, column, message, category):
+        self.path = path
+        self.line = line
+        self.column = column
+        self.message = message
+        self.category = category
+        self.count = 1
+
+    def to_dict(self):
+        result = {
+                'fileName': self.path,
+                'lineStart': self.line,
+                'message': self.message,
+                'severity': 'NORMAL',
+                'count': self.count
+            }
+        if self.column is not None:
+            result['columnStart'] = self.column
+        if self.category:
+            result['category'] = self.category
+        return result
+
+def parse_warning(line):
+    """Parses a compiler warning from a line of build output.
+
+    Returns:
+        Tuple[str, int, int or None, str, str or None] or None: Path, line,
+            column, message, and category of the warning, or None if the line
+            is not a warning.
+    """
+    if 'warning' not in line:
+        return None
+    match = _GNU_RE.match(line)
+    if match:
+        category = match.group('flag')
+        if match.group('icc_code'):
+            category = '#' + match.group('icc_code')
+    else:
+        match = _PAREN_RE.match(line)
+        if not match:
+            return None
+        category = match.group('code')
+    column = match.group('column')
+    if column is not None:
+        column = int(column)
+    return (match.group('file').strip(), int(match.group('line')), column,
+            match.group('message'), category)
+
+class WarningCollector(object):
+    """Collects and deduplicates compiler warnings from build output.
+
+    Lines are passed to process_line() as the output is produced.
+    """
+
+    def __init__(self, root, cwd):
+        """Creates a collector.
+
+        Args:
+            root (str): Paths under this directory are reported relative to it.
+            cwd (CurrentDirectoryTracker): Used to resolve relative paths in
+                the output.
+        """
+        self._root = root
+        self._cwd = cwd
+        self._warnings = dict()
+
+    def process_line(self, line):
+        """Processes a single line of build output."""
+        result = parse_warning(line)
+        if result is None:
+            return
+        path, line, column, message, category = result
+        path = self._normalize_path(path)
+        key = (path, line, message)
+        if key in self._warnings:
+            self._warnings[key].count += 1
+        else:
+            self._warnings[key] = CompilerWarning(path, line, column, message, category)
+
+    def _normalize_path(self, path):
+        path = os.path.normpath(self._cwd.to_abs_path(path))
+        root = os.path.normpath(self._root) + os.sep
+        if path.startswith(root):
+            path = path[len(root):]
+        return path
+
+    @property
+    def warnings(self):
+        """List[CompilerWarning]: Collected warnings, sorted by file and line."""
+        return sorted(self._warnings.itervalues(),
+                key=lambda x: (x.path, x.line, x.message))
+
+    def write_summary(self, executor, path):
+        """Writes the collected warnings as JSON.
+
+        The format is the native JSON format of the Jenkins Warnings Next
+        Generation plugin, with the number of times each warning was emitted
+        added, and the number of warnings per file.
+        """
+        warnings = self.warnings
+        files = dict()
+        for warning in warnings:
+            files[warning.path] = files.get(warning.path, 0) + 1
+        contents = json.dumps({
+                'issues': [x.to_dict() for x in warnings],
+                'files': files
+            }, indent=1, sort_keys=True)
+        executor.write_file(path, contents)
@@ -4,11 +4,12 @@ Build and Jenkins environment handling
 This file contains all the code that hardcodes details about the Jenkins build
 slave environment, such as paths to various executables.
 """
+from __future__ import print_function
 
 import os
 
-from common import ConfigurationError
-from common import Compiler,System
+from common import CommandError, ConfigurationError
+from common import CacheKind,Compiler,Generator,System
 import cmake
 import slaves
 import re
@@ -20,12 +21,79 @@ import re
 # different approaches may be used (some might set an environment variable,
 # others use an absolute path, or set a CMake option).
 
+_CMAKE_GENERATORS = {
+        Generator.MAKE: 'Unix Makefiles',
+        Generator.NINJA: 'Ninja',
+        Generator.JOM: 'NMake Makefiles JOM'
+    }
+
 def _to_version_tuple(version_string):
     return [int(x) for x in version_string.split('.')]
 
 def _is_older_version(older, newer):
     return _to_version_tuple(older) < _to_version_tuple(newer)
 
+# Counters from ``ccache --print-stats`` output (ccache 3.7 and later; some
+# counters were renamed in ccache 4.0) that are reported as build statistics.
+_CCACHE_PRINT_STATS = {
+        'cache_hit_direct': 'hits',
+        'direct_cache_hit': 'hits',
+        'cache_hit_preprocessed': 'hits',
+        'preprocessed_cache_hit': 'hits',
+        'cache_miss': 'misses',
+        'called_for_link': 'uncacheable',
+        'called_for_preprocessing': 'uncacheable',
+        'compile_failed': 'uncacheable',
+        'preprocessor_error': 'uncacheable',
+        'unsupported_compiler_option': 'uncacheable',
+        'no_input_file': 'uncacheable'
+    }
+
+# Counters from ``ccache -s`` output of older versions.
+_CCACHE_STATS = {
+        'cache hit (direct)': 'hits',
+        'cache hit (preprocessed)': 'hits',
+        'cache miss': 'misses',
+        'called for link': 'uncacheable',
+        'called for preprocessing': 'uncacheable',
+        'compile failed': 'uncacheable',
+        'preprocessor error': 'uncacheable',
+        'unsupported compiler option': 'uncacheable',
+        'no input file': 'uncacheable'
+    }
+
+def _parse_ccache_stats(output):
+    """Parses hit/miss counters from ``ccache --print-stats`` or ``-s`` output.
+
+    The tab-separated output of ``--print-stats`` is parsed if present, and
+    otherwise the ``-s`` output of ccache 3.x.
+
+    Returns:
+        Dict[str, int] or None: Number of hits, misses, and uncacheable
+            calls, or None if the output does not have any known counters.
+    """
+    stats = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+    if not output:
+        return None
+    found = False
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 2 and fields[0] in _CCACHE_PRINT_STATS:
+            name, value = _CCACHE_PRINT_STATS[fields[0]], fields[1]
+        else:
+            match = re.match(r'^(\S.*?)\s{2,}(\d+)\s*$', line)
+            if not match or match.group(1) not in _CCACHE_STATS:
+                continue
+            name, value = _CCACHE_STATS[match.group(1)], match.group(2)
+        try:
+            stats[name] += int(value)
+        except ValueError:
+            continue
+        found = True
+    if not found:
+        return None
+    return stats
+
 class BuildEnvironment(object):
     """Provides access to the build environment.
 
@@ -50,6 +118,7 @@ class BuildEnvironment(object):
        cmake_command (str): Name of the CMake executable.
        ctest_command (str): Name of the CTest executable.
        cmake_version (str): Version of the CMake executable.
+       generator (Generator or None): Build tool being used.
        cmake_generator (str or None): CMake generator being used.
        cuda_root (str or None): Root of the CUDA toolkit being used
            (for passing to CUDA_TOOLKIT_ROOT_DIR CMake option).
@@ -57,8 +126,12 @@ class BuildEnvironment(object):
            with CUDA (for passing to CUDA_HOST_COMPILER CMake option).
        amdappsdk_root (str or None): Root of the AMD SDK being used
            (for using as AMDAPPSDKROOT environment variable).
+       ccache_command (str or None): Full path to ccache, if the build uses
+           it as a compiler launcher.
+       linker (Linker or None): Linker used instead of the default one.
        extra_cmake_options (Dict[str, str]): Additional options to pass to
            CMake.
+       test_jobs (int): Number of tests to run in parallel.
     """
 
     def __init__(self, factory):
@@ -71,20 +144,31 @@ class BuildEnvironment(object):
         self.cmake_command = 'cmake'
         self.ctest_command = 'ctest'
         self.cmake_version = None
+        self.generator = None
         self.cmake_generator = None
         self.cuda_root = None
         self.cuda_host_compiler = None
         self.amdappsdk_root = None
+        self.ccache_command = None
+        self.linker = None
         self.clang_analyzer_output_dir = None
         self.extra_cmake_options = dict()
 
         self._build_prefix_cmd = None
+        self._cmake_requirement = None
         self._cmd_runner = factory.cmd_runner
         self._workspace = factory.workspace
+        self._caches = factory.caches
+        self._resources = factory.resources
+        self._uses_mpi_wrappers = False
+        self._split_dwarf = False
+        self._compress_debug = False
+        self._debug_info_options_applied = False
         self._node_name = factory.jenkins.node_name
         self._cmake_base_dir = None
 
-        self._build_jobs = slaves.get_default_build_parallelism(self._node_name)
+        self._build_jobs = self._resources.compile_jobs
+        self.test_jobs = self._resources.test_jobs
 
         environment_command = slaves.get_environment_subshell(self._node_name)
         if environment_command:
@@ -114,30 +198,137 @@ class BuildEnvironment(object):
         """Returns path to the uncrustify executable."""
         return os.path.expanduser('~/bin/uncrustify')
 
-    def _get_build_cmd(self, target=None, parallel=True, keep_going=False):
+    def _supports_multiple_targets(self):
+        """Whether _get_build_cmd() can build several targets at once."""
+        if self.cmake_version and not _is_older_version(self.cmake_version, '3.15'):
+            return True
+        return self.generator == Generator.NINJA
+
+    def _supports_ctest_json_listing(self):
+        """Whether CTest supports --show-only=json-v1 (CTest 3.14 and later)."""
+        return bool(self.cmake_version) and not _is_older_version(self.cmake_version, '3.14')
+
+    def _supports_ctest_stop_on_failure(self):
+        """Whether CTest supports --stop-on-failure (CTest 3.18 and later)."""
+        return bool(self.cmake_version) and not _is_older_version(self.cmake_version, '3.18')
+
+    def _get_build_cmd(self, target=None, parallel=True, keep_going=False, jobs=None):
+        """Returns the command to build given target(s).
+
+        Args:
+            target (str or List[str] or None): Target(s) to build.  Several
+                targets are only supported if _supports_multiple_targets()
+                returns ``True``.
+        """
+        targets = []
+        if isinstance(target, list):
+            assert len(target) < 2 or self._supports_multiple_targets()
+            targets = target
+        elif target is not None:
+            targets = [target]
         cmd = []
         if self._build_prefix_cmd is not None:
             cmd.extend(self._build_prefix_cmd)
         cmd.extend([self.cmake_command, '--build', '.'])
-        if target is not None:
-            cmd.extend(['--target', target])
-        jobs = self._build_jobs if parallel else 1
+        cmake_targets = len(targets) < 2 or not _is_older_version(self.cmake_version or '0', '3.15')
+        if targets and cmake_targets:
+            cmd.append('--target')
+            cmd.extend(targets)
+        if jobs is None:
+            jobs = self._build_jobs
+        if not parallel:
+            jobs = 1
         cmd.extend(['--', '-j{0}'.format(jobs)])
         if keep_going:
-            cmd.append('-k')
+            if self.generator == Generator.NINJA:
+                # Ninja stops after N failures with -k N; 0 means never.
+                cmd.extend(['-k', '0'])
+            else:
+                cmd.append('-k')
+        if targets and not cmake_targets:
+            # Older CMake only accepts a single --target, but Ninja accepts
+            # several targets on its command line.
+            cmd.extend(targets)
         return cmd
 
+    def _get_link_jobs(self):
+        """Returns the number of link steps allowed to run in parallel.
+
+        Linking the large binaries can take much more memory than compiling,
+        so fewer link steps than compilation jobs are run at a time.
+        """
+        if self._resources.link_jobs is None:
+            return max(1, self._build_jobs // 4)
+        return min(self._build_jobs, self._resources.link_jobs)
+
+    def _get_toolchain_fingerprint(self):
+        """Returns strings that identify the toolchain used for the build.
+
+        The result changes if the compilers (or the compilers underlying MPI
+        wrappers), their versions, compiler flags from the environment, the
+        CMake version, or the generator change.
+
+        Returns:
+            List[str] or None: Strings identifying the toolchain, or None if
+                the toolchain could not be identified.
+        """
+        if self.system == System.WINDOWS:
+            return None
+        result = ['generator: {0}'.format(self.cmake_generator)]
+        commands = [self.cmake_command, self.c_compiler, self.cxx_compiler]
+        if self._uses_mpi_wrappers:
+            commands.extend([self._cmd_runner.get_env_var('OMPI_CC'),
+                self._cmd_runner.get_env_var('OMPI_CXX')])
+        for command in commands:
+            if not command:
+                continue
+            path = self._cmd_runner.find_executable(command)
+            if not path:
+                return None
+            try:
+                version = self._cmd_runner.check_output([command, '--version'])
+            except CommandError:
+                return None
+            result.append('{0}: {1}\n{2}'.format(command, path, version))
+        for variable in ('CFLAGS', 'CXXFLAGS', 'LDFLAGS', 'CPPFLAGS'):
+            value = self._cmd_runner.get_env_var(variable)
+            result.append('{0}={1}'.format(variable, value))
+        return result
+
+    def _print_parallelism(self, console):
+        """Prints the detected resources and the parallelism used."""
+        self._resources.print_summary(console)
+        print('Parallel jobs: compile: {0}, link: {1}, test: {2}'.format(
+            self._build_jobs, self._get_link_jobs(), self.test_jobs), file=console)
+
     def _set_cmake_minimum_version(self, version):
+        required = self._cmake_requirement
+        if required and (not version or _is_older_version(version, required[0])):
+            version = required[0]
         if self.cmake_version or not version:
             return
         current_version = cmake.get_cmake_version(self._cmd_runner, self.cmake_command)
         self.cmake_version = current_version
-        if not _is_older_version(current_version, version):
+        if _is_older_version(current_version, version):
+            available_versions = self._get_available_cmake_versions()
+            for test_version in available_versions:
+                if not _is_older_version(test_version, version):
+                    self._init_cmake(test_version)
+        if required:
+            self._require_cmake_version(*required)
+
+    def _require_cmake_version(self, version, feature):
+        """Requires a minimum CMake version for a build option.
+
+        If the CMake version is not yet known, the check is done (and a new
+        enough CMake selected, if available) in _set_cmake_minimum_version().
+        """
+        if not self.cmake_version:
+            self._cmake_requirement = (version, feature)
             return
-        available_versions = self._get_available_cmake_versions()
-        for test_version in available_versions:
-            if not _is_older_version(test_version, version):
-                self._init_cmake(test_version)
+        if _is_older_version(self.cmake_version, version):
+            raise ConfigurationError('{0} requires CMake {1} or newer, but CMake {2} is used'.format(
+                feature, version, self.cmake_version))
 
     def _get_available_cmake_versions(self):
         versions = []
@@ -150,6 +341,34 @@ class BuildEnvironment(object):
         versions.sort(key=_to_version_tuple)
         return versions
 
+    def _get_ccache_stats(self, console):
+        """Returns current hit/miss counters of the compiler cache.
+
+        Uses ``ccache --print-stats``, falling back to ``ccache -s`` for
+        versions older than 3.7.  Failures only print a note to ``console``,
+        so that they do not affect the build result.
+
+        Returns:
+            Dict[str, int] or None: Counters (see _parse_ccache_stats()), or
+                None if the build does not use ccache or the counters could
+                not be read.
+        """
+        if not self.ccache_command:
+            return None
+        try:
+            try:
+                output = self._cmd_runner.check_output([self.ccache_command, '--print-stats'])
+            except CommandError:
+                output = self._cmd_runner.check_output([self.ccache_command, '-s'])
+        except CommandError as e:
+            print('Failed to read ccache statistics: {0}'.format(e), file=console)
+            return None
+        stats = _parse_ccache_stats(output)
+        if stats is None:
+            print('Unknown ccache statistics format, not reporting statistics',
+                    file=console)
+        return stats
+
     def set_env_var(self, variable, value):
         """Sets environment variable to be used for further commands.
 
@@ -181,7 +400,7 @@ class BuildEnvironment(object):
 
     def _init_system(self):
         if self.system == System.WINDOWS:
-            self.cmake_generator = 'NMake Makefiles JOM'
+            self._set_generator(Generator.JOM)
             self._cmake_base_dir = 'c:\\utils'
         else:
             self.prepend_path_env('~/bin')
@@ -190,6 +409,36 @@ class BuildEnvironment(object):
             self._init_core_dump()
             self._cmake_base_dir = ('/opt/cmake')
 
+    def _set_generator(self, generator):
+        self.generator = generator
+        self.cmake_generator = _CMAKE_GENERATORS[generator]
+        if generator == Generator.NINJA:
+            # Job pools are only supported by the Ninja generator.
+            self.extra_cmake_options['CMAKE_JOB_POOLS'] = \
+                    'link_pool={0}'.format(self._get_link_jobs())
+            self.extra_cmake_options['CMAKE_JOB_POOL_LINK'] = 'link_pool'
+        else:
+            self.extra_cmake_options.pop('CMAKE_JOB_POOLS', None)
+            self.extra_cmake_options.pop('CMAKE_JOB_POOL_LINK', None)
+
+    def _find_ninja(self):
+        for name in ('ninja', 'ninja-build'):
+            path = self._cmd_runner.find_executable(name)
+            if path:
+                return path
+        return None
+
+    def _init_default_generator(self):
+        """Selects Ninja as the generator if it is available.
+
+        Called after all build options have been processed, if the generator
+        was not explicitly selected with an option.
+        """
+        if self.system in (None, System.WINDOWS):
+            return
+        if self._find_ninja():
+            self._set_generator(Generator.NINJA)
+
     def _init_core_dump(self):
         import resource
         try:
@@ -204,6 +453,16 @@ class BuildEnvironment(object):
     def _set_build_jobs(self, jobs):
         self._build_jobs = jobs
 
+    def _init_generator(self, generator):
+        if self.system == System.WINDOWS:
+            if generator == Generator.MAKE:
+                raise ConfigurationError('generator=make is not supported on Windows')
+        elif generator == Generator.JOM:
+            raise ConfigurationError('generator=jom is only supported on Windows')
+        if generator == Generator.NINJA and not self._find_ninja():
+            raise ConfigurationError('ninja not found on the build host')
+        self._set_generator(generator)
+
     def _init_cmake(self, version):
         cmake_bin_dir = os.path.join(self._cmake_base_dir, 'cmake-' + version, 'bin')
         if not os.path.exists(cmake_bin_dir):
@@ -398,3 +657,95 @@ class BuildEnvironment(object):
         self.set_env_var('OMPI_CXX', self.cxx_compiler)
         self.c_compiler = 'mpicc'
         self.cxx_compiler = 'mpic++'
+        self._uses_mpi_wrappers = True
+
+    def _init_ccache(self):
+        """Initializes the build to use ccache as a compiler launcher.
+
+        The cache is shared between all builds on the node, and is managed as
+        a node-local cache.  This needs to be called after the compiler has
+        been selected.
+        """
+        if self.system == System.WINDOWS:
+            raise ConfigurationError('ccache is not supported on Windows')
+        ccache_path = self._cmd_runner.find_executable('ccache')
+        if not ccache_path:
+            raise ConfigurationError('ccache not found on the build host')
+        self.ccache_command = ccache_path
+        self.set_env_var('CCACHE_DIR',
+                self._caches.get_cache_dir(CacheKind.COMPILER_CACHE, 'ccache'))
+        max_size = max(1, self._caches.budget // (4 * 1024**3))
+        self.set_env_var('CCACHE_MAXSIZE', '{0}G'.format(max_size))
+        self.set_env_var('CCACHE_COMPRESS', '1')
+        # Make hits possible across workspaces that build the same sources
+        # (different jobs and executors have different workspace paths).
+        self.set_env_var('CCACHE_BASEDIR', self._workspace.root)
+        self.set_env_var('CCACHE_NOHASHDIR', '1')
+        # CMAKE_<LANG>_COMPILER_LAUNCHER is only supported by CMake 3.4 and
+        # later; older versions would silently build without ccache.
+        self._require_cmake_version('3.4', 'ccache')
+        if self._uses_mpi_wrappers:
+            # The MPI wrappers do not change when OMPI_CC/OMPI_CXX select a
+            # different compiler, so identify the compiler by the version of
+            # the underlying compiler instead of the wrapper's mtime.
+            self.set_env_var('CCACHE_COMPILERCHECK', '%compiler% --version')
+        # The CUDA host compiler is not touched: nvcc needs a real compiler
+        # there, and FindCUDA does not use the launchers.
+        self.extra_cmake_options['CMAKE_C_COMPILER_LAUNCHER'] = ccache_path
+        # With the static analyzer, the C++ compiler runs the analysis, and
+        # a cache hit would skip it.  C sources are not analyzed.
+        if not self.clang_analyzer_output_dir:
+            self.extra_cmake_options['CMAKE_CXX_COMPILER_LAUNCHER'] = ccache_path
+
+    def _check_debug_info_option_supported(self, name):
+        if self.system == System.WINDOWS or self.compiler in (Compiler.MSVC, Compiler.INTEL):
+            raise ConfigurationError(name + ' is only supported with gcc and clang on Unix')
+
+    def _init_linker(self, linker):
+        """Initializes the build to use a faster linker (gold or lld).
+
+        This needs to be called after the compiler has been selected.
+        """
+        self._check_debug_info_option_supported('linker=' + linker)
+        if not self._cmd_runner.find_executable('ld.' + linker):
+            raise ConfigurationError('ld.{0} not found on the build host'.format(linker))
+        self.linker = linker
+        # LDFLAGS initializes the linker flags for executables, shared
+        # libraries, and modules in CMake.
+        self.append_to_env_var('LDFLAGS', '-fuse-ld=' + linker)
+
+    def _init_split_dwarf(self):
+        self._check_debug_info_option_supported('split-dwarf')
+        self._split_dwarf = True
+
+    def _init_compress_debug(self):
+        self._check_debug_info_option_supported('compress-debug')
+        self._compress_debug = True
+
+    def _apply_debug_info_options(self, build_type):
+        """Adds compiler and linker flags for reducing debug info size.
+
+        The ``split-dwarf`` and ``compress-debug`` options only have an
+        effect for build types that produce full debug info; this is called
+        from run_cmake() with the build type passed to CMake.  The flags are
+        only added once, even if a build script runs CMake several times.
+
+        Args:
+            build_type (str or None): Value of CMAKE_BUILD_TYPE.
+        """
+        if self._debug_info_options_applied:
+            return
+        if not build_type or build_type.lower() not in ('debug', 'asan', 'tsan'):
+            return
+        self._debug_info_options_applied = True
+        if self._split_dwarf:
+            # Debug info goes into .dwo files next to the objects, so the
+            # linker does not need to process (or write) it.
+            self.append_to_env_var('CFLAGS', '-gsplit-dwarf')
+            self.append_to_env_var('CXXFLAGS', '-gsplit-dwarf')
+            if self.linker is not None:
+                self.append_to_env_var('LDFLAGS', '-Wl,--gdb-index')
+        if self._compress_debug:
+            self.append_to_env_var('CFLAGS', '-gz')
+            self.append_to_env_var('CXXFLAGS', '-gz')
+            self.append_to_env_var('LDFLAGS', '-gz')
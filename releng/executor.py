@@ -14,6 +14,7 @@ expanding unit tests.
 from __future__ import print_function
 
 from distutils.spawn import find_executable
+import multiprocessing
 import os
 import pipes
 import re
@@ -34,6 +35,32 @@ def _read_file(path, binary):
             for line in fp:
                 yield line
 
+def _get_disk_usage(path):
+    if os.path.isfile(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def _get_cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+def _get_load_average():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
 class Executor(object):
     """Real executor for Jenkins builds that does all operations for real."""
 
@@ -56,6 +83,33 @@ class Executor(object):
     def check_output(self, cmd, **kwargs):
         return subprocess.check_output(cmd, **kwargs)
 
+    def check_call_with_output_handler(self, cmd, handler, **kwargs):
+        """Runs a command like check_call(), passing each output line to handler.
+
+        The output (stdout and stderr combined) is also written to the
+        console as it is produced.  If the handler raises an exception, the
+        command is killed before the exception is propagated.
+        """
+        console = self.console
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.STDOUT
+        process = subprocess.Popen(cmd, **kwargs)
+        try:
+            for line in iter(process.stdout.readline, b''):
+                console.write(line)
+                console.flush()
+                handler(line)
+        except:
+            # Do not leave the command running (and possibly blocked on a
+            # full pipe) if the handler fails.
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
     def remove_path(self, path):
         """Deletes a file or a directory at a given path if it exists."""
         path = self._cwd.to_abs_path(path)
@@ -80,23 +134,84 @@ class Executor(object):
         if os.path.isfile(source):
             shutil.copy(source, dest)
 
+    def rename_file(self, source, dest):
+        """Renames a file, atomically replacing the destination."""
+        source = self._cwd.to_abs_path(source)
+        dest = self._cwd.to_abs_path(dest)
+        os.rename(source, dest)
+
+    def copy_tree(self, source, dest):
+        """Copies a directory tree, replacing the destination.
+
+        Symbolic links are copied as links.  Does nothing if the source does
+        not exist.
+        """
+        source = self._cwd.to_abs_path(source)
+        dest = self._cwd.to_abs_path(dest)
+        if os.path.isdir(source):
+            self.remove_path(dest)
+            shutil.copytree(source, dest, symlinks=True)
+
     def read_file(self, path, binary=False):
         """Iterates over lines in a file."""
         path = self._cwd.to_abs_path(path)
         return _read_file(path, binary)
 
     def write_file(self, path, contents):
-        """Writes a file with the given contents."""
+        """Writes a file with the given contents.
+
+        Args:
+            path (str): Path to the file to write.
+            contents (str or Iterable[str]): Contents to write.  If an
+                iterable is given, the chunks are written as they are
+                produced, so the whole contents need not be in memory.
+        """
         path = self._cwd.to_abs_path(path)
         with open(path, 'w') as fp:
-            fp.write(contents)
+            if isinstance(contents, basestring):
+                fp.write(contents)
+            else:
+                for chunk in contents:
+                    fp.write(chunk)
 
     def find_executable_with_path(self, name, environment_path):
         """Returns the full path to the given executable,
-        including resolving symlinks."""
+        including resolving symlinks.
+
+        Returns None if the executable is not found."""
         # If we at some point require Python 3.3, shutil.which() would be
         # more obvious.
-        return os.path.realpath(find_executable(name, environment_path))
+        path = find_executable(name, environment_path)
+        if path is None:
+            return None
+        return os.path.realpath(path)
+
+    def lock_file(self, path, shared=False, blocking=True):
+        """Acquires a cross-process lock using the given lock file.
+
+        Returns:
+            FileLock: The acquired lock, or None if blocking is ``False`` and
+                the lock could not be acquired.
+        """
+        lock = utils.FileLock(self._cwd.to_abs_path(path), shared=shared)
+        if not lock.acquire(blocking=blocking):
+            return None
+        return lock
+
+    def get_disk_usage(self, path):
+        """Returns the total size of files under a path (in bytes)."""
+        path = self._cwd.to_abs_path(path)
+        if not os.path.exists(path):
+            return 0
+        return _get_disk_usage(path)
+
+    def get_cpu_count(self):
+        """Returns the number of CPUs usable by the process, or None."""
+        return _get_cpu_count()
+
+    def get_load_average(self):
+        """Returns the one-minute load average, or None if not available."""
+        return _get_load_average()
 
 class DryRunExecutor(object):
     """Executor replacement for manual testing dry runs."""
@@ -120,6 +235,10 @@ class DryRunExecutor(object):
     def check_output(self, cmd, **kwargs):
         return subprocess.check_output(cmd, **kwargs)
 
+    def check_call_with_output_handler(self, cmd, handler, **kwargs):
+        # The command is not run, so there is no output for the handler.
+        self.check_call(cmd, **kwargs)
+
     def remove_path(self, path):
         print('delete: ' + path)
 
@@ -131,11 +250,19 @@ class DryRunExecutor(object):
         if os.path.isfile(source):
             shutil.copy(source, dest)
 
+    def rename_file(self, source, dest):
+        print('rename {0} -> {1}'.format(source, dest))
+
+    def copy_tree(self, source, dest):
+        print('copy tree {0} -> {1}'.format(source, dest))
+
     def read_file(self, path, binary=False):
         path = self._cwd.to_abs_path(path)
         return _read_file(path, binary)
 
     def write_file(self, path, contents):
+        if not isinstance(contents, basestring):
+            contents = ''.join(contents)
         print('write: ' + path + ' <<<')
         print(contents + '<<<')
 
@@ -143,6 +270,22 @@ class DryRunExecutor(object):
         print('find: ' + name)
         return '/usr/local/bin/' + name
 
+    def lock_file(self, path, shared=False, blocking=True):
+        print('lock: ' + path)
+        return utils.FileLock(path, shared=shared)
+
+    def get_disk_usage(self, path):
+        path = self._cwd.to_abs_path(path)
+        if not os.path.exists(path):
+            return 0
+        return _get_disk_usage(path)
+
+    def get_cpu_count(self):
+        return _get_cpu_count()
+
+    def get_load_average(self):
+        return _get_load_average()
+
 class CurrentDirectoryTracker(object):
     """Helper class for tracking the current directory for command execution."""
 
@@ -171,11 +314,26 @@ class CommandRunner(object):
     def __init__(self, factory):
         self._cwd = factory.cwd
         self._env = dict(factory.env)
+        self._initial_env = dict(factory.env)
         self._shell_call_opts = dict()
         if factory.system and factory.system != System.WINDOWS:
             self._shell_call_opts['executable'] = '/bin/bash'
         self._is_windows = factory.system and factory.system == System.WINDOWS
         self._executor = factory.executor
+        self._timeline = factory.timeline
+
+    def get_env_var(self, variable):
+        return self._env.get(variable, None)
+
+    def get_changed_env_vars(self):
+        """Returns environment variables that have been set or changed.
+
+        Returns:
+            Dict[str, str]: Variables whose values differ from the initial
+                environment of the build.
+        """
+        return dict([(key, value) for key, value in self._env.iteritems()
+            if self._initial_env.get(key) != value])
 
     def set_env_var(self, variable, value):
         if value is not None:
@@ -222,7 +380,8 @@ class CommandRunner(object):
         passed, e.g. cwd or env to make such calls in stateless ways.
         """
         cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
-        returncode = self._executor.call(cmd, **kwargs)
+        with self._timeline_span(cmd, cmd_string):
+            returncode = self._executor.call(cmd, **kwargs)
         self._handle_return_code(returncode)
         return returncode
 
@@ -235,10 +394,18 @@ class CommandRunner(object):
 
         Any arguments accepted by subprocess.check_call() can also be
         passed, e.g. cwd or env to make such calls in stateless ways.
+
+        If ``output_handler`` is passed, it is called with each line of
+        output from the command (the output is still written to the console).
         """
+        output_handler = kwargs.pop('output_handler', None)
         cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
         try:
-            self._executor.check_call(cmd, **kwargs)
+            with self._timeline_span(cmd, cmd_string):
+                if output_handler is None:
+                    self._executor.check_call(cmd, **kwargs)
+                else:
+                    self._executor.check_call_with_output_handler(cmd, output_handler, **kwargs)
         except subprocess.CalledProcessError as e:
             self._handle_return_code(e.returncode)
             raise CommandError(cmd_string)
@@ -256,7 +423,8 @@ class CommandRunner(object):
         """
         cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
         try:
-            return self._executor.check_output(cmd, **kwargs)
+            with self._timeline_span(cmd, cmd_string):
+                return self._executor.check_output(cmd, **kwargs)
         except subprocess.CalledProcessError as e:
             if e.output:
                 print(e.output, file=self._executor.console)
@@ -276,6 +444,14 @@ class CommandRunner(object):
         utils.flush_output()
         return cmd_string, kwargs
 
+    def _timeline_span(self, cmd, cmd_string):
+        """Returns a timeline span for running an external command."""
+        if isinstance(cmd, basestring):
+            name = cmd.split(None, 1)[0] if cmd.strip() else cmd
+        else:
+            name = os.path.basename(cmd[0])
+        return self._timeline.span(name, category='cmd', args={'cmd': cmd_string})
+
     def _cmd_to_string(self, cmd, shell):
         """Converts a shell command from a string/list into properly escaped string."""
         if shell:
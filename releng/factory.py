@@ -1,14 +1,22 @@
 """
 Declares a factory class for wiring together all the other releng classes.
 """
+from __future__ import print_function
 
 import os
 import platform
+import sqlite3
 
-from common import Project, System
+from caches import CacheManager
+from common import CacheKind, Project, System
 from context import BuildContext
 from executor import CommandRunner, CurrentDirectoryTracker, Executor
 from integration import GerritIntegration, JenkinsIntegration, ProjectsManager, StatusReporter
+from jobslots import JobSlotPool
+from remotecache import RemoteCacheClient
+from resources import NodeResources
+from testhistory import TestHistory
+from timeline import Timeline
 from workspace import Workspace
 
 class ContextFactory(object):
@@ -38,12 +46,18 @@ class ContextFactory(object):
         self.default_project = default_project
         self._env = env
         self._cwd = CurrentDirectoryTracker()
+        self._caches = None
         self._executor = None
         self._cmd_runner = None
         self._gerrit = None
         self._jenkins = None
+        self._job_slots = None
         self._projects = None
+        self._remote_cache = None
+        self._resources = None
         self._status_reporter = None
+        self._test_history = None
+        self._timeline = None
         self._workspace = None
 
     @property
@@ -80,6 +94,52 @@ class ContextFactory(object):
             self.init_status_reporter()
         return self._status_reporter
 
+    @property
+    def caches(self):
+        """Returns the CacheManager instance for the build."""
+        if self._caches is None:
+            self.init_caches()
+        return self._caches
+
+    @property
+    def resources(self):
+        """Returns the NodeResources instance for the build."""
+        if self._resources is None:
+            self.init_resources()
+        return self._resources
+
+    @property
+    def job_slots(self):
+        """Returns the JobSlotPool instance for the build."""
+        if self._job_slots is None:
+            self.init_job_slots()
+        return self._job_slots
+
+    @property
+    def timeline(self):
+        """Returns the Timeline instance for the build."""
+        if self._timeline is None:
+            self.init_timeline()
+        return self._timeline
+
+    @property
+    def remote_cache(self):
+        """Returns the RemoteCacheClient instance for the build.
+
+        Returns None if no remote cache is configured."""
+        if self._remote_cache is None:
+            self.init_remote_cache()
+        return self._remote_cache or None
+
+    @property
+    def test_history(self):
+        """Returns the TestHistory instance for the build.
+
+        Returns None if the store cannot be opened."""
+        if self._test_history is None:
+            self.init_test_history()
+        return self._test_history or None
+
     @property
     def gerrit(self):
         """Returns the GerritIntegration instance for the build."""
@@ -133,6 +193,71 @@ class ContextFactory(object):
         assert self._status_reporter is None
         self._status_reporter = StatusReporter(factory=self, **kwargs)
 
+    def init_caches(self):
+        """Initializes CacheManager.
+
+        If not called, the object will be created with default parameters.
+        """
+        assert self._caches is None
+        self._caches = CacheManager(factory=self)
+
+    def init_resources(self):
+        """Initializes NodeResources.
+
+        If not called, the object will be created with default parameters.
+        """
+        assert self._resources is None
+        self._resources = NodeResources(factory=self)
+
+    def init_job_slots(self):
+        """Initializes JobSlotPool.
+
+        If not called, the object will be created with default parameters.
+        """
+        assert self._job_slots is None
+        self._job_slots = JobSlotPool(factory=self)
+
+    def init_timeline(self):
+        """Initializes Timeline.
+
+        If not called, the object will be created with default parameters.
+        """
+        assert self._timeline is None
+        self._timeline = Timeline(factory=self)
+
+    def init_remote_cache(self, instance=None):
+        """Initializes the remote cache client for the build.
+
+        The client is only created if ``RELENG_REMOTE_CACHE`` is set, unless
+        an instance is given.  ``RELENG_REMOTE_CACHE_TOKEN`` provides the
+        shared token for the server, if it requires one.
+        """
+        assert self._remote_cache is None
+        if instance is None:
+            url = self._env.get('RELENG_REMOTE_CACHE', None)
+            if url:
+                token = self._env.get('RELENG_REMOTE_CACHE_TOKEN', None)
+                instance = RemoteCacheClient(url, self.executor.console, token=token)
+            else:
+                instance = False
+        self._remote_cache = instance
+
+    def init_test_history(self, instance=None):
+        """Initializes the test result history store for the build.
+
+        By default, the store is kept in the node-local caches.  If it cannot
+        be opened, a note is printed and test results are not recorded.
+        """
+        assert self._test_history is None
+        if instance is None:
+            cache_dir = self.caches.get_cache_dir(CacheKind.TEST_HISTORY, 'history')
+            try:
+                instance = TestHistory(os.path.join(cache_dir, 'history.db'))
+            except sqlite3.Error as e:
+                print('Test history not available: {0}'.format(e), file=self.executor.console)
+                instance = False
+        self._test_history = instance
+
     def init_gerrit_integration(self, **kwargs):
         """Initializes GerritIntegration with given parameters.
 
@@ -423,13 +423,23 @@ class ParameterTypes(object):
 
 
 class JenkinsIntegration(object):
-    """Access to Jenkins specifics such as build parameters."""
+    """Access to Jenkins specifics such as build parameters.
+
+    Attributes:
+        workspace_root (str): Root directory of the workspace.
+        node_name (str): Name of the node running the build.
+        node_dir (str): Directory on the node for data that persists between
+            builds and is shared between all workspaces on the node.
+    """
 
     def __init__(self, factory):
         self.workspace_root = factory.env['WORKSPACE']
         self.node_name = factory.env.get('NODE_NAME', None)
         if not self.node_name:
             self.node_name = 'unknown'
+        self.node_dir = factory.env.get('RELENG_NODE_DIR', None)
+        if not self.node_dir:
+            self.node_dir = os.path.expanduser('~/releng-node')
         self.params = BuildParameters(factory)
 
     def query_matrix_build(self, url):
@@ -456,6 +466,9 @@ class StatusReporter(object):
 
     Attributes:
         failed (bool): Whether the build has already failed.
+        statistics (Dict[str, object]): Statistics collected during the build
+            (e.g., compiler cache hits), reported in the status file if it is
+            written as JSON.
     """
 
     def __init__(self, factory, tracebacks=True):
@@ -470,6 +483,7 @@ class StatusReporter(object):
         self._aborted = False
         self._unsuccessful_reason = []
         self.return_value = None
+        self.statistics = dict()
         self._tracebacks = tracebacks
 
     def __enter__(self):
@@ -562,6 +576,8 @@ class StatusReporter(object):
                 }
             if self.return_value:
                 output['return_value'] = self.return_value
+            if self.statistics:
+                output['statistics'] = self.statistics
             contents = json.dumps(output, indent=2)
         elif reason:
             contents = reason + '\n'
@@ -0,0 +1,134 @@
+"""
+Node-wide job slots shared by concurrent builds
+
+When a node runs several builds at the same time, each of them would
+otherwise decide its parallelism independently, and together they could
+oversubscribe the CPUs and memory of the node.  This module implements a
+simple semaphore with one lock file per slot under the node directory.  Before
+running a parallel command (such as a build or tests), the build acquires
+slots from the pool, and runs the command with as many jobs as it got slots.
+The total number of slots is the number of CPUs usable on the node, so the
+total number of active jobs stays at the core count.
+
+A command waits for a bounded time to get its fair share of the slots (the
+slots divided by the number of executors on the node), keeping the slots it
+already has; after that, it runs with the slots it got, so that a build is
+never blocked for long by others, at the cost of possibly running a long
+command with fewer jobs than it could use later.
+
+The lock files are locked with flock(), so slots held by a build that gets
+killed are released automatically.  Slots are only ever locked without
+blocking; if all of them are busy, the pool is polled until one becomes free.
+"""
+
+import os.path
+import random
+import time
+
+# Seconds to wait between attempts when all slots are busy.
+_POLL_INTERVAL = 1.0
+# Seconds to wait for the fair share of slots before running with fewer.
+_FAIR_SHARE_WAIT = 30.0
+
+def _get_slot_dir(factory):
+    return os.path.join(factory.jenkins.node_dir, 'jobslots')
+
+def _get_slot_path(slot_dir, slot):
+    return os.path.join(slot_dir, 'slot-{0}.lock'.format(slot))
+
+def get_busy_slot_count(factory, size):
+    """Returns the number of job slots currently held by builds on the node.
+
+    Args:
+        size (int): Total number of slots on the node.
+    """
+    executor = factory.executor
+    slot_dir = _get_slot_dir(factory)
+    executor.ensure_dir_exists(slot_dir)
+    busy = 0
+    for slot in range(size):
+        lock = executor.lock_file(_get_slot_path(slot_dir, slot), blocking=False)
+        if lock is None:
+            busy += 1
+        else:
+            lock.release()
+    return busy
+
+class JobSlots(object):
+    """Job slots acquired from a JobSlotPool.
+
+    Can be used as a context manager; the slots are released on exit.
+
+    Attributes:
+        count (int): Number of slots acquired.
+    """
+
+    def __init__(self, locks):
+        self._locks = locks
+        self.count = len(locks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+    def release(self):
+        """Releases the slots back to the pool."""
+        for lock in self._locks:
+            lock.release()
+        self._locks = []
+
+class JobSlotPool(object):
+    """Pool of job slots shared by all builds on the node.
+
+    Attributes:
+        size (int): Total number of slots on the node.
+    """
+
+    def __init__(self, factory):
+        self._executor = factory.executor
+        self._dir = _get_slot_dir(factory)
+        self.size = factory.resources.node_jobs
+        self._executors = factory.resources.executors
+
+    def acquire(self, count):
+        """Acquires job slots for running a parallel command.
+
+        Acquires as many slots as are free, up to ``count``.  If fewer slots
+        than the fair share of this build (the pool size divided by the
+        number of executors) are free, waits for up to a bounded time for
+        more to become free; if no slots are free, waits until one does.
+
+        Args:
+            count (int): Maximum number of slots to acquire.
+
+        Returns:
+            JobSlots: The acquired slots (at least one).
+        """
+        self._executor.ensure_dir_exists(self._dir)
+        count = max(1, min(count, self.size))
+        fair_share = max(1, min(count, self.size // self._executors))
+        locks = dict()
+        waited = 0.0
+        while True:
+            self._try_acquire(count, locks)
+            if len(locks) >= fair_share or (locks and waited >= _FAIR_SHARE_WAIT):
+                return JobSlots(locks.values())
+            time.sleep(_POLL_INTERVAL)
+            waited += _POLL_INTERVAL
+
+    def _try_acquire(self, count, locks):
+        """Adds free slots to ``locks`` (slot index to lock) up to ``count``."""
+        # Start from a random slot so that concurrent builds do not all
+        # contend for the first slots.
+        first = random.randrange(self.size)
+        slots = [(first + i) % self.size for i in range(self.size)]
+        for slot in slots:
+            if len(locks) >= count:
+                break
+            if slot in locks:
+                continue
+            lock = self._executor.lock_file(_get_slot_path(self._dir, slot), blocking=False)
+            if lock is not None:
+                locks[slot] = lock
@@ -58,9 +58,25 @@ def _read_matrix_configs(executor, path):
         line = line.strip()
         if line:
             opts = shlex.split(line)
-            configs.append(BuildConfig(opts))
+            configs.extend([BuildConfig(x) for x in _expand_test_shards(opts)])
     return configs
 
+def _expand_test_shards(opts):
+    """Expands ``test-shards=N`` into N configurations with ``test-shard=K/N``."""
+    shard_opts = [x for x in opts if x.startswith('test-shards=')]
+    if not shard_opts:
+        return [opts]
+    if len(shard_opts) > 1:
+        raise ConfigurationError('conflicting options found: ' + ' '.join(shard_opts))
+    value = shard_opts[0][len('test-shards='):]
+    if not value.isdigit() or int(value) < 1:
+        raise ConfigurationError('invalid matrix option: ' + shard_opts[0])
+    count = int(value)
+    opts = [x for x in opts if x != shard_opts[0]]
+    if count == 1:
+        return [opts]
+    return [opts + ['test-shard={0}/{1}'.format(i, count)] for i in range(1, count + 1)]
+
 def _check_matrix_configs(configs):
     for config in configs:
         if not slaves.is_matrix_host(config.host):
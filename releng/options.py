@@ -12,7 +12,7 @@ import shlex
 
 from common import to_python_identifier
 from common import ConfigurationError
-from common import BuildType, FftLibrary, Simd
+from common import BuildType, FftLibrary, Generator, Linker, Simd
 from environment import BuildEnvironment
 import slaves
 
@@ -314,12 +314,34 @@ class _BoolOptionHandler(_BuildOptionHandler):
             return None
         return self._label(opt, value)
 
+class _ShardOptionHandler(_BuildOptionHandler):
+    """Handler for an option with syntax 'opt=K/N'.
+
+    The value of the option will be a tuple ``(K, N)`` of integers, with
+    ``1 <= K <= N``.
+    """
+
+    def matches(self, opt):
+        return opt.startswith(self.name + '=')
+
+    def parse(self, opt):
+        match = re.match(r'(\d+)/(\d+)$', opt[len(self.name)+1:])
+        if match:
+            index, count = int(match.group(1)), int(match.group(2))
+            if 1 <= index <= count:
+                return (index, count)
+        raise ConfigurationError('invalid build option: ' + opt)
+
 def simd_label(opt, value):
     """Determines the host label needed for selected SIMD option."""
     if value in (Simd.NONE, Simd.REFERENCE):
         return None
     return str(value).lower()
 
+def linker_label(opt, value):
+    """Determines the host label needed for selected linker option."""
+    return str(value)
+
 def _define_handlers(e, extra_options):
     """Defines the list of recognized build options."""
     # The options are processed in the order they are in the tuple, to support
@@ -333,6 +355,7 @@ def _define_handlers(e, extra_options):
     handlers = [
             _IntOptionHandler('build-jobs', e._set_build_jobs),
             _SimpleOptionHandler('out-of-source'),
+            _EnumOptionHandler('generator', Generator, e._init_generator),
             _VersionOptionHandler('cmake', e._init_cmake, label=OPT),
             _VersionOptionHandler('gcc', e._init_gcc, label=OPT),
             _VersionOptionHandler('gcov', label=OPT),
@@ -347,7 +370,18 @@ def _define_handlers(e, extra_options):
             _SimpleOptionHandler('atlas', e._init_atlas),
             _SimpleOptionHandler('x11', label=OPT),
             _EnumOptionHandler('simd', Simd, label=simd_label),
-            _SimpleOptionHandler('mpi', e._init_mpi, label=OPT)
+            _SimpleOptionHandler('mpi', e._init_mpi, label=OPT),
+            _SimpleOptionHandler('ccache', e._init_ccache, label=OPT),
+            _EnumOptionHandler('linker', Linker, e._init_linker, label=linker_label),
+            _SimpleOptionHandler('split-dwarf', e._init_split_dwarf, label=OPT),
+            _SimpleOptionHandler('compress-debug', e._init_compress_debug, label=OPT),
+            _BoolOptionHandler('configure-cache'),
+            _SimpleOptionHandler('artifact-cache'),
+            _BoolOptionHandler('test-impact'),
+            _BoolOptionHandler('test-priority'),
+            _SimpleOptionHandler('test-fail-fast'),
+            _IntOptionHandler('test-budget'),
+            _ShardOptionHandler('test-shard')
         ]
     if extra_options:
         for name, builder in extra_options.iteritems():
@@ -376,11 +410,14 @@ def process_build_options(factory, opts, extra_options):
         Tuple[BuildEnvironment, BuildParameters, BuildOptions]: Build
             environment and options initialized from the options.
     """
-    e = BuildEnvironment(factory)
-    handlers = _define_handlers(e, extra_options)
-    if opts:
-        opts = _remove_host_option(opts)
-    o = BuildOptions(handlers, opts)
+    with factory.timeline.span('process_build_options'):
+        e = BuildEnvironment(factory)
+        handlers = _define_handlers(e, extra_options)
+        if opts:
+            opts = _remove_host_option(opts)
+        o = BuildOptions(handlers, opts)
+        if o.generator is None:
+            e._init_default_generator()
     return (e, o)
 
 def _remove_host_option(opts):
@@ -405,6 +442,7 @@ def select_build_hosts(factory, configs):
         config.opts = _remove_host_option(config.opts)
         opts = config.opts
         labels = set()
+        index = 0
         for handler in handlers:
             found_opts = [x for x in opts if handler.matches(x)]
             for found_opt in found_opts:
@@ -412,7 +450,9 @@ def select_build_hosts(factory, configs):
                 label = handler.label(found_opt, value)
                 if label:
                     labels.add(label)
+                if handler.name == 'test-shard':
+                    index = value[0] - 1
         config.labels = list(labels)
-        config.host = slaves.pick_host(labels, config.opts)
+        config.host = slaves.pick_host(labels, config.opts, index)
         result.append(config)
     return result
@@ -0,0 +1,575 @@
+"""
+Remote build cache shared between build nodes
+
+Provides a client for a simple HTTP cache protocol, and a reference server
+implementing it that can be run on localhost (or on any host reachable from the
+build nodes) with::
+
+    python -m releng.remotecache --root /path/to/storage --port 8080
+
+The protocol has two namespaces:
+
+``/cas/<sha256>``
+    Content-addressed storage: blobs keyed by the SHA-256 of their
+    (uncompressed) contents.  The server verifies the digest on PUT, and the
+    client verifies it on GET, so corrupted blobs are never used.
+``/ac/<key>``
+    Action cache: small JSON entries keyed by an arbitrary name (e.g., a key
+    computed from the build configuration) that refer to blobs in the CAS.
+
+All bodies are transferred zlib-compressed (and stored compressed on the
+server).  GET returns 404 if the item is not present, and HEAD can be used to
+check for presence without a download.  If the server is configured with a
+shared token, all requests need to pass it in an ``Authorization: Bearer``
+header; other requests get 401.
+
+The client streams downloads to disk, uses bounded timeouts and a bounded
+number of concurrent connections, and treats any network or server error as a
+cache outage: it prints a note and disables itself for the rest of the build,
+so that the build continues as if there was no remote cache.
+
+This module only depends on the standard library, so that the server can be
+run without the rest of releng.
+"""
+from __future__ import print_function
+
+import BaseHTTPServer
+import hashlib
+import hmac
+import httplib
+import json
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import sys
+import tarfile
+import tempfile
+import threading
+import urlparse
+import zlib
+
+_CHUNK_SIZE = 64 * 1024
+_KEY_RE = re.compile(r'^[0-9A-Za-z_.-]+$')
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class _NotFound(Exception):
+    """Raised internally when the remote cache does not have an item."""
+
+def _compress_to_temp(fp):
+    """Compresses a file into a temporary file.
+
+    Returns:
+        Tuple[file, str, int]: The compressed data (positioned at the start),
+            SHA-256 of the uncompressed data, and size of the compressed data.
+    """
+    result = tempfile.TemporaryFile()
+    digest = hashlib.sha256()
+    compressor = zlib.compressobj(6)
+    while True:
+        data = fp.read(_CHUNK_SIZE)
+        if not data:
+            break
+        digest.update(data)
+        result.write(compressor.compress(data))
+    result.write(compressor.flush())
+    size = result.tell()
+    result.seek(0)
+    return result, digest.hexdigest(), size
+
+def _decompress_stream(source, dest, length=None):
+    """Decompresses data from a file-like object into another.
+
+    Args:
+        source: Object with read() returning compressed data.
+        dest: Object with write() for the uncompressed data.
+        length (Optional[int]): Number of compressed bytes to read; if not
+            given, reads until the end.
+
+    Returns:
+        str: SHA-256 of the uncompressed data.
+    """
+    digest = hashlib.sha256()
+    decompressor = zlib.decompressobj()
+    remaining = length
+    while remaining is None or remaining > 0:
+        size = _CHUNK_SIZE if remaining is None else min(_CHUNK_SIZE, remaining)
+        data = source.read(size)
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        data = decompressor.decompress(data)
+        digest.update(data)
+        dest.write(data)
+    data = decompressor.flush()
+    digest.update(data)
+    dest.write(data)
+    return digest.hexdigest()
+
+class _NullWriter(object):
+    def write(self, data):
+        pass
+
+class RemoteCacheClient(object):
+    """Client for the remote cache.
+
+    All methods are safe to call from multiple threads.  Once the remote
+    cache has failed, all methods return immediately as for cache misses.
+
+    Attributes:
+        available (bool): Whether the remote cache is (still) in use.
+        bytes_downloaded (int): Compressed bytes downloaded so far.
+        bytes_uploaded (int): Compressed bytes uploaded so far.
+    """
+
+    def __init__(self, url, console, timeout=30, max_connections=4, token=None):
+        """Creates a client.
+
+        Args:
+            url (str): Base URL of the cache server (``http://host:port``).
+            console (file): Stream to print notes about cache outages.
+            timeout (Optional[float]): Timeout in seconds for connecting and
+                for each read on the connection.
+            max_connections (Optional[int]): Maximum number of concurrent
+                requests to the server.
+            token (Optional[str]): Shared token to authenticate with.
+        """
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme != 'http' or not parsed.hostname:
+            raise ValueError('unsupported remote cache URL: ' + url)
+        self._host = parsed.hostname
+        self._port = parsed.port or 80
+        self._prefix = parsed.path.rstrip('/')
+        self._console = console
+        self._token = token
+        self._timeout = timeout
+        self._max_connections = max_connections
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+        self._stats_lock = threading.Lock()
+        self.available = True
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+
+    def _request(self, method, path, body=None, size=None, handler=None):
+        """Makes a single request to the server.
+
+        Returns the result of handler(response), or None if the cache is
+        not available or failed.  Raises _NotFound for 404 responses.
+        """
+        if not self.available:
+            return None
+        with self._semaphore:
+            conn = httplib.HTTPConnection(self._host, self._port, timeout=self._timeout)
+            try:
+                headers = dict()
+                if self._token:
+                    headers['Authorization'] = 'Bearer ' + self._token
+                if body is not None:
+                    headers['Content-Length'] = str(size)
+                    headers['Content-Type'] = 'application/octet-stream'
+                conn.request(method, self._prefix + path, body, headers)
+                response = conn.getresponse()
+                if response.status == 404:
+                    response.read()
+                    raise _NotFound()
+                if response.status >= 300:
+                    raise httplib.HTTPException('HTTP {0} {1}'.format(
+                        response.status, response.reason))
+                if handler is None:
+                    response.read()
+                    return True
+                return handler(response)
+            except (IOError, OSError, socket.error, httplib.HTTPException, zlib.error) as e:
+                self._disable('{0} {1}: {2}'.format(method, path, e))
+                return None
+            finally:
+                conn.close()
+
+    def _disable(self, reason):
+        if self.available:
+            self.available = False
+            print('Remote cache unavailable ({0}), continuing without it'.format(reason),
+                    file=self._console)
+
+    def _add_stats(self, downloaded=0, uploaded=0):
+        with self._stats_lock:
+            self.bytes_downloaded += downloaded
+            self.bytes_uploaded += uploaded
+
+    def has_blob(self, digest):
+        """Checks whether a blob is present in the cache."""
+        try:
+            return bool(self._request('HEAD', '/cas/' + digest))
+        except _NotFound:
+            return False
+
+    def get_blob(self, digest, path):
+        """Downloads a blob into a file.
+
+        The data is streamed to a temporary file next to ``path``, and only
+        moved into place if its digest matches.
+
+        Returns:
+            bool: Whether the blob was downloaded.
+        """
+        tmp_path = path + '.part'
+        def handler(response):
+            length = response.getheader('Content-Length')
+            if length is not None:
+                length = int(length)
+            counter = _CountingReader(response)
+            with open(tmp_path, 'wb') as fp:
+                actual = _decompress_stream(counter, fp, length)
+            self._add_stats(downloaded=counter.count)
+            if actual != digest:
+                print('Remote cache returned corrupted data for {0}, ignoring'.format(digest),
+                        file=self._console)
+                return False
+            os.rename(tmp_path, path)
+            return True
+        try:
+            return bool(self._request('GET', '/cas/' + digest, handler=handler))
+        except _NotFound:
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put_blob(self, path):
+        """Uploads a file as a blob (unless already present).
+
+        Returns:
+            str or None: SHA-256 of the file, or None if the upload failed.
+        """
+        if not self.available:
+            return None
+        with open(path, 'rb') as fp:
+            data, digest, size = _compress_to_temp(fp)
+        with data:
+            if self.has_blob(digest):
+                return digest
+            if not self._request('PUT', '/cas/' + digest, body=data, size=size):
+                return None
+        self._add_stats(uploaded=size)
+        return digest
+
+    def put_blobs(self, paths):
+        """Uploads several files concurrently.
+
+        Returns:
+            Dict[str, str] or None: SHA-256 for each path, or None if any
+                upload failed.
+        """
+        results = dict()
+        def upload(path):
+            results[path] = self.put_blob(path)
+        self._run_concurrently(upload, paths)
+        if any(x is None for x in results.itervalues()):
+            return None
+        return results
+
+    def get_blobs(self, blobs):
+        """Downloads several blobs concurrently.
+
+        Args:
+            blobs (Dict[str, str]): Paths to download to, keyed by digest.
+
+        Returns:
+            bool: Whether all blobs were downloaded.
+        """
+        results = dict()
+        def download(digest):
+            results[digest] = self.get_blob(digest, blobs[digest])
+        self._run_concurrently(download, list(blobs))
+        return all(results.itervalues())
+
+    def _run_concurrently(self, func, items):
+        threads = [threading.Thread(target=func, args=(x,)) for x in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def get_entry(self, key):
+        """Returns an action cache entry, or None if not present."""
+        def handler(response):
+            data = response.read()
+            self._add_stats(downloaded=len(data))
+            return json.loads(zlib.decompress(data))
+        try:
+            return self._request('GET', '/ac/' + key, handler=handler)
+        except _NotFound:
+            return None
+        except ValueError:
+            return None
+
+    def put_entry(self, key, value):
+        """Stores an action cache entry.
+
+        Returns:
+            bool: Whether the entry was stored.
+        """
+        data = zlib.compress(json.dumps(value))
+        try:
+            result = self._request('PUT', '/ac/' + key, body=data, size=len(data))
+        except _NotFound:
+            return False
+        if result:
+            self._add_stats(uploaded=len(data))
+        return bool(result)
+
+    def get_file(self, key, path):
+        """Downloads a single file stored with put_file().
+
+        Returns:
+            bool: Whether the file was downloaded.
+        """
+        entry = self.get_entry(key)
+        if not entry or 'file' not in entry:
+            return False
+        return self.get_blob(entry['file'], path)
+
+    def put_file(self, key, path):
+        """Uploads a single file under an action cache key.
+
+        Returns:
+            bool: Whether the file was stored.
+        """
+        digest = self.put_blob(path)
+        if digest is None:
+            return False
+        return self.put_entry(key, {'file': digest})
+
+class _CountingReader(object):
+    def __init__(self, fp):
+        self._fp = fp
+        self.count = 0
+
+    def read(self, size):
+        data = self._fp.read(size)
+        self.count += len(data)
+        return data
+
+def pack_tree(path, archive):
+    """Packs a directory tree into an (uncompressed) tar archive.
+
+    The archive contains the contents of the directory with relative paths.
+    Symbolic links are stored as links.
+    """
+    with tarfile.open(archive, 'w') as tar:
+        for name in sorted(os.listdir(path)):
+            tar.add(os.path.join(path, name), arcname=name)
+
+def _is_within(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+def unpack_tree(archive, path):
+    """Unpacks an archive created with pack_tree() into a directory.
+
+    The directory is replaced if it exists.  Only regular files, directories,
+    and symbolic links that resolve within the directory are accepted; if
+    the archive contains anything else, or anything that would be written
+    outside the directory, IOError is raised and the directory is removed.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    root = os.path.realpath(path)
+    try:
+        with tarfile.open(archive) as tar:
+            links = []
+            for member in tar:
+                if not (member.isfile() or member.isdir() or member.issym()):
+                    raise IOError('unsupported member in archive: ' + member.name)
+                # Resolve links already extracted, so that nothing is
+                # written through a link that points outside the tree.
+                target = os.path.realpath(os.path.join(root, member.name))
+                if not _is_within(target, root):
+                    raise IOError('invalid path in archive: ' + member.name)
+                tar.extract(member, root)
+                if member.issym():
+                    links.append(member.name)
+            # A link that was dangling when checked may resolve outside the
+            # tree after later members have been extracted.
+            for name in links:
+                if not _is_within(os.path.realpath(os.path.join(root, name)), root):
+                    raise IOError('invalid link in archive: ' + name)
+    except:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+class _CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler for the reference cache server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _get_path(self):
+        parts = self.path.split('/')
+        if len(parts) != 3 or parts[0] != '':
+            return None, None
+        namespace, key = parts[1], parts[2]
+        if namespace == 'cas' and _DIGEST_RE.match(key):
+            return namespace, os.path.join(self.server.root, 'cas', key[:2], key)
+        if namespace == 'ac' and _KEY_RE.match(key):
+            return namespace, os.path.join(self.server.root, 'ac', key)
+        return None, None
+
+    def _send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _check_token(self):
+        """Checks the shared token; sends 401 and returns False if not valid."""
+        token = self.server.token
+        if not token:
+            return True
+        header = self.headers.getheader('Authorization') or ''
+        if hmac.compare_digest(header, 'Bearer ' + token):
+            return True
+        # The body (if any) is not read, so the connection cannot be reused.
+        self.close_connection = 1
+        self._send_empty(401)
+        return False
+
+    def do_HEAD(self):
+        if not self._check_token():
+            return
+        namespace, path = self._get_path()
+        if path is None:
+            self._send_empty(400)
+        elif not os.path.isfile(path):
+            self._send_empty(404)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+
+    def do_GET(self):
+        if not self._check_token():
+            return
+        namespace, path = self._get_path()
+        if path is None:
+            self._send_empty(400)
+            return
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            self._send_empty(404)
+            return
+        with fp:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(fp.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(fp, self.wfile, _CHUNK_SIZE)
+
+    def do_PUT(self):
+        if not self._check_token():
+            return
+        namespace, path = self._get_path()
+        length = self.headers.getheader('Content-Length')
+        if path is None or length is None:
+            self._send_empty(400)
+            return
+        length = int(length)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                if namespace == 'cas':
+                    tee = _TeeReader(self.rfile, fp)
+                    try:
+                        digest = _decompress_stream(tee, _NullWriter(), length)
+                    except zlib.error:
+                        digest = None
+                    valid = (digest == os.path.basename(path))
+                else:
+                    data = self.rfile.read(length)
+                    fp.write(data)
+                    try:
+                        json.loads(zlib.decompress(data))
+                        valid = True
+                    except (zlib.error, ValueError):
+                        valid = False
+            if not valid:
+                self._send_empty(400)
+                return
+            os.rename(tmp_path, path)
+            tmp_path = None
+            self._send_empty(201)
+        finally:
+            if tmp_path is not None:
+                os.remove(tmp_path)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class _TeeReader(object):
+    def __init__(self, fp, copy):
+        self._fp = fp
+        self._copy = copy
+
+    def read(self, size):
+        data = self._fp.read(size)
+        self._copy.write(data)
+        return data
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Reference implementation of the remote cache server.
+
+    Stores the items as files under a root directory.  Not intended for
+    production use with many clients (there is no size limit), but
+    sufficient for a single lab or for testing.  By default, the server
+    only listens on localhost; when it is reachable from other hosts, a
+    shared token should be required so that only the build nodes can
+    store items.
+
+    Attributes:
+        root (str): Directory where the items are stored.
+        token (str or None): Shared token required from clients.
+        url (str): URL that clients can use to access the server.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, host='localhost', port=0, verbose=False, token=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _CacheRequestHandler)
+        self.root = root
+        self.token = token
+        self.verbose = verbose
+        self.url = 'http://{0}:{1}'.format(host, self.server_address[1])
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="""\
+            Reference server for the releng remote build cache
+            """)
+    parser.add_argument('--root', required=True, help='Directory to store the cache in')
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log requests')
+    args = parser.parse_args(args)
+    token = os.environ.get('RELENG_REMOTE_CACHE_TOKEN', None)
+    if not token and args.host not in ('localhost', '127.0.0.1', '::1'):
+        parser.error('set RELENG_REMOTE_CACHE_TOKEN to listen on other hosts than localhost')
+    server = CacheServer(args.root, host=args.host, port=args.port, verbose=args.verbose,
+            token=token)
+    print('Serving remote cache at {0} from {1}'.format(server.url, args.root))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
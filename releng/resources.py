@@ -0,0 +1,182 @@
+"""
+Resource model of the build node
+
+Determines how many compilation, link, and test jobs a build can run in
+parallel, based on the CPUs and memory available on the node, the current load,
+and the number of executors (concurrent builds) that the node runs.  CPU and
+memory limits from cgroups are respected, so that builds running in containers
+do not oversubscribe their quota.
+"""
+from __future__ import print_function
+
+import math
+
+import jobslots
+import slaves
+import utils
+
+# Approximate peak memory usage of a single job of each kind (in bytes).
+# Linking the large GROMACS binaries (in particular with debug info) takes
+# much more memory than compiling any single source file.
+_COMPILE_JOB_MEMORY = 1024**3
+_LINK_JOB_MEMORY = 3 * 1024**3
+_TEST_JOB_MEMORY = 1024**3
+
+def _read_value(executor, path):
+    """Returns the first line of a (pseudo)file, or None if it is not readable."""
+    try:
+        lines = list(executor.read_file(path))
+    except (IOError, OSError):
+        return None
+    if not lines:
+        return None
+    return lines[0].strip()
+
+def _read_int(executor, path):
+    value = _read_value(executor, path)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def get_cgroup_cpu_limit(executor):
+    """Returns the number of CPUs that the cgroup CPU quota allows.
+
+    Returns:
+        float or None: CPU limit, or None if there is no quota.
+    """
+    # cgroup v2
+    value = _read_value(executor, '/sys/fs/cgroup/cpu.max')
+    if value is not None:
+        fields = value.split()
+        if len(fields) != 2 or fields[0] == 'max':
+            return None
+        return float(fields[0]) / float(fields[1])
+    # cgroup v1
+    quota = _read_int(executor, '/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_int(executor, '/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota is None or period is None or quota <= 0 or period <= 0:
+        return None
+    return float(quota) / period
+
+def get_memory_available(executor):
+    """Returns the amount of memory available for new processes.
+
+    Both the memory available on the host and the remaining memory in the
+    cgroup limit (if any) are considered.
+
+    Returns:
+        int or None: Available memory in bytes, or None if not known.
+    """
+    result = None
+    try:
+        for line in executor.read_file('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                result = int(line.split()[1]) * 1024
+                break
+    except (IOError, OSError):
+        pass
+    # cgroup v2
+    limit = _read_value(executor, '/sys/fs/cgroup/memory.max')
+    usage = _read_int(executor, '/sys/fs/cgroup/memory.current')
+    if limit is None:
+        # cgroup v1
+        limit = _read_value(executor, '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+        usage = _read_int(executor, '/sys/fs/cgroup/memory/memory.usage_in_bytes')
+    if limit is not None and limit != 'max' and usage is not None:
+        try:
+            remaining = max(0, int(limit) - usage)
+        except ValueError:
+            remaining = None
+        # cgroup v1 reports a huge number if there is no limit, so the
+        # comparison takes care of that as well.
+        if remaining is not None and (result is None or remaining < result):
+            result = remaining
+    return result
+
+def _limit_by_memory(jobs, memory, job_memory):
+    if memory is None:
+        return jobs
+    return max(1, min(jobs, memory // job_memory))
+
+class NodeResources(object):
+    """Resources available for the build on the current node.
+
+    The numbers are determined once when the object is created, i.e., at the
+    start of the build.
+
+    Attributes:
+        cpu_count (int or None): Number of CPUs on the node.
+        cpu_limit (float or None): CPU limit from a cgroup quota.
+        memory_available (int or None): Memory available in bytes.
+        load_average (float or None): One-minute load average.
+        executors (int): Number of builds that the node can run concurrently.
+        node_jobs (int): Number of jobs that all builds on the node together
+            can run in parallel.
+        compile_jobs (int): Number of compilation jobs to run in parallel.
+        link_jobs (int or None): Number of link steps to run in parallel,
+            or None if the available memory is not known.
+        test_jobs (int): Number of tests to run in parallel.
+    """
+
+    def __init__(self, factory):
+        executor = factory.executor
+        node_name = factory.jenkins.node_name
+        self.cpu_count = executor.get_cpu_count()
+        self.cpu_limit = get_cgroup_cpu_limit(executor)
+        self.memory_available = get_memory_available(executor)
+        self.load_average = executor.get_load_average()
+        executors = factory.env.get('RELENG_NODE_EXECUTORS', None)
+        if executors:
+            self.executors = max(1, int(executors))
+        else:
+            self.executors = slaves.get_executor_count(node_name)
+        self._compute_jobs(factory, slaves.get_default_build_parallelism(node_name))
+
+    def _compute_jobs(self, factory, default_jobs):
+        if self.cpu_count is None:
+            cpu_jobs = default_jobs
+            self.node_jobs = default_jobs * self.executors
+        else:
+            cpus = self.cpu_count
+            if self.cpu_limit is not None:
+                cpus = min(cpus, max(1, int(math.ceil(self.cpu_limit))))
+            self.node_jobs = cpus
+            cpu_jobs = max(1, cpus // self.executors)
+            if self.load_average is not None:
+                # The load average is for the whole host, so with a cgroup
+                # limit, only the share of the load that corresponds to the
+                # limited CPUs is considered.
+                load = self.load_average * cpus / self.cpu_count
+                # Jobs of other builds on the node (which hold job slots) are
+                # already accounted for by dividing by the executors, so only
+                # the rest of the load reduces the jobs.
+                load = max(0.0, load - jobslots.get_busy_slot_count(factory, cpus))
+                idle_cpus = int(cpus - load + 0.5)
+                cpu_jobs = max(1, min(cpu_jobs, idle_cpus))
+        memory = None
+        if self.memory_available is not None:
+            memory = self.memory_available // self.executors
+        self.compile_jobs = _limit_by_memory(cpu_jobs, memory, _COMPILE_JOB_MEMORY)
+        if memory is None:
+            self.link_jobs = None
+        else:
+            # Capped by the number of build jobs in BuildEnvironment, which
+            # may be overridden with a build option.
+            self.link_jobs = max(1, memory // _LINK_JOB_MEMORY)
+        self.test_jobs = _limit_by_memory(cpu_jobs, memory, _TEST_JOB_MEMORY)
+
+    def print_summary(self, console):
+        """Prints the detected resources to the build log."""
+        cpus = 'unknown' if self.cpu_count is None else str(self.cpu_count)
+        if self.cpu_limit is not None:
+            cpus += ' (cgroup limit {0:.1f})'.format(self.cpu_limit)
+        if self.memory_available is None:
+            memory = 'unknown'
+        else:
+            memory = utils.format_size(self.memory_available)
+        load = 'unknown' if self.load_average is None else '{0:.2f}'.format(self.load_average)
+        print('Node resources: CPUs: {0}, memory available: {1}, load: {2}, executors: {3}'.format(
+            cpus, memory, load, self.executors), file=console)
@@ -44,7 +44,8 @@ _HOST_LABELS = {
                               'phi',
                               'cmake-2.8.12.2', 'cmake-3.3.2', 'cmake-3.6.1', 'cmake-3.8.1',
                               'sse2', 'sse4.1', 'avx_256', 'mic',
-                              'tsan'
+                              'tsan', 'ccache',
+                              'gold', 'split-dwarf', 'compress-debug'
                             },
             BS_MAC:         { 'gcc-4.2', 'gcc-4.4', 'gcc-4.5', 'gcc-4.6', 'gcc-4.7', 'gcc-4.8', 'gcc-4.9', 'gcc-6.1', 'gcc-6',
                               'clang-4.0', 'clang-4',
@@ -59,7 +60,8 @@ _HOST_LABELS = {
                               'cmake-2.8.8', 'cmake-3.6.1',# 'cmake-3.8.1',
                               'sse2', 'sse4.1', 'avx_256', 'avx2_256',
                               'mpi', 'x11',
-                              'valgrind' },
+                              'valgrind', 'ccache',
+                              'gold', 'lld', 'split-dwarf', 'compress-debug' },
             BS_NIX1310:     { 'gcc-4.4', 'gcc-4.6', 'gcc-4.7', 'gcc-4.8', 'gcc-4.9',
                               # These clang are installed, but we don't want to use it if we can avoid it.
                               # 'clang-3.4', 'clang-4', 'clang-5',
@@ -71,7 +73,8 @@ _HOST_LABELS = {
                               'cmake-2.8.11.2', 'cmake-3.4.3', 'cmake-3.5.2', 'cmake-3.8.1',
                               'sse2', 'sse4.1', 'avx_256', 'avx2_256',
                               'mpi', 'x11',
-                              'valgrind', 'tsan' },
+                              'valgrind', 'tsan', 'ccache',
+                              'gold', 'split-dwarf', 'compress-debug' },
             BS_NIX1404:     { 'gcc-4.4', 'gcc-4.6', 'gcc-4.7', 'gcc-4.8', 'gcc-4.9', 'gcc-5.1', 'gcc-5', 'gcc-7',
                               'clang-3.5', 'clang-3.6', 'clang-3.7', 'clang-3.8', 'clang-3.9',
                               # These CUDA versions are installed, but aren't useful to use
@@ -81,24 +84,28 @@ _HOST_LABELS = {
                               'mpi',
                               # TSAN works here with gcc-7, but is too slow on a VM, so this is disabled
                               # 'tsan',
-                              'valgrind', 'msan'
+                              'valgrind', 'msan', 'ccache',
+                              'gold', 'split-dwarf', 'compress-debug'
                             },
             BS_NIX_AMD_GPU: { 'gcc-4.4', 'gcc-4.6', 'gcc-4.7', 'gcc-4.8', 'gcc-4.9', 'gcc-5.2', 'gcc-5',
                               'amdappsdk-3.0',
                               'cmake-2.8.12.2', 'cmake-3.5.2',
                               'sse2', 'sse4.1', 'avx_128_fma',
-                              'mpi' },
+                              'mpi', 'ccache',
+                              'gold', 'split-dwarf', 'compress-debug' },
             BS_NIX_AMD:     { 'gcc-4.4', 'gcc-4.6', 'gcc-4.7', 'gcc-4.8', 'gcc-4.9', 'gcc-5.2', 'gcc-5',
                               'clang-3.4', 'clang-4', 'clang-5',
                               'cmake-2.8.12.2', 'cmake-3.4.3',
                               'sse2', 'sse4.1', 'avx_128_fma',
-                              'mpi' },
+                              'mpi', 'ccache',
+                              'gold', 'lld', 'split-dwarf', 'compress-debug' },
             BS_NIX_DOCS:    { 'cmake-3.6.1'
                             },
             BS_NIX_STATIC_ANALYZER: {
                               'clang-3.8', 'clang-4', 'clang-5',
                               'clang-static-analyzer-3.8', 'clang-static-analyzer-4', 'clang-static-analyzer-5',
-                              'cmake-3.5.1', 'cmake-3.7.2'
+                              'cmake-3.5.1', 'cmake-3.7.2',
+                              'ccache'
                             },
             BS_WIN2008:     { 'msvc-2010',
                               'icc-12.1' },
@@ -185,8 +192,9 @@ _SPECIAL_HOST_GROUPS = [
             {BS_NIX_AMD_GPU, BS_NIX1204, BS_NIX1310}
         ]
 
-# For hosts not specifically listed here, a default hard-coded in
-# get_default_build_parallelism() is used.
+# Used as the number of build jobs on hosts where the number of CPUs cannot be
+# determined (see resources.py).  For hosts not specifically listed here, a
+# default hard-coded in get_default_build_parallelism() is used.
 _DEFAULT_BUILD_PARALLELISM = {
             BS_WIN2008: 4,
             BS_WIN2012R2: 4,
@@ -194,6 +202,26 @@ _DEFAULT_BUILD_PARALLELISM = {
             BS_JETSON_TX1: 4
         }
 
+# Disk space (in GiB) that releng-managed caches (see caches.py) are allowed to
+# use on a host.  For hosts not specifically listed here, a default hard-coded
+# in get_cache_disk_budget() is used.
+_CACHE_DISK_BUDGET = {
+            BS_NIX_DOCS: 10,
+            BS_NIX_STATIC_ANALYZER: 10,
+            BS_JETSON_TK1: 4,
+            BS_JETSON_TX1: 8
+        }
+
+# Number of executors (concurrent builds) configured in Jenkins for a host.
+# For hosts not specifically listed here, a default hard-coded in
+# get_executor_count() is used.
+_EXECUTOR_COUNT = {
+            BS_NIX_DOCS: 1,
+            BS_NIX_STATIC_ANALYZER: 1,
+            BS_JETSON_TK1: 1,
+            BS_JETSON_TX1: 1
+        }
+
 def is_label(host):
     return host in ALL_LABELS
 
@@ -203,8 +231,22 @@ def is_matrix_host(host):
 def get_default_build_parallelism(host):
     return _DEFAULT_BUILD_PARALLELISM.get(host, 2)
 
-def pick_host(labels, opts):
-    """Selects a host that can build with a given set of labels."""
+def get_cache_disk_budget(host):
+    return _CACHE_DISK_BUDGET.get(host, 40)
+
+def get_executor_count(host):
+    return _EXECUTOR_COUNT.get(host, 2)
+
+def pick_host(labels, opts, index=0):
+    """Selects a host that can build with a given set of labels.
+
+    Args:
+        labels (Set[str]): Labels required from the host.
+        opts (List[str]): Build options (for error messages).
+        index (int): Index of the configuration among otherwise identical
+            ones (e.g., test shards).  Consecutive indices are spread over
+            the possible hosts.
+    """
     if labels.issubset(_HOST_LABELS[DOCKER_DEFAULT]):
         return DOCKER_DEFAULT
     possible_hosts = []
@@ -218,6 +260,6 @@ def pick_host(labels, opts):
     # avoid assigning all the builds to the same host.
     for group in _SPECIAL_HOST_GROUPS:
         if set(possible_hosts).issubset(group):
-            return possible_hosts[0]
+            return possible_hosts[index % len(possible_hosts)]
         possible_hosts = [x for x in possible_hosts if x not in group]
-    return possible_hosts[0]
+    return possible_hosts[index % len(possible_hosts)]
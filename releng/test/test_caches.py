@@ -0,0 +1,76 @@
+import json
+import unittest
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
+
+from releng.caches import CacheEntry, evict_least_recently_used
+from releng.common import CacheKind
+
+from releng.test.utils import TestHelper
+
+class TestEvictLeastRecentlyUsed(unittest.TestCase):
+    def setUp(self):
+        self.entries = [
+                CacheEntry(CacheKind.GIT_MIRROR, 'a', size=100, last_used=3),
+                CacheEntry(CacheKind.GIT_MIRROR, 'b', size=100, last_used=1),
+                CacheEntry(CacheKind.COMPILER_CACHE, 'c', size=100, last_used=2)
+            ]
+
+    def test_WithinBudget(self):
+        evicted = evict_least_recently_used(self.entries, 300, lambda x: True)
+        self.assertEqual(evicted, [])
+
+    def test_EvictsOldestFirst(self):
+        evicted = evict_least_recently_used(self.entries, 150, lambda x: True)
+        self.assertEqual([x.name for x in evicted], ['b', 'c'])
+
+    def test_SkipsCachesInUse(self):
+        evicted = evict_least_recently_used(self.entries, 200, lambda x: x.name != 'b')
+        self.assertEqual([x.name for x in evicted], ['c'])
+
+
+class TestCacheManager(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node',
+                'RELENG_CACHE_BUDGET': str(250.0 / 1024**3)
+            })
+        self.helper.add_input_json_file('/node/caches/index.json', {
+                'entries': [
+                    {'kind': 'git-mirror', 'name': 'old', 'size': 100, 'last_used': 1},
+                    {'kind': 'probe-cache', 'name': 'newer', 'size': 100, 'last_used': 2}
+                ]
+            })
+
+    def test_GetCacheDir(self):
+        caches = self.helper.factory.caches
+        path = caches.get_cache_dir(CacheKind.COMPILER_CACHE, 'ccache')
+        self.assertEqual(path, '/node/caches/compiler-cache/ccache')
+        self.helper.executor.lock_file.assert_any_call(path + '.lock',
+                shared=True, blocking=False)
+        index = json.loads(self.helper._output_files['/node/caches/index.json'])
+        self.assertEqual(sorted([x['name'] for x in index['entries']]),
+                ['ccache', 'newer', 'old'])
+
+    def test_CacheLockedByAnotherBuild(self):
+        self.helper.executor.lock_file.side_effect = \
+                lambda path, shared=False, blocking=True: \
+                    None if path.endswith('ccache.lock') else mock.MagicMock()
+        caches = self.helper.factory.caches
+        path = caches.get_cache_dir(CacheKind.COMPILER_CACHE, 'ccache')
+        self.assertEqual(path, '/node/caches/compiler-cache/ccache')
+        caches._finish_build()
+
+    def test_FinishBuildEvictsOverBudget(self):
+        self.helper.executor.get_disk_usage.return_value = 100
+        caches = self.helper.factory.caches
+        caches.get_cache_dir(CacheKind.COMPILER_CACHE, 'ccache')
+        caches._finish_build()
+        self.helper.executor.remove_path.assert_any_call('/node/caches/git-mirror/old')
+        index = json.loads(self.helper._output_files['/node/caches/index.json'])
+        self.assertEqual(sorted([x['name'] for x in index['entries']]),
+                ['ccache', 'newer'])
+
+if __name__ == '__main__':
+    unittest.main()
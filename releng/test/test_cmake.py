@@ -1,6 +1,7 @@
 import unittest
 
-from releng.cmake import process_ctest_xml
+from releng.cmake import parse_ctest_test_list, process_ctest_xml, read_ctest_cost_data
+from releng.cmake import select_ctest_tests_for_budget, split_ctest_tests
 
 from releng.test.utils import TestHelper
 
@@ -55,10 +56,194 @@ class TestRunBuild(unittest.TestCase):
                   </Testing>
                 </Site>
                 """)
-        process_ctest_xml(self.helper.executor, memcheck=False)
+        results = []
+        process_ctest_xml(self.helper.executor, memcheck=False, results=results)
+        self.assertEqual(results, [('Test1', 'failed', 0.1)])
         self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
                 <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" time="0.1"><failure message="Failed" /><system-out>some output</system-out></testcase></testsuite></testsuites>""")
 
+    def test_CTestLongOutput(self):
+        self.helper.add_input_file("Testing/YYYYMMDD-HHMM/Test.xml", """\
+                <Site>
+                  <Testing>
+                    <StartDateTime>Jan 01 00:00 UTC</StartDateTime>
+                    <Test Status="passed">
+                      <Name>Test 1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>0123456789abcdef</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                    <Test Status="failed">
+                      <Name>Test2</Name>
+                      <Results>
+                        <NamedMeasurement name="Exit Code">
+                          <Value>Failed</Value>
+                        </NamedMeasurement>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.2</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>0123456789abcdef</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """)
+        process_ctest_xml(self.helper.executor, memcheck=False, max_passed_output=10)
+        self.helper.assertOutputFile("Testing/Temporary/CTestOutput/Test_1-5ccaaa9c.log", """\
+                0123456789abcdef""")
+        self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test 1" time="0.1"><system-out>0123456789
+                [output truncated; full output in Testing/Temporary/CTestOutput/Test_1-5ccaaa9c.log]</system-out></testcase><testcase classname="CTest" name="Test2" time="0.2"><failure message="Failed" /><system-out>0123456789abcdef</system-out></testcase></testsuite></testsuites>""")
+
+    def test_CTestLongOutputFileNamesAreUnique(self):
+        self.helper.add_input_file("Testing/YYYYMMDD-HHMM/Test.xml", """\
+                <Site>
+                  <Testing>
+                    <Test Status="passed">
+                      <Name>Test 1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>0123456789abcdef</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                    <Test Status="passed">
+                      <Name>Test_1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>0123456789abcdef</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                    <Test Status="passed">
+                      <Name>Test/1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>0123456789abcdef</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """)
+        process_ctest_xml(self.helper.executor, memcheck=False, max_passed_output=10)
+        paths = [x for x in self.helper._output_files if x.endswith('.log')]
+        self.assertEqual(len(paths), 3)
+        self.assertIn('Testing/Temporary/CTestOutput/Test_1.log', paths)
+
+    def test_CTestResultsDoNotDependOnWriting(self):
+        self.helper.add_input_file("Testing/YYYYMMDD-HHMM/Test.xml", """\
+                <Site>
+                  <Testing>
+                    <Test Status="passed">
+                      <Name>Test1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>0123456789abcdef</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """)
+        # An executor that does not consume the contents (e.g., a dry run).
+        self.helper.executor.write_file.side_effect = None
+        results = []
+        process_ctest_xml(self.helper.executor, memcheck=False, results=results)
+        self.assertEqual(results, [('Test1', 'passed', 0.1)])
+
+    def test_CTestRerunFailed(self):
+        self.helper.add_input_file("attempt0.xml", """\
+                <Site>
+                  <Testing>
+                    <Test Status="failed">
+                      <Name>Test1</Name>
+                      <Results>
+                        <NamedMeasurement name="Exit Code">
+                          <Value>Timeout</Value>
+                        </NamedMeasurement>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>30</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>output 1</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                    <Test Status="failed">
+                      <Name>Test2</Name>
+                      <Results>
+                        <NamedMeasurement name="Exit Code">
+                          <Value>Failed</Value>
+                        </NamedMeasurement>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>output 2</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """)
+        self.helper.add_input_file("attempt1.xml", """\
+                <Site>
+                  <Testing>
+                    <Test Status="passed">
+                      <Name>Test1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.5</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>rerun output 1</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                    <Test Status="failed">
+                      <Name>Test2</Name>
+                      <Results>
+                        <NamedMeasurement name="Exit Code">
+                          <Value>Failed</Value>
+                        </NamedMeasurement>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.2</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>rerun output 2</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """)
+        flaky, failed = process_ctest_xml(self.helper.executor, memcheck=False,
+                attempt_paths=['attempt0.xml', 'attempt1.xml'])
+        self.assertEqual(flaky, ['Test1'])
+        self.assertEqual(failed, ['Test2'])
+        self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" time="0.5"><flakyFailure message="Timeout" time="30"><system-out>output 1</system-out></flakyFailure><system-out>rerun output 1</system-out></testcase><testcase classname="CTest" name="Test2" time="0.1"><failure message="Failed" /><rerunFailure message="Failed" time="0.2"><system-out>rerun output 2</system-out></rerunFailure><system-out>output 2</system-out></testcase></testsuite></testsuites>""")
+
     def test_CTestAsanFailure(self):
         self.helper.add_input_file("Testing/YYYYMMDD-HHMM/DynamicAnalysis.xml", """\
                 <Site>
@@ -76,3 +261,37 @@ class TestRunBuild(unittest.TestCase):
         process_ctest_xml(self.helper.executor, memcheck=True)
         self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
                 <testsuites><testsuite name="CTest_MemCheck"><testcase classname="CTest_MemCheck" name="Test1"><failure message="SEGV" /><system-out>some output</system-out></testcase></testsuite></testsuites>""")
+
+class TestTestSharding(unittest.TestCase):
+    def test_ReadCostData(self):
+        lines = ['MdrunTests 12 30.5\n', 'Regression Simple 3 4\n', 'broken\n',
+                '---\n', 'FailedTest\n']
+        self.assertEqual(read_ctest_cost_data(lines),
+                {'MdrunTests': 30.5, 'Regression Simple': 4.0})
+
+    def test_ParseTestList(self):
+        output = ('Test project /ws/build\n'
+                  '  Test  #1: MdrunTests\n'
+                  '  Test #10: Regression Simple\n'
+                  '\n'
+                  'Total Tests: 2\n')
+        self.assertEqual(parse_ctest_test_list(output), ['MdrunTests', 'Regression Simple'])
+
+    def test_SplitBalancesDuration(self):
+        costs = {'A': 10.0, 'B': 6.0, 'C': 5.0, 'D': 1.0}
+        self.assertEqual(split_ctest_tests(['D', 'C', 'B', 'A', 'E'], costs, 2),
+                [['A', 'C'], ['B', 'D', 'E']])
+
+    def test_SplitWithoutCostData(self):
+        self.assertEqual(split_ctest_tests(['C', 'A', 'B'], {}, 2), [['A', 'C'], ['B']])
+
+class TestTestBudget(unittest.TestCase):
+    def test_SelectByPriority(self):
+        costs = {'Slow': 100.0, 'Failed': 30.0, 'A': 10.0, 'B': 20.0, 'C': 50.0}
+        tests = ['A', 'B', 'C', 'Failed', 'Slow', 'Unknown']
+        # 'Unknown' has no timing and takes the average (42 s), 'Other' is
+        # not a test that would run.
+        self.assertEqual(select_ctest_tests_for_budget(tests,
+            ['Failed', 'Other'], costs, 60.0, 2), ['A', 'B', 'Failed', 'Unknown'])
+        self.assertEqual(select_ctest_tests_for_budget(tests,
+            ['Failed', 'Other'], costs, 12.0, 1), ['A'])
@@ -1,14 +1,30 @@
+import hashlib
+import json
 import os.path
+import shutil
+import subprocess
+import tempfile
 import unittest
 # With Python 2.7, this needs to be separately installed.
 # With Python 3.3 and up, this should change to unittest.mock.
 import mock
 
-from releng.common import JobType
+from releng.artifacts import ArtifactCache
+from releng.common import BuildError, ConfigurationError, JobType
 from releng.context import BuildContext
+from releng.remotecache import pack_tree
+from releng.testhistory import TestHistory
 
 from releng.test.utils import TestHelper
 
+def _list_tests_output(cmd, names):
+    """Returns CTest output for listing the given tests with ``cmd``."""
+    if '--show-only=json-v1' in cmd:
+        return json.dumps({'tests': [{'name': x, 'command': ['/bin/' + x]} for x in names]})
+    if '-N' in cmd:
+        return ''.join(['  Test #{0}: {1}\n'.format(i + 1, x) for i, x in enumerate(names)])
+    return None
+
 class TestRunBuild(unittest.TestCase):
     def setUp(self):
         self.helper = TestHelper(self, workspace='/ws')
@@ -65,6 +81,88 @@ class TestRunBuild(unittest.TestCase):
         BuildContext._run_build(self.helper.factory,
                 'script/build.py', JobType.GERRIT, None)
 
+    def test_Timeline(self):
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.run_cmd(['echo', 'foo'])
+                """)
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+        timeline = json.loads(self.helper._output_files['/ws/logs/timeline.json'])
+        names = [x['name'] for x in timeline['traceEvents']]
+        self.assertIn('run_build', names)
+        self.assertIn('checkout gromacs', names)
+        self.assertIn('process_build_options', names)
+        self.assertIn('do_build', names)
+        self.assertIn('echo', names)
+        for event in timeline['traceEvents']:
+            self.assertEqual(event['ph'], 'X')
+
+    def test_CcacheStatistics(self):
+        self.helper.executor.find_executable_with_path.return_value = '/usr/bin/ccache'
+        outputs = [
+                'cache hit (direct)                 5\ncache miss                         2\n',
+                'cache hit (direct)                 8\ncache hit (preprocessed)           1\n'
+                'cache miss                         3\ncalled for link                    1\n'
+            ]
+        self._set_ccache_output(lambda: outputs.pop(0))
+        self._run_ccache_build()
+        stats = self.helper.factory.status_reporter.statistics['ccache']
+        self.assertEqual((stats['hits'], stats['misses'], stats['uncacheable']), (4, 1, 1))
+
+    def test_CcacheStatisticsWithPrintStats(self):
+        self.helper.executor.find_executable_with_path.return_value = '/usr/bin/ccache'
+        outputs = [
+                'direct_cache_hit\t5\ncache_miss\t2\nstats_updated_timestamp\t0\n',
+                'direct_cache_hit\t8\npreprocessed_cache_hit\t1\n'
+                'cache_miss\t3\ncalled_for_link\t1\n'
+            ]
+        self._set_ccache_output(lambda: outputs.pop(0))
+        self._run_ccache_build()
+        self.helper.executor.check_output.assert_any_call(
+                ['/usr/bin/ccache', '--print-stats'], cwd=mock.ANY, env=mock.ANY)
+        stats = self.helper.factory.status_reporter.statistics['ccache']
+        self.assertEqual((stats['hits'], stats['misses'], stats['uncacheable']), (4, 1, 1))
+
+    def test_CcacheStatisticsFailureIsIgnored(self):
+        self.helper.executor.find_executable_with_path.return_value = '/usr/bin/ccache'
+        def fail():
+            raise subprocess.CalledProcessError(1, 'ccache')
+        self._set_ccache_output(fail)
+        self._run_ccache_build()
+        self.assertNotIn('ccache', self.helper.factory.status_reporter.statistics)
+
+    @mock.patch('releng.environment.os.listdir')
+    def test_CcacheRequiresCMake34(self, listdir):
+        listdir.return_value = []
+        self.helper.executor.find_executable_with_path.return_value = '/usr/bin/ccache'
+        self._set_ccache_output(lambda: '', cmake_version='3.3.2')
+        with self.assertRaisesRegexp(ConfigurationError, 'requires CMake 3.4'):
+            self._run_ccache_build()
+
+    def test_CcacheWithOldCMakeOption(self):
+        self.helper.executor.find_executable_with_path.return_value = '/usr/bin/ccache'
+        with self.assertRaisesRegexp(ConfigurationError, 'requires CMake 3.4'):
+            self._run_ccache_build(['cmake-2.8'])
+
+    def _set_ccache_output(self, ccache_output, cmake_version='3.10.2'):
+        def check_output(cmd, **kwargs):
+            if cmd == ['cmake', '--version']:
+                return 'cmake version {0}\n'.format(cmake_version)
+            return ccache_output()
+        self.helper.executor.check_output.side_effect = check_output
+
+    def _run_ccache_build(self, extra_opts=[]):
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_options = {0}
+                def do_build(context):
+                    pass
+                """.format(['gcc-4.8', 'ccache'] + extra_opts))
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+
 
 class TestReadBuildScriptConfig(unittest.TestCase):
     def setUp(self):
@@ -100,5 +198,544 @@ class TestReadCmakeVariableFile(unittest.TestCase):
         result = context.read_cmake_variable_file('Test.cmake')
         self.assertEqual(result, { 'FOO': '1', 'BAR': '2' })
 
+class TestRunCmake(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node'
+            })
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: '/usr/bin/' + name
+        self.compiler_version = 'gcc 4.8.5'
+        self.helper.executor.check_output.side_effect = \
+                lambda cmd, **kwargs: self.compiler_version
+        self.helper.add_input_file('CMakeCache.txt',
+                """\
+                # This is the CMakeCache file.
+                CMAKE_C_COMPILER_WORKS:INTERNAL=1
+                HAVE_UNISTD_H:INTERNAL=1
+                CFLAGS_WARN:INTERNAL=1
+                CXX_SSE2_FLAG_ACCEPTED:INTERNAL=1
+                GMX_SIMD:STRING=SSE2
+                HAVE_LOCAL_FILE:INTERNAL=/ws/build/file
+                """)
+
+    def _run_cmake(self, simd='SSE2'):
+        context = self.helper.factory.create_context(JobType.GERRIT, ['gcc-4.8'], None)
+        context.run_cmake({'GMX_SIMD': simd})
+        paths = [x for x in self.helper._output_files if x.endswith('InitialCache.cmake')]
+        self.assertEqual(len(paths), 1)
+        self.assertFalse([x for x in self.helper._output_files if x.endswith('.tmp')])
+        return paths[0]
+
+    def test_SavesCheckResults(self):
+        path = self._run_cmake()
+        self.assertTrue(path.startswith('/node/caches/probe-cache/configure-'))
+        self.helper.assertOutputFile(path,
+                """\
+                set(HAVE_UNISTD_H "1" CACHE INTERNAL "")
+                set(CFLAGS_WARN "1" CACHE INTERNAL "")
+                set(CXX_SSE2_FLAG_ACCEPTED "1" CACHE INTERNAL "")
+                """)
+
+    def test_CompilerChangeInvalidates(self):
+        path = self._run_cmake()
+        self.helper._output_files.clear()
+        self.helper.factory._caches = None
+        self.compiler_version = 'gcc 4.8.6'
+        self.assertNotEqual(self._run_cmake(), path)
+
+    def test_CMakeOptionChangeInvalidates(self):
+        path = self._run_cmake()
+        self.helper._output_files.clear()
+        self.helper.factory._caches = None
+        self.assertNotEqual(self._run_cmake(simd='AVX_256'), path)
+
+class TestBuildTargets(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+        self.helper.executor.check_call.side_effect = self._check_call
+        self.failing_target = None
+
+    def _check_call(self, cmd, **kwargs):
+        if self.failing_target in cmd:
+            raise subprocess.CalledProcessError(1, cmd)
+
+    def _create_context(self, opts):
+        return self.helper.factory.create_context(JobType.GERRIT, opts, None)
+
+    def test_SingleInvocationWithNinja(self):
+        context = self._create_context(['build-jobs=4', 'generator=ninja'])
+        context.build_targets(['tests', 'install'])
+        self.helper.executor.check_call.assert_called_once_with(
+                ['cmake', '--build', '.', '--', '-j4', 'tests', 'install'],
+                cwd=mock.ANY, env=mock.ANY)
+
+    def test_SingleInvocationWithNewCMake(self):
+        context = self._create_context(['build-jobs=4', 'generator=make'])
+        context.env.cmake_version = '3.15.2'
+        context.build_targets(['tests', 'install'])
+        self.helper.assertCommandInvoked(
+                ['cmake', '--build', '.', '--target', 'tests', 'install', '--', '-j4'])
+
+    def test_OneByOneWithOldCMake(self):
+        context = self._create_context(['build-jobs=4', 'generator=make'])
+        context.env.cmake_version = '3.4.3'
+        context.build_targets(['tests', 'install'])
+        self.assertEqual(self.helper.executor.check_call.call_count, 2)
+
+    def test_FailureReportedPerTarget(self):
+        self.failing_target = 'install'
+        context = self._create_context(['build-jobs=4', 'generator=ninja'])
+        with self.assertRaises(BuildError) as cm:
+            context.build_targets(['tests', 'install'],
+                    target_descrs={'install': 'Installation'})
+        self.assertEqual(str(cm.exception), 'Installation failed to build')
+        self.helper.assertCommandInvoked(['cmake', '--build', '.', '--target', 'tests', '--', '-j4'])
+
+class TestRunCtest(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node',
+                'RELENG_NODE_EXECUTORS': '1',
+                'GERRIT_BRANCH': 'release-2018'
+            })
+        self.helper.executor.get_cpu_count.return_value = 4
+        self.helper.add_input_file('Testing/TAG', 'YYYYMMDD-HHMM\n')
+        self.helper.add_input_file('Testing/YYYYMMDD-HHMM/Test.xml', '<Site />\n')
+
+    def _run_ctest(self, opts, args, cmake_version=None):
+        context = self.helper.factory.create_context(JobType.GERRIT, opts, None)
+        context.env.cmake_version = cmake_version
+        context.run_ctest(args)
+        self.helper.factory._caches = None
+        return [x[0] for x in self.helper.executor.copy_file.call_args_list]
+
+    def test_ParallelWithCostData(self):
+        restored, saved = self._run_ctest(['gcc-4.8'], ['--output-on-failure'])
+        self.helper.assertCommandInvoked(
+                ['ctest', '-D', 'ExperimentalTest', '--output-on-failure', '-j', '4'])
+        cost_data = 'Testing/Temporary/CTestCostData.txt'
+        self.assertTrue(restored[0].startswith('/node/caches/test-cost/ctest-'))
+        self.assertEqual(restored, (saved[1], cost_data))
+        self.assertEqual(saved[0], cost_data)
+
+    def test_CostDataIsPerConfiguration(self):
+        first = self._run_ctest(['gcc-4.8'], [])[0]
+        self.helper.executor.reset_mock()
+        second = self._run_ctest(['gcc-7'], [])[0]
+        self.assertNotEqual(first[0], second[0])
+
+    def test_RerunFailed(self):
+        self.helper.executor.check_call.side_effect = \
+                lambda cmd, **kwargs: self._fail_first_run(cmd)
+        self.helper.add_input_file('Testing/Temporary/CTestAttempt0.xml', '<Site />\n')
+        self.helper.add_input_file('Testing/Temporary/CTestAttempt1.xml', '<Site />\n')
+        context = self.helper.factory.create_context(JobType.GERRIT, ['gcc-4.8'], None)
+        context.run_ctest(['-j2'], rerun_failed=2)
+        self.helper.assertCommandInvoked(
+                ['ctest', '-D', 'ExperimentalTest', '-j2', '--rerun-failed'])
+        self.assertEqual(self.helper.executor.check_call.call_count, 2)
+        self.assertFalse(context.failed)
+        self.assertEqual(self.helper.factory.status_reporter._unsuccessful_reason, [])
+
+    def _fail_first_run(self, cmd):
+        if '--rerun-failed' not in cmd:
+            raise subprocess.CalledProcessError(8, cmd)
+
+    def test_RecordsTestHistory(self):
+        self.helper.add_input_file('Testing/YYYYMMDD-HHMM/Test.xml', """\
+                <Site><Testing><Test Status="passed"><Name>MdrunTests</Name><Results>
+                  <NamedMeasurement name="Execution Time"><Value>12.5</Value></NamedMeasurement>
+                  <Measurement><Value>output</Value></Measurement>
+                </Results></Test></Testing></Site>
+                """)
+        self._run_ctest(['gcc-4.8'], [])
+        history = self.helper.factory.test_history
+        self.assertEqual(history.get_configs(), ['gcc=4.8'])
+        self.assertEqual(self.helper.factory.status_reporter.statistics['slowest_tests'],
+                [{'name': 'MdrunTests', 'duration': 12.5, 'runs': 1}])
+
+    def test_TestHistoryOpenedOnlyWhenTestsRun(self):
+        self.helper.factory._test_history = None
+        self.helper.factory.create_context(JobType.GERRIT, ['gcc-4.8'], None)
+        self.assertIsNone(self.helper.factory._test_history)
+        history = TestHistory(':memory:')
+        history.add_build('gcc=4.8', None, [('A', 'passed', 1.0)], timestamp=0.0)
+        self.helper.factory.init_test_history(instance=history)
+        self.helper.add_input_file('Testing/YYYYMMDD-HHMM/Test.xml', """\
+                <Site><Testing><Test Status="passed"><Name>B</Name><Results>
+                  <NamedMeasurement name="Execution Time"><Value>2.0</Value></NamedMeasurement>
+                  <Measurement><Value>output</Value></Measurement>
+                </Results></Test></Testing></Site>
+                """)
+        self._run_ctest(['gcc-4.8'], [])
+        # The old build is removed when the new results are recorded.
+        self.assertEqual(history.get_slowest_tests(), [('B', 2.0, 1)])
+
+    def test_TestShard(self):
+        self.helper.executor.check_output.side_effect = \
+                lambda cmd, **kwargs: _list_tests_output(cmd, ['C', 'A', 'B'])
+        self._run_ctest(['gcc-4.8', 'test-shard=2/2'], ['-L', 'Quick'], cmake_version='3.14.0')
+        self.helper.executor.check_output.assert_any_call(
+                ['ctest', '--show-only=json-v1', '-L', 'Quick'], cwd=mock.ANY, env=mock.ANY)
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-L', 'Quick',
+            '-R', '^(B)$', '-j', '4'])
+
+    def test_TestShardWithOldCTest(self):
+        self.helper.executor.check_output.side_effect = \
+                lambda cmd, **kwargs: _list_tests_output(cmd, ['C', 'A', 'B'])
+        self._run_ctest(['gcc-4.8', 'test-shard=2/2'], ['-L', 'Quick'], cmake_version='3.8.1')
+        self.helper.executor.check_output.assert_any_call(
+                ['ctest', '-N', '-L', 'Quick'], cwd=mock.ANY, env=mock.ANY)
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-L', 'Quick',
+            '-R', '^(B)$', '-j', '4'])
+
+    def test_ShardsCoverEachTestOnce(self):
+        tests = ['A', 'B', 'C', 'D', 'E']
+        self.helper.executor.check_output.side_effect = \
+                lambda cmd, **kwargs: _list_tests_output(cmd, tests)
+        store = dict()
+        def get_file(key, path):
+            if key not in store:
+                return False
+            self.helper.add_input_file(path, store[key])
+            return True
+        def put_file(key, path):
+            store[key] = self.helper._output_files.get(path) or \
+                    ''.join(self.helper._input_files[path])
+            return True
+        remote = mock.Mock()
+        remote.get_file.side_effect = get_file
+        remote.put_file.side_effect = put_file
+        self.helper.factory.init_remote_cache(instance=remote)
+        selected = []
+        for index in range(1, 4):
+            self.helper.executor.check_call.reset_mock()
+            context = self.helper.factory.create_context(JobType.GERRIT,
+                    ['gcc-4.8', 'test-shard={0}/3'.format(index)], None)
+            key = context._get_remote_key(context._get_test_cost_data_file(False))
+            if index == 1:
+                store[key] = 'A 1 5\nB 1 3\nC 1 2\nD 1 1\nE 1 4\n'
+            else:
+                # Shards that have finished update the timings.
+                store[key] = 'A 1 1\nB 1 2\nC 1 3\nD 1 4\nE 1 5\n'
+            context.run_ctest([])
+            self.helper.factory._caches = None
+            cmd = self.helper.executor.check_call.call_args[0][0]
+            selected.extend(cmd[cmd.index('-R') + 1][2:-2].split('|'))
+        self.assertEqual(sorted(selected), tests)
+
+    def test_TestShardFailsIfTestsCannotBeListed(self):
+        with self.assertRaises(BuildError):
+            self._run_ctest(['gcc-4.8', 'test-shard=2/2'], [])
+
+    def test_ScriptParallelismIsKept(self):
+        self._run_ctest(['gcc-4.8'], ['-j2'])
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-j2'])
+
+class TestTestImpact(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node',
+                'CHECKOUT_PROJECT': 'gromacs',
+                'CHECKOUT_REFSPEC': 'refs/changes/34/1234/5',
+                'GERRIT_PROJECT': 'gromacs',
+                'GERRIT_REFSPEC': 'refs/changes/34/1234/5',
+                'GERRIT_BRANCH': 'master',
+                'GROMACS_REFSPEC': 'refs/heads/master',
+                'RELENG_REFSPEC': 'refs/heads/master'
+            })
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: '/usr/bin/' + name
+        self.helper.executor.check_output.side_effect = self._check_output
+        self.helper.add_input_file('Testing/TAG', 'YYYYMMDD-HHMM\n')
+        self.helper.add_input_file('Testing/YYYYMMDD-HHMM/Test.xml', '<Site />\n')
+        deps_dir = 'deps-' + hashlib.sha1('master').hexdigest()[:16]
+        self.helper.add_input_file('/node/caches/test-impact/' + deps_dir + '/deps.json',
+                json.dumps({'src/gromacs/math/tests/units.cpp': ['math-test']}))
+
+    def _check_output(self, cmd, **kwargs):
+        if cmd[:2] == ['git', 'diff']:
+            return 'src/gromacs/math/tests/units.cpp\n'
+        if cmd[-1] == '--show-only=json-v1':
+            return json.dumps({'tests': [
+                    {'name': 'MathUnitTest', 'command': ['/ws/build/bin/math-test']},
+                    {'name': 'MdrunTests', 'command': ['/ws/build/bin/mdrun-test']},
+                    {'name': 'FFTUnitTest', 'command': ['/ws/build/bin/fft-test']}
+                ]})
+        return None
+
+    def _run_ctest(self, job_type, opts, args):
+        context = self.helper.factory.create_context(job_type, opts, None)
+        context.run_ctest(args)
+
+    def test_GerritRunsAffectedTests(self):
+        self.helper.add_input_file('Testing/Temporary/CTestPriority.xml', '<Site />\n')
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8'], [])
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest',
+            '-R', '^(MathUnitTest)$', '-j', '2'])
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest',
+            '-E', '^(MathUnitTest)$', '-R', '^(MdrunTests)$', '-j', '2'])
+        self.assertEqual(self.helper.executor.check_call.call_count, 2)
+
+    def test_NightlyRunsAllTests(self):
+        self._run_ctest(JobType.NIGHTLY, ['gcc-4.8'], [])
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-j', '2'])
+
+    def test_DisabledByOption(self):
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8', 'no-test-impact'], [])
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-j', '2'])
+
+    def test_ScriptSelectionIsKept(self):
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8'], ['-L', 'QuickGpuTest'])
+        self.helper.assertCommandInvoked(
+                ['ctest', '-D', 'ExperimentalTest', '-L', 'QuickGpuTest', '-j', '2'])
+
+class TestTestPriority(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node',
+                'GERRIT_BRANCH': 'master'
+            })
+        self.helper.executor.get_cpu_count.return_value = 1
+        self.helper.executor.check_output.side_effect = \
+                lambda cmd, **kwargs: _list_tests_output(cmd, ['A', 'B', 'C'])
+        self.helper.add_input_file('Testing/TAG', 'YYYYMMDD-HHMM\n')
+        self.helper.add_input_file('Testing/YYYYMMDD-HHMM/Test.xml', '<Site />\n')
+        self.helper.add_input_file('Testing/Temporary/CTestCostData.txt', 'A 1 5\n---\nB\n')
+        self.helper.factory.test_history.add_build('gcc=4.8', None,
+                [('A', 'passed', 5.0), ('C', 'failed', 1.0)])
+
+    def _run_ctest(self, job_type, opts, cmake_version=None, cost_data=None):
+        context = self.helper.factory.create_context(job_type, opts, None)
+        context.env.cmake_version = cmake_version
+        if cost_data:
+            self.helper.add_input_file(context._get_test_cost_data_file(False), cost_data)
+        context.run_ctest([])
+
+    def _add_test_xml(self, path, name, status):
+        self.helper.add_input_file(path, """\
+                <Site>
+                  <Testing>
+                    <Test Status="{1}">
+                      <Name>{0}</Name>
+                      <Results>
+                        <NamedMeasurement name="Exit Code">
+                          <Value>{1}</Value>
+                        </NamedMeasurement>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>output</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """.format(name, status))
+
+    def test_GerritRunsRecentFailuresFirst(self):
+        self._add_test_xml('Testing/Temporary/CTestPriority.xml', 'C', 'passed')
+        self._add_test_xml('Testing/YYYYMMDD-HHMM/Test.xml', 'A', 'passed')
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8'], cmake_version='3.18.0')
+        self.assertEqual([x[0][0] for x in self.helper.executor.check_call.call_args_list], [
+                ['ctest', '-D', 'ExperimentalTest', '-R', '^(C)$', '-j', '1'],
+                ['ctest', '-D', 'ExperimentalTest', '-E', '^(C)$', '-j', '1']
+            ])
+        self.helper.executor.copy_file.assert_any_call('Testing/YYYYMMDD-HHMM/Test.xml',
+                'Testing/Temporary/CTestPriority.xml')
+        # CTest's own bookkeeping of failed tests is not touched.
+        self.assertNotIn('Testing/Temporary/CTestCostData.txt', self.helper._output_files)
+        junit = self.helper._output_files['Testing/Temporary/CTest.xml']
+        self.assertLess(junit.index('name="C"'), junit.index('name="A"'))
+
+    def test_FailFastSkipsOtherTests(self):
+        self._add_test_xml('Testing/YYYYMMDD-HHMM/Test.xml', 'C', 'failed')
+        self.helper.executor.check_call.side_effect = \
+                subprocess.CalledProcessError(8, 'ctest')
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8', 'test-fail-fast'], cmake_version='3.18.0')
+        self.assertEqual([x[0][0] for x in self.helper.executor.check_call.call_args_list], [
+                ['ctest', '-D', 'ExperimentalTest', '--stop-on-failure', '-R', '^(C)$', '-j', '1']
+            ])
+        self.assertIn('Not running the other tests', self.helper._console.getvalue())
+
+    def test_NoStopOnFailureByDefault(self):
+        self.helper.add_input_file('Testing/Temporary/CTestPriority.xml', '<Site />\n')
+        self.helper.executor.check_call.side_effect = \
+                subprocess.CalledProcessError(8, 'ctest')
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8'], cmake_version='3.18.0')
+        self.assertEqual(self.helper.executor.check_call.call_count, 2)
+        for call in self.helper.executor.check_call.call_args_list:
+            self.assertNotIn('--stop-on-failure', call[0][0])
+
+    def test_TestBudget(self):
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8', 'test-budget=1'],
+                cost_data='A 1 50\nB 1 20\nC 1 30\n')
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-R', '^(B|C)$', '-j', '1'])
+
+    def test_TestBudgetIgnoredIfTestsCannotBeListed(self):
+        self.helper.executor.check_output.side_effect = \
+                subprocess.CalledProcessError(1, 'ctest')
+        self._run_ctest(JobType.GERRIT, ['gcc-4.8', 'test-budget=1'],
+                cost_data='A 1 50\nB 1 20\nC 1 30\n')
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-j', '1'])
+
+    def test_NightlyRunsAllTests(self):
+        self._run_ctest(JobType.NIGHTLY, ['gcc-4.8', 'test-budget=1'], cmake_version='3.18.0')
+        self.helper.assertCommandInvoked(['ctest', '-D', 'ExperimentalTest', '-j', '1'])
+
+class TestProcessCoverageResults(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node',
+                'RELENG_NODE_EXECUTORS': '1'
+            })
+        self.helper.executor.get_cpu_count.return_value = 4
+        self.helper.factory.workspace._init_build_dir(True)
+
+    def test_RunsGcovInParallel(self):
+        context = self.helper.factory.create_context(JobType.NIGHTLY, ['gcc-7'], None)
+        context.process_coverage_results(exclude=['.*/tests/.*'])
+        self.helper.assertCommandInvoked(['/ws/releng/scripts/gcovr-3.2', '--xml',
+            '-r', '/ws/gromacs', '-o', '/ws/logs/coverage.xml', '.',
+            '--gcov-executable=gcov-7', '--cache-dir', mock.ANY,
+            '-e', '.*/tests/.*', '-j', '4'])
+
+    def test_CacheIsPerConfiguration(self):
+        context = self.helper.factory.create_context(JobType.NIGHTLY, ['gcc-7'], None)
+        first = context._get_coverage_cache_dir()
+        self.assertTrue(first.startswith('/node/caches/coverage/gcovr-'))
+        context = self.helper.factory.create_context(JobType.NIGHTLY, ['gcc-8'], None)
+        self.assertNotEqual(context._get_coverage_cache_dir(), first)
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node'
+            })
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: '/usr/bin/' + name
+        self.helper.executor.check_output.side_effect = self._check_output
+        self.helper.factory.workspace._init_build_dir(True)
+
+    def _check_output(self, cmd, **kwargs):
+        if cmd == ['git', 'rev-parse', 'HEAD^{tree}']:
+            return '0123456789abcdef0123456789abcdef01234567\n'
+        return 'version 1.0'
+
+    def _run_build(self, env=None):
+        # Each build starts from the initial environment, as in a new process.
+        runner = self.helper.factory.cmd_runner
+        runner._env = dict(runner._initial_env)
+        context = self.helper.factory.create_context(JobType.GERRIT,
+                ['gcc-4.8', 'artifact-cache', 'generator=ninja'], None)
+        for name, value in (env or dict()).iteritems():
+            context.env.set_env_var(name, value)
+        context.run_cmake({'GMX_SIMD': 'SSE2'})
+        context.build_targets(['tests', 'install'])
+        context.build_target('check-source')
+        context._save_artifact_cache()
+        return context
+
+    def test_SaveAndRestore(self):
+        self._run_build()
+        paths = [x for x in self.helper._output_files if x.endswith('artifacts.json')]
+        self.assertEqual(len(paths), 1)
+        cache_dir = os.path.dirname(paths[0])
+        self.assertTrue(cache_dir.startswith('/node/caches/artifacts/'))
+        self.helper.executor.copy_tree.assert_any_call('/ws/build', cache_dir + '/build')
+        self.helper.executor.copy_tree.assert_any_call('/ws/test-install', cache_dir + '/install')
+        self.assertEqual(json.loads(self.helper._output_files[paths[0]]),
+                {'targets': ['tests', 'install']})
+
+        self.helper.add_input_file(paths[0], self.helper._output_files[paths[0]])
+        self.helper._output_files.clear()
+        self.helper.factory._caches = None
+        self.helper.executor.reset_mock()
+        self._run_build()
+        self.helper.executor.copy_tree.assert_any_call(cache_dir + '/build', '/ws/build')
+        self.assertEqual(self.helper.executor.check_call.call_count, 2)
+        self.helper.executor.check_call.assert_any_call(
+                ['cmake', '--version'], cwd=mock.ANY, env=mock.ANY)
+        # Targets that do not produce artifacts are not skipped.
+        self.helper.assertCommandInvoked(
+                ['cmake', '--build', '.', '--target', 'check-source', '--', mock.ANY])
+        self.assertFalse(any(x.endswith('artifacts.json') for x in self.helper._output_files))
+
+    def _save_to_cache(self):
+        self._run_build()
+        path = [x for x in self.helper._output_files if x.endswith('artifacts.json')][0]
+        self.helper.add_input_file(path, self.helper._output_files[path])
+        self.helper._output_files.clear()
+        self.helper.factory._caches = None
+        self.helper.executor.reset_mock()
+        return os.path.dirname(path)
+
+    def test_FailedRestoreBuildsNormally(self):
+        self._save_to_cache()
+        def copy_tree(source, dest):
+            if dest == '/ws/test-install':
+                raise OSError(28, 'No space left on device')
+        self.helper.executor.copy_tree.side_effect = copy_tree
+        self._run_build()
+        self.helper.executor.ensure_dir_exists.assert_any_call('/ws/build', ensure_empty=True)
+        self.helper.assertCommandInvoked(['cmake', '--build', '.', '--', '-j2', 'tests', 'install'])
+
+    def test_FailedSaveDoesNotFailBuild(self):
+        self.helper.executor.copy_tree.side_effect = IOError(28, 'No space left on device')
+        context = self._run_build()
+        self.assertFalse(any(x.endswith('artifacts.json') for x in self.helper._output_files))
+        self.assertFalse(context.failed)
+
+    def test_EnvironmentIsPartOfKey(self):
+        first = self._save_to_cache()
+        self._run_build(env={'ASAN_OPTIONS': 'detect_leaks=0'})
+        paths = [x for x in self.helper._output_files if x.endswith('artifacts.json')]
+        self.assertEqual(len(paths), 1)
+        self.assertNotEqual(os.path.dirname(paths[0]), first)
+
+class TestArtifactCacheRemote(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+        self.tmpdir = tempfile.mkdtemp()
+        self.remote = mock.Mock()
+        self.remote.get_entry.return_value = {'targets': ['all'], 'build': 'digest'}
+        self.cache = ArtifactCache(self.helper.executor, self.tmpdir,
+                '/ws/build', '/ws/test-install', remote=self.remote, remote_key='key')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _set_archive(self, create):
+        def get_blobs(blobs):
+            for path in blobs.itervalues():
+                create(path)
+            return True
+        self.remote.get_blobs.side_effect = get_blobs
+
+    def test_FetchRenamesTreeIntoPlace(self):
+        source = os.path.join(self.tmpdir, 'source')
+        os.makedirs(source)
+        with open(os.path.join(source, 'file'), 'w') as fp:
+            fp.write('contents')
+        self._set_archive(lambda path: pack_tree(source, path))
+        self.assertTrue(self.cache.restore())
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, 'build', 'file')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'build.tmp')))
+        self.helper.executor.lock_file.assert_called_with(
+                os.path.join(self.tmpdir, 'save.lock'))
+
+    def test_CorruptArchiveIsMiss(self):
+        def create(path):
+            with open(path, 'w') as fp:
+                fp.write('not an archive')
+        self._set_archive(create)
+        self.assertFalse(self.cache.restore())
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'build')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'build.tmp')))
+        self.assertFalse(self.helper._output_files)
+        self.helper.executor.copy_tree.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,47 @@
+import json
+import unittest
+
+from releng.diagnostics import WarningCollector, parse_warning
+from releng.executor import CurrentDirectoryTracker
+
+from releng.test.utils import TestHelper
+
+class TestParseWarning(unittest.TestCase):
+    def test_Gcc(self):
+        result = parse_warning("src/a.cpp:12:5: warning: unused variable 'x' [-Wunused-variable]\n")
+        self.assertEqual(result, ('src/a.cpp', 12, 5, "unused variable 'x'", '-Wunused-variable'))
+
+    def test_IccLinux(self):
+        result = parse_warning('src/a.cpp(12): warning #177: variable "x" was declared but never referenced\n')
+        self.assertEqual(result, ('src/a.cpp', 12, None, 'variable "x" was declared but never referenced', '#177'))
+
+    def test_Msvc(self):
+        result = parse_warning(r'C:\ws\src\a.cpp(12,3): warning C4996: deprecated' + '\n')
+        self.assertEqual(result, (r'C:\ws\src\a.cpp', 12, 3, 'deprecated', 'C4996'))
+
+    def test_Nvcc(self):
+        result = parse_warning('src/a.cu(7): warning: variable "y" was set but never used\n')
+        self.assertEqual(result, ('src/a.cu', 7, None, 'variable "y" was set but never used', None))
+
+    def test_NotAWarning(self):
+        self.assertIs(parse_warning('[ 10%] Building CXX object src/a.cpp.o\n'), None)
+        self.assertIs(parse_warning('src/a.cpp:12:5: error: expected ;\n'), None)
+
+
+class TestWarningCollector(unittest.TestCase):
+    def test_DeduplicatesHeaderWarnings(self):
+        helper = TestHelper(self)
+        cwd = CurrentDirectoryTracker()
+        cwd.chdir('/ws/build')
+        collector = WarningCollector('/ws', cwd)
+        collector.process_line('/ws/src/a.h:3:1: warning: foo [-Wfoo]\n')
+        collector.process_line('../src/a.h:3:1: warning: foo [-Wfoo]\n')
+        collector.process_line('/ws/src/b.cpp:8:1: warning: bar [-Wbar]\n')
+        collector.write_summary(helper.executor, '/ws/logs/compiler-warnings.json')
+        summary = json.loads(helper._output_files['/ws/logs/compiler-warnings.json'])
+        self.assertEqual([(x['fileName'], x['lineStart'], x['count']) for x in summary['issues']],
+                [('src/a.h', 3, 2), ('src/b.cpp', 8, 1)])
+        self.assertEqual(summary['files'], {'src/a.h': 1, 'src/b.cpp': 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import sys
+import time
+import unittest
+from StringIO import StringIO
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
+
+from releng.executor import DryRunExecutor, Executor
+
+class TestCheckCallWithOutputHandler(unittest.TestCase):
+    def setUp(self):
+        self.console = StringIO()
+        patcher = mock.patch.object(Executor, 'console', new=self.console)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.executor = Executor(mock.Mock())
+
+    def test_PassesOutputToHandler(self):
+        lines = []
+        self.executor.check_call_with_output_handler(
+                [sys.executable, '-c', 'print("a"); print("b")'], lines.append)
+        self.assertEqual(lines, ['a\n', 'b\n'])
+        self.assertEqual(self.console.getvalue(), 'a\nb\n')
+
+    def test_KillsCommandIfHandlerFails(self):
+        def handler(line):
+            raise ValueError(line)
+        start = time.time()
+        with self.assertRaises(ValueError):
+            self.executor.check_call_with_output_handler(
+                    [sys.executable, '-u', '-c', 'import time; print("a"); time.sleep(60)'],
+                    handler)
+        self.assertLess(time.time() - start, 30)
+
+class TestDryRunExecutor(unittest.TestCase):
+    def test_OutputHandlerCallIsLikeCheckCall(self):
+        executor = DryRunExecutor(mock.Mock())
+        with mock.patch.object(executor, 'check_call') as check_call:
+            executor.check_call_with_output_handler(['cmd', 'arg'], mock.Mock(), cwd='/ws')
+        check_call.assert_called_once_with(['cmd', 'arg'], cwd='/ws')
+
+if __name__ == '__main__':
+    unittest.main()
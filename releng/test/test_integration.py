@@ -1,5 +1,7 @@
 import base64
+import json
 import os.path
+import subprocess
 import unittest
 # With Python 2.7, this needs to be separately installed.
 # With Python 3.3 and up, this should change to unittest.mock.
@@ -174,6 +176,65 @@ class TestProjectsManager(unittest.TestCase):
         projects.checkout_project(Project.GROMACS)
         # TODO: Verify some of the results
 
+    def test_CheckoutWithWorktree(self):
+        helper = self._create_worktree_helper()
+        store_dir = '/node/caches/git-mirror/gromacs.git'
+        helper.executor.check_call.assert_any_call(
+                ['git', 'worktree', 'add', '--detach', '/ws/gromacs', '1234abcd'],
+                cwd=store_dir, env=mock.ANY)
+        # The checkout is recorded right away, so that concurrent builds do
+        # not consider the worktree stale.
+        usage = json.loads(helper._output_files[store_dir + '/releng-worktrees.json'])
+        self.assertEqual(list(usage.keys()), ['/ws/gromacs'])
+        helper.factory.workspace._prune_worktrees()
+        helper.executor.check_call.assert_called_with(
+                ['git', 'worktree', 'prune'], cwd=store_dir, env=mock.ANY)
+
+    def _create_worktree_helper(self):
+        helper = TestHelper(self, env={
+                'CHECKOUT_PROJECT': 'releng',
+                'CHECKOUT_REFSPEC': 'refs/changes/34/1234/5',
+                'CHECKOUT_BACKEND': 'worktree',
+                'GROMACS_REFSPEC': 'refs/heads/master',
+                'GROMACS_HASH': '1234abcd',
+                'RELENG_REFSPEC': 'refs/heads/master',
+                'RELENG_NODE_DIR': '/node'
+            })
+        helper.factory.projects.checkout_project(Project.GROMACS)
+        return helper
+
+    def test_RemovesStaleWorktrees(self):
+        helper = self._create_worktree_helper()
+        store_dir = '/node/caches/git-mirror/gromacs.git'
+        usage_file = store_dir + '/releng-worktrees.json'
+        helper.add_input_json_file(usage_file, {'/old/gromacs': 0, '/ws/gromacs': 0})
+        helper.executor.check_output.side_effect = lambda cmd, **kwargs: \
+                'worktree {0}\nbare\n\nworktree /ws/gromacs\ndetached\n\n' \
+                'worktree /old/gromacs\ndetached\n\nworktree /new/gromacs\ndetached\n'.format(store_dir)
+        helper.factory.workspace._prune_worktrees()
+        helper.executor.remove_path.assert_called_with('/old/gromacs')
+        self.assertEqual(sorted(json.loads(helper._output_files[usage_file]).keys()),
+                ['/new/gromacs', '/ws/gromacs'])
+
+    def test_OwnWorktreeIsKeptWithSymlinkedWorkspace(self):
+        helper = self._create_worktree_helper()
+        store_dir = '/node/caches/git-mirror/gromacs.git'
+        usage_file = store_dir + '/releng-worktrees.json'
+        helper.add_input_json_file(usage_file, {'/real/ws/gromacs': 0})
+        helper.executor.check_output.side_effect = lambda cmd, **kwargs: \
+                'worktree /real/ws/gromacs\ndetached\n'
+        realpath = lambda path: '/real' + path if path.startswith('/ws') else path
+        helper.executor.remove_path.reset_mock()
+        with mock.patch('releng.workspace.os.path.realpath', side_effect=realpath):
+            helper.factory.workspace._prune_worktrees()
+        self.assertFalse(helper.executor.remove_path.called)
+
+    def test_PruneFailureIsIgnored(self):
+        helper = self._create_worktree_helper()
+        helper.executor.check_call.side_effect = subprocess.CalledProcessError(1, 'git')
+        helper.factory.workspace._prune_worktrees()
+        self.assertIn('Failed to prune worktrees', helper._console.getvalue())
+
     def test_GetBuildRevisions(self):
         helper = TestHelper(self, env={
                 'WORKSPACE': 'ws',
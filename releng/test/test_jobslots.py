@@ -0,0 +1,72 @@
+import unittest
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
+
+from releng.test.utils import TestHelper
+
+class TestJobSlotPool(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_NODE_DIR': '/node',
+                'RELENG_NODE_EXECUTORS': '2'
+            })
+        self.helper.executor.get_cpu_count.return_value = 4
+        self.busy = set()
+        self.helper.executor.lock_file.side_effect = self._lock_file
+
+    def _lock_file(self, path, shared=False, blocking=True):
+        if path in self.busy and not blocking:
+            return None
+        return mock.MagicMock()
+
+    def test_AcquiresUpToCount(self):
+        pool = self.helper.factory.job_slots
+        self.assertEqual(pool.size, 4)
+        with pool.acquire(3) as slots:
+            self.assertEqual(slots.count, 3)
+        with pool.acquire(8) as slots:
+            self.assertEqual(slots.count, 4)
+
+    @mock.patch('releng.jobslots.time.sleep')
+    def test_AcquiresFreeSlotsOnlyAfterBoundedWait(self, sleep):
+        self.busy = set(['/node/jobslots/slot-{0}.lock'.format(x) for x in range(3)])
+        pool = self.helper.factory.job_slots
+        with pool.acquire(3) as slots:
+            self.assertEqual(slots.count, 1)
+        self.assertEqual(sleep.call_count, 30)
+
+    def test_DoesNotWaitWithFairShare(self):
+        self.busy = set(['/node/jobslots/slot-{0}.lock'.format(x) for x in range(2)])
+        pool = self.helper.factory.job_slots
+        with pool.acquire(4) as slots:
+            self.assertEqual(slots.count, 2)
+
+    @mock.patch('releng.jobslots.time.sleep')
+    def test_WaitsForFairShare(self, sleep):
+        self.busy = set(['/node/jobslots/slot-{0}.lock'.format(x) for x in range(3)])
+        def free_slot_on_second_wait(seconds):
+            if sleep.call_count == 2:
+                self.busy.remove('/node/jobslots/slot-2.lock')
+        sleep.side_effect = free_slot_on_second_wait
+        pool = self.helper.factory.job_slots
+        with pool.acquire(3) as slots:
+            self.assertEqual(slots.count, 2)
+        self.assertEqual(sleep.call_count, 2)
+
+    @mock.patch('releng.jobslots.time.sleep')
+    def test_WaitsIfAllSlotsBusy(self, sleep):
+        self.busy = set(['/node/jobslots/slot-{0}.lock'.format(x) for x in range(4)])
+        def free_slot_on_second_wait(seconds):
+            if sleep.call_count == 2:
+                self.busy.remove('/node/jobslots/slot-2.lock')
+        sleep.side_effect = free_slot_on_second_wait
+        pool = self.helper.factory.job_slots
+        with pool.acquire(2) as slots:
+            self.assertEqual(slots.count, 1)
+        self.assertEqual(sleep.call_count, 30)
+        for call in self.helper.executor.lock_file.call_args_list:
+            self.assertEqual(call[1].get('blocking'), False)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -39,5 +39,18 @@ class TestPrepareBuildMatrix(unittest.TestCase):
                 "as_axis": '"{0} host=bs_nix1310" "{1} host=bs-win2012r2"'.format(*[x.strip() for x in input_lines])
             })
 
+    def test_TestShards(self):
+        factory = self.helper.factory
+        self.helper.add_input_file('ws/gromacs/admin/builds/nightly-matrix.txt',
+                'gcc-4.8 mpi test-shards=2\nmsvc-2013 test-shards=1\n')
+        prepare_build_matrix(factory, 'nightly-matrix')
+        configs = factory.status_reporter.return_value['configs']
+        self.assertEqual([x['opts'] for x in configs], [
+                ['gcc-4.8', 'mpi', 'test-shard=1/2'],
+                ['gcc-4.8', 'mpi', 'test-shard=2/2'],
+                ['msvc-2013']
+            ])
+        self.assertNotEqual(configs[0]['host'], configs[1]['host'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,7 +2,7 @@ import unittest
 
 from releng.test.utils import TestHelper
 
-from releng.common import Enum, Simd
+from releng.common import ConfigurationError, Enum, Generator, Linker, Simd
 from releng.options import OptionTypes
 from releng.options import process_build_options
 
@@ -25,6 +25,65 @@ class TestProcessBuildOptions(unittest.TestCase):
         self.assertEqual(o.simd, Simd.REFERENCE)
         self.assertEqual(o.x11, True)
 
+    def test_CcacheWithMpi(self):
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: '/usr/bin/' + name
+        opts = ['gcc-4.8', 'mpi', 'ccache']
+        e, o = process_build_options(self.helper.factory, opts, None)
+        self.assertEqual(e.ccache_command, '/usr/bin/ccache')
+        self.assertEqual(e.c_compiler, 'mpicc')
+        self.assertEqual(e.cuda_host_compiler, '/usr/bin/gcc-4.8')
+        self.assertEqual(e.extra_cmake_options['CMAKE_C_COMPILER_LAUNCHER'], '/usr/bin/ccache')
+        self.assertEqual(e.extra_cmake_options['CMAKE_CXX_COMPILER_LAUNCHER'], '/usr/bin/ccache')
+        env = self.helper.factory.cmd_runner._env
+        self.assertTrue(env['CCACHE_DIR'].endswith('/caches/compiler-cache/ccache'))
+        self.assertEqual(env['CCACHE_COMPILERCHECK'], '%compiler% --version')
+
+    def test_CcacheWithClangAnalyzer(self):
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: '/usr/bin/' + name
+        opts = ['clang-3.8', 'clang-static-analyzer-3.8', 'ccache']
+        e, o = process_build_options(self.helper.factory, opts, None)
+        self.assertEqual(e.ccache_command, '/usr/bin/ccache')
+        self.assertEqual(e.extra_cmake_options['CMAKE_C_COMPILER_LAUNCHER'], '/usr/bin/ccache')
+        self.assertNotIn('CMAKE_CXX_COMPILER_LAUNCHER', e.extra_cmake_options)
+
+    def test_DebugInfoOptions(self):
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: '/usr/bin/' + name
+        opts = ['gcc-7', 'linker=gold', 'split-dwarf', 'compress-debug']
+        e, o = process_build_options(self.helper.factory, opts, None)
+        self.assertEqual(e.linker, Linker.GOLD)
+        env = self.helper.factory.cmd_runner._env
+        self.assertEqual(env['LDFLAGS'], '-fuse-ld=gold')
+        e._apply_debug_info_options('Release')
+        self.assertNotIn('CFLAGS', env)
+        e._apply_debug_info_options('ASAN')
+        e._apply_debug_info_options('ASAN')
+        self.assertEqual(env['CFLAGS'], '-gsplit-dwarf -gz')
+        self.assertEqual(env['CXXFLAGS'], '-gsplit-dwarf -gz')
+        self.assertEqual(env['LDFLAGS'], '-fuse-ld=gold -Wl,--gdb-index -gz')
+
+    def test_DebugInfoOptionsWithMsvc(self):
+        with self.assertRaises(ConfigurationError):
+            process_build_options(self.helper.factory, ['msvc-2015', 'split-dwarf'], None)
+
+    def test_TestShard(self):
+        e, o = process_build_options(self.helper.factory, ['test-shard=2/3'], None)
+        self.assertEqual(o.test_shard, (2, 3))
+        for opt in ('test-shard=0/3', 'test-shard=4/3', 'test-shard=1'):
+            with self.assertRaises(ConfigurationError):
+                process_build_options(self.helper.factory, [opt], None)
+
+    def test_NinjaGenerator(self):
+        opts = ['build-jobs=8', 'generator=ninja']
+        e, o = process_build_options(self.helper.factory, opts, None)
+        self.assertEqual(o.generator, Generator.NINJA)
+        self.assertEqual(e.cmake_generator, 'Ninja')
+        self.assertEqual(e.extra_cmake_options['CMAKE_JOB_POOLS'], 'link_pool=2')
+        self.assertEqual(e._get_build_cmd(target='tests', keep_going=True),
+                ['cmake', '--build', '.', '--target', 'tests', '--', '-j8', '-k', '0'])
+
     def test_ExtraOptions(self):
         TestEnum = Enum.create('TestEnum', 'foo', 'bar')
         extra_opts = {
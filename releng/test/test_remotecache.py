@@ -0,0 +1,143 @@
+import hashlib
+import os
+import os.path
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+from releng.remotecache import CacheServer, RemoteCacheClient
+from releng.remotecache import pack_tree, unpack_tree
+
+class TestRemoteCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = CacheServer(os.path.join(self.tmpdir, 'server'))
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.console = StringIO()
+        self.client = RemoteCacheClient(self.server.url, self.console, timeout=5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(contents)
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def test_BlobRoundTrip(self):
+        contents = 'data\n' * 100000
+        path = self._write('source', contents)
+        digest = self.client.put_blob(path)
+        self.assertEqual(digest, hashlib.sha256(contents).hexdigest())
+        self.assertTrue(self.client.has_blob(digest))
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertTrue(self.client.get_blob(digest, dest))
+        self.assertEqual(self._read(dest), contents)
+        self.assertLess(self.client.bytes_uploaded, len(contents))
+
+    def test_Miss(self):
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertFalse(self.client.get_blob('0' * 64, dest))
+        self.assertIsNone(self.client.get_entry('missing'))
+        self.assertFalse(os.path.exists(dest))
+        self.assertTrue(self.client.available)
+
+    def test_CorruptedBlobIsRejected(self):
+        path = self._write('source', 'contents')
+        digest = self.client.put_blob(path)
+        stored = os.path.join(self.tmpdir, 'server', 'cas', digest[:2], digest)
+        with open(stored, 'wb') as fp:
+            fp.write('x'.encode('zlib'))
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertFalse(self.client.get_blob(digest, dest))
+        self.assertFalse(os.path.exists(dest))
+
+    def test_FileAndEntries(self):
+        path = self._write('InitialCache.cmake', 'set(HAVE_FOO "1" CACHE INTERNAL "")\n')
+        self.assertTrue(self.client.put_file('configure-1234', path))
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertTrue(self.client.get_file('configure-1234', dest))
+        self.assertEqual(self._read(dest), self._read(path))
+
+    def test_PutBlobs(self):
+        paths = [self._write('file{0}'.format(i), str(i) * 1000) for i in range(6)]
+        digests = self.client.put_blobs(paths)
+        self.assertEqual(sorted(digests.keys()), sorted(paths))
+        blobs = dict([(digest, path + '.out') for path, digest in digests.iteritems()])
+        self.assertTrue(self.client.get_blobs(blobs))
+        for path in paths:
+            self.assertEqual(self._read(path + '.out'), self._read(path))
+
+    def test_PackTree(self):
+        tree = os.path.join(self.tmpdir, 'tree')
+        os.makedirs(os.path.join(tree, 'bin'))
+        self._write('tree/bin/gmx', 'binary')
+        os.symlink('gmx', os.path.join(tree, 'bin', 'gmx_d'))
+        archive = os.path.join(self.tmpdir, 'tree.tar')
+        pack_tree(tree, archive)
+        dest = os.path.join(self.tmpdir, 'restored')
+        unpack_tree(archive, dest)
+        self.assertEqual(self._read(os.path.join(dest, 'bin', 'gmx')), 'binary')
+        self.assertEqual(os.readlink(os.path.join(dest, 'bin', 'gmx_d')), 'gmx')
+
+    def _create_archive(self, members):
+        archive = os.path.join(self.tmpdir, 'tree.tar')
+        with tarfile.open(archive, 'w') as tar:
+            for name, kind, target in members:
+                info = tarfile.TarInfo(name)
+                info.type = kind
+                info.linkname = target
+                tar.addfile(info, StringIO('') if kind == tarfile.REGTYPE else None)
+        return archive
+
+    def test_UnpackRejectsPathsOutsideTree(self):
+        dest = os.path.join(self.tmpdir, 'restored')
+        for members in ([('a/../../x', tarfile.REGTYPE, '')],
+                        [('up', tarfile.SYMTYPE, '..'), ('up/x', tarfile.REGTYPE, '')],
+                        [('a', tarfile.SYMTYPE, 'b/..'), ('b', tarfile.SYMTYPE, '.')],
+                        [('x', tarfile.REGTYPE, ''), ('y', tarfile.LNKTYPE, 'x')],
+                        [('dev', tarfile.CHRTYPE, '')]):
+            with self.assertRaises(IOError):
+                unpack_tree(self._create_archive(members), dest)
+            self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'x')))
+
+    def test_TokenIsRequired(self):
+        self.server.token = 'secret'
+        self.assertFalse(self.client.put_entry('key', {}))
+        self.assertFalse(self.client.available)
+        client = RemoteCacheClient(self.server.url, self.console, timeout=5, token='secret')
+        self.assertTrue(client.put_entry('key', {'file': 'x'}))
+        self.assertEqual(client.get_entry('key'), {'file': 'x'})
+        self.assertEqual(client.bytes_downloaded, client.bytes_uploaded)
+
+class TestRemoteCacheOutage(unittest.TestCase):
+    def test_UnreachableServerDisablesCache(self):
+        # Find a port that nothing listens on.
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        console = StringIO()
+        client = RemoteCacheClient('http://localhost:{0}'.format(port), console, timeout=1)
+        self.assertIsNone(client.get_entry('key'))
+        self.assertFalse(client.available)
+        self.assertIn('Remote cache unavailable', console.getvalue())
+        self.assertFalse(client.put_entry('key', {}))
+
+if __name__ == '__main__':
+    unittest.main()
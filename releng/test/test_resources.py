@@ -0,0 +1,75 @@
+import mock
+import unittest
+
+from releng.test.utils import TestHelper
+
+class TestNodeResources(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'NODE_NAME': 'bs_nix1404',
+                'RELENG_NODE_DIR': '/node',
+                'RELENG_NODE_EXECUTORS': '2'
+            })
+        self.helper.executor.get_cpu_count.return_value = 16
+        self.helper.executor.get_load_average.return_value = 0.0
+
+    def test_CpuCount(self):
+        resources = self.helper.factory.resources
+        self.assertEqual(resources.compile_jobs, 8)
+        self.assertEqual(resources.test_jobs, 8)
+        self.assertIs(resources.link_jobs, None)
+
+    def test_CgroupV2Limits(self):
+        self.helper.add_input_file('/sys/fs/cgroup/cpu.max', '400000 100000\n')
+        self.helper.add_input_file('/sys/fs/cgroup/memory.max', str(8 * 1024**3) + '\n')
+        self.helper.add_input_file('/sys/fs/cgroup/memory.current', str(2 * 1024**3) + '\n')
+        self.helper.add_input_file('/proc/meminfo', """\
+                MemTotal:       65536000 kB
+                MemAvailable:   60000000 kB
+                """)
+        resources = self.helper.factory.resources
+        self.assertEqual(resources.cpu_limit, 4.0)
+        self.assertEqual(resources.memory_available, 6 * 1024**3)
+        self.assertEqual(resources.compile_jobs, 2)
+        self.assertEqual(resources.link_jobs, 1)
+
+    def test_CgroupV1Limits(self):
+        self.helper.add_input_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '-1\n')
+        self.helper.add_input_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us', '100000\n')
+        self.helper.add_input_file('/sys/fs/cgroup/memory/memory.limit_in_bytes', str(4 * 1024**3) + '\n')
+        self.helper.add_input_file('/sys/fs/cgroup/memory/memory.usage_in_bytes', '0\n')
+        resources = self.helper.factory.resources
+        self.assertIs(resources.cpu_limit, None)
+        self.assertEqual(resources.compile_jobs, 2)
+        self.assertEqual(resources.test_jobs, 2)
+
+    def test_LoadReducesJobs(self):
+        self.helper.executor.get_load_average.return_value = 13.2
+        resources = self.helper.factory.resources
+        self.assertEqual(resources.compile_jobs, 3)
+
+    def test_LoadFromOtherBuildsIsNotSubtractedTwice(self):
+        busy = set(['/node/jobslots/slot-{0}.lock'.format(x) for x in range(8)])
+        def lock_file(path, blocking=True):
+            if path in busy:
+                return None
+            return mock.MagicMock()
+        self.helper.executor.lock_file.side_effect = lock_file
+        self.helper.executor.get_load_average.return_value = 13.2
+        resources = self.helper.factory.resources
+        self.assertEqual(resources.compile_jobs, 8)
+
+    def test_LoadIsScaledByCgroupLimit(self):
+        self.helper.add_input_file('/sys/fs/cgroup/cpu.max', '400000 100000\n')
+        self.helper.executor.get_load_average.return_value = 8.0
+        resources = self.helper.factory.resources
+        self.assertEqual(resources.compile_jobs, 2)
+        self.assertEqual(resources.test_jobs, 2)
+
+    def test_BuildJobsOverride(self):
+        context = self.helper.factory.create_context(None, ['build-jobs=3'], None)
+        self.assertEqual(context.env._get_build_cmd(),
+                ['cmake', '--build', '.', '--', '-j3'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+from StringIO import StringIO
+import unittest
+
+from releng.testhistory import TestHistory
+
+class TestTestHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = TestHistory(':memory:')
+        self.timestamp = 0
+
+    def tearDown(self):
+        self.history.close()
+
+    def _add_build(self, config, results):
+        self.timestamp += 1
+        self.history.add_build(config, 'abcdef', results, branch='master',
+                timestamp=self.timestamp)
+
+    def test_SlowestTests(self):
+        self._add_build('gcc-7', [('A', 'passed', 1.0), ('B', 'passed', 5.0), ('C', 'failed', 60.0)])
+        self._add_build('gcc-7', [('A', 'passed', 3.0), ('B', 'passed', 5.0), ('C', 'passed', 0.5)])
+        self._add_build('clang-6', [('A', 'passed', 20.0)])
+        self.assertEqual(self.history.get_slowest_tests('gcc-7', limit=2),
+                [('B', 5.0, 2), ('A', 2.0, 2)])
+        self.assertEqual(self.history.get_slowest_tests(limit=1), [('A', 8.0, 3)])
+
+    def test_DurationRegressions(self):
+        for i in range(4):
+            self._add_build('gcc-7', [('A', 'passed', 2.0), ('B', 'passed', 0.2)])
+        for i in range(2):
+            self._add_build('gcc-7', [('A', 'passed', 4.0), ('B', 'passed', 0.6)])
+        self.assertEqual(self.history.get_duration_regressions(recent=2),
+                [('A', 'gcc-7', 2.0, 4.0)])
+
+    def test_FlakinessScores(self):
+        statuses = [('passed', 'failed'), ('flaky', 'failed'), ('passed', 'failed'),
+                ('failed', 'failed'), ('passed', 'failed')]
+        for a, b in statuses:
+            self._add_build('gcc-7', [('A', a, 1.0), ('B', b, 1.0), ('C', 'passed', 1.0)])
+        self.assertEqual(self.history.get_flakiness_scores(), [('A', 0.6, 5)])
+
+    def test_FailureFrequency(self):
+        self._add_build('gcc-7', [('A', 'failed', 1.0), ('B', 'passed', 1.0)])
+        self._add_build('gcc-7', [('A', 'passed', 1.0), ('B', 'flaky', 1.0)])
+        self._add_build('clang-6', [('A', 'failed', 1.0), ('B', 'notrun', None)])
+        self.assertEqual(self.history.get_failure_frequency(),
+                [('A', 'clang-6', 1, 1), ('A', 'gcc-7', 1, 2)])
+
+    def test_RecentlyFailedTests(self):
+        self._add_build('gcc-7', [('A', 'failed', 1.0), ('B', 'passed', 1.0), ('C', 'failed', 1.0)])
+        self._add_build('gcc-7', [('A', 'passed', 1.0), ('B', 'flaky', 1.0), ('C', 'failed', 1.0)])
+        self._add_build('clang-6', [('D', 'failed', 1.0)])
+        self.assertEqual(self.history.get_recently_failed_tests('gcc-7'), ['B', 'C', 'A'])
+        self.assertEqual(self.history.get_recently_failed_tests('gcc-7', recent=1), ['B', 'C'])
+
+    def test_RemoveOldBuilds(self):
+        self.history.add_build('gcc-7', 'abcdef', [('A', 'failed', 1.0)], timestamp=100.0)
+        self.history.add_build('gcc-7', 'abcdef', [('B', 'failed', 1.0)], timestamp=200.0)
+        self.assertEqual(self.history.remove_old_builds(max_age=50.0, now=210.0), 1)
+        self.assertEqual(self.history.get_recently_failed_tests('gcc-7'), ['B'])
+        rows = self.history._conn.execute('SELECT test FROM results')
+        self.assertEqual([row[0] for row in rows], ['B'])
+
+    def test_ExportAndImport(self):
+        self._add_build('gcc-7', [('A', 'passed', 1.0)])
+        dump = StringIO()
+        self.history.export(dump)
+        other = TestHistory(':memory:')
+        other.add_build('clang-6', 'abcdef', [('A', 'passed', 3.0)], timestamp=0)
+        dump.seek(0)
+        other.import_dump(dump)
+        self.assertEqual(other.get_configs(), ['clang-6', 'gcc-7'])
+        self.assertEqual(other.get_slowest_tests(), [('A', 2.0, 2)])
+        other.close()
+
+if __name__ == '__main__':
+    unittest.main()
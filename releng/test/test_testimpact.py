@@ -0,0 +1,85 @@
+import json
+import unittest
+
+from releng.testimpact import format_test_regex, get_affected_tests, parse_ctest_tests
+from releng.testimpact import parse_ninja_deps, select_tests
+
+class TestParsing(unittest.TestCase):
+    def test_ParseNinjaDeps(self):
+        output = """\
+src/gromacs/CMakeFiles/libgromacs.dir/math/units.cpp.o: #deps 3, deps mtime 1 (VALID)
+    /src/gromacs/src/gromacs/math/units.cpp
+    /src/gromacs/src/gromacs/math/units.h
+    /usr/include/stdio.h
+
+src/gromacs/math/tests/CMakeFiles/MathUnitTests.dir/units.cpp.o: #deps 2, deps mtime 1 (VALID)
+    ../gromacs/src/gromacs/math/tests/units.cpp
+    /src/gromacs/src/gromacs/math/units.h
+
+bin/gmx: #deps 0, deps mtime 1 (VALID)
+"""
+        result = parse_ninja_deps(output.splitlines(), '/src/build', '/src/gromacs')
+        self.assertEqual(result, {
+                'src/gromacs/math/units.cpp': set(['libgromacs']),
+                'src/gromacs/math/units.h': set(['libgromacs', 'MathUnitTests']),
+                'src/gromacs/math/tests/units.cpp': set(['MathUnitTests'])
+            })
+
+    def test_ParseCTestTests(self):
+        text = json.dumps({'kind': 'ctestInfo', 'tests': [
+                {'name': 'MathUnitTest', 'command': ['/build/bin/math-test', '--xml']},
+                {'name': 'MdrunTests', 'command': ['C:\\build\\bin\\mdrun-test.exe']},
+                {'name': 'NoCommand'}
+            ]})
+        self.assertEqual(parse_ctest_tests(text), {
+                'MathUnitTest': 'math-test',
+                'MdrunTests': 'mdrun-test'
+            })
+
+class TestSelectTests(unittest.TestCase):
+    def setUp(self):
+        self.file_targets = {
+                'src/gromacs/math/units.cpp': set(['libgromacs']),
+                'src/gromacs/math/tests/units.cpp': set(['math-test']),
+                'src/gromacs/fft/tests/fft.cpp': set(['fft-test']),
+                'api/gmxapi/tests/context.cpp': set(['gmxapi-test'])
+            }
+        self.test_targets = {
+                'MathUnitTest': 'math-test',
+                'FFTUnitTest': 'fft-test',
+                'MdrunTests': 'mdrun-test',
+                'GmxapiTests': 'gmxapi-test'
+            }
+
+    def _select(self, changed_files):
+        return select_tests(changed_files, self.file_targets, self.test_targets, ['MdrunTests'])
+
+    def test_TestOnlyChange(self):
+        self.assertEqual(self._select(['src/gromacs/math/tests/units.cpp', 'docs/index.rst']),
+                ['MathUnitTest', 'MdrunTests'])
+
+    def test_DocumentationOnlyChange(self):
+        self.assertEqual(self._select(['docs/index.rst']), ['MdrunTests'])
+
+    def test_LibraryChangeRunsAll(self):
+        self.assertIsNone(self._select(['src/gromacs/math/units.cpp']))
+
+    def test_UnknownFileRunsAll(self):
+        self.assertIsNone(self._select(['CMakeLists.txt']))
+
+    def test_AllTestsSelected(self):
+        self.assertIsNone(self._select(['src/gromacs/math/tests/units.cpp',
+            'src/gromacs/fft/tests/fft.cpp', 'api/gmxapi/tests/context.cpp']))
+
+    def test_AffectedTests(self):
+        affected = get_affected_tests(['src/gromacs/math/units.cpp',
+            'src/gromacs/math/tests/units.cpp', 'CMakeLists.txt'],
+            self.file_targets, self.test_targets)
+        self.assertEqual(affected, ['MathUnitTest'])
+
+    def test_FormatTestRegex(self):
+        self.assertEqual(format_test_regex(['MdrunTests', 'Regression.Simple']),
+                r'^(MdrunTests|Regression\.Simple)$')
+
+if __name__ == '__main__':
+    unittest.main()
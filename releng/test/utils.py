@@ -8,6 +8,7 @@ import mock
 from releng.common import Project
 from releng.executor import Executor
 from releng.factory import ContextFactory
+from releng.testhistory import TestHistory
 
 class TestHelper(object):
     def __init__(self, test, workspace=None, env=dict()):
@@ -17,6 +18,10 @@ class TestHelper(object):
         self.executor.check_output.side_effect = self._check_output
         self.executor.read_file.side_effect = self._read_file
         self.executor.write_file.side_effect = self._write_file
+        self.executor.rename_file.side_effect = self._rename_file
+        self.executor.check_call_with_output_handler.side_effect = self._check_call_with_output_handler
+        self.executor.get_cpu_count.return_value = None
+        self.executor.get_load_average.return_value = None
         self.reset_console_output()
 
         if workspace:
@@ -35,12 +40,14 @@ class TestHelper(object):
             env['WORKSPACE'] = '/ws'
         self.factory = ContextFactory(env=env)
         self.factory.init_executor(instance=self.executor)
+        self.factory.init_test_history(instance=TestHistory(':memory:'))
         if workspace:
             self.factory.init_workspace_and_projects()
             self.executor.reset_mock()
             self.reset_console_output()
         self._input_files = dict()
         self._output_files = dict()
+        self.command_output = dict()
 
     def reset_console_output(self):
         self._console = StringIO()
@@ -71,14 +78,27 @@ class TestHelper(object):
             return json.dumps(data) + '\nstats'
         return None
 
-    def _read_file(self, path):
+    def _check_call_with_output_handler(self, cmd, handler, **kwargs):
+        # Forward to check_call() so that tests can treat both the same.
+        self.executor.check_call(cmd, **kwargs)
+        for line in self.command_output.get(tuple(cmd), []):
+            handler(line)
+
+    def _read_file(self, path, binary=False):
         if path not in self._input_files:
             raise IOError(path + ': not part of test')
         return self._input_files[path]
 
     def _write_file(self, path, contents):
+        if not isinstance(contents, basestring):
+            contents = ''.join(contents)
         self._output_files[path] = contents
 
+    def _rename_file(self, source, dest):
+        for files in (self._input_files, self._output_files):
+            if source in files:
+                files[dest] = files.pop(source)
+
     def add_input_file(self, path, contents):
         lines = textwrap.dedent(contents).splitlines(True)
         self._input_files[path] = lines
@@ -0,0 +1,345 @@
+"""
+History of test results across builds
+
+Stores the status and duration of each test from every build into an SQLite
+database, together with the build configuration, the source revision, and the
+branch.  The database is node-local (it lives in the node cache directory), but
+can be exported as an SQL dump and merged with exports from other nodes::
+
+    python -m releng.testhistory --db history.db --export history.sql
+    python -m releng.testhistory --db merged.db --import history.sql
+
+The query methods provide the data that test ordering, scheduling and status
+reports need: the slowest tests, tests whose duration has regressed, flakiness
+scores, and failure frequencies per configuration.  The same queries can be run
+from the command line (see ``--help``).
+
+Test status is one of ``passed``, ``failed``, ``flaky`` (failed, but passed
+when rerun), or ``notrun``.  Builds older than a retention limit are removed
+when new results are added, so that the database does not grow without bound.
+
+This module only depends on the standard library, so that exported data can be
+analyzed without the rest of releng.
+"""
+from __future__ import print_function
+
+import sqlite3
+import sys
+import time
+
+# Builds older than this (in seconds) are removed from the store.
+DEFAULT_MAX_AGE = 90 * 24 * 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    config TEXT NOT NULL,
+    revision TEXT,
+    branch TEXT,
+    job_type TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    build_id INTEGER NOT NULL REFERENCES builds (id),
+    test TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS results_build ON results (build_id);
+CREATE INDEX IF NOT EXISTS builds_config ON builds (config);
+CREATE INDEX IF NOT EXISTS builds_timestamp ON builds (timestamp);
+"""
+
+class TestHistory(object):
+    """Store for test results from builds.
+
+    All query methods consider only the most recent builds (``recent``
+    builds per configuration), so that old results do not dominate.
+    """
+
+    def __init__(self, path, timeout=30):
+        """Opens (and if necessary, creates) the database.
+
+        Args:
+            path (str): Path to the database file (``':memory:'`` for a
+                temporary database).
+            timeout (float): Seconds to wait for a lock held by another build
+                on the same node.
+        """
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def add_build(self, config, revision, results, branch=None, job_type=None, timestamp=None):
+        """Adds results of tests from a build.
+
+        Args:
+            config (str): Description of the build configuration.
+            revision (str or None): Source revision that was tested.
+            results (Iterable[Tuple[str, str, float or None]]): Name, status,
+                and duration in seconds for each test.
+            branch (Optional[str]): Branch that was tested.
+            job_type (Optional[str]): Type of the build job.
+            timestamp (Optional[float]): Time of the build (default is now).
+
+        Returns:
+            int: Identifier of the build in the store.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._conn:
+            cursor = self._conn.execute(
+                    'INSERT INTO builds (timestamp, config, revision, branch, job_type) '
+                    'VALUES (?, ?, ?, ?, ?)', (timestamp, config, revision, branch, job_type))
+            build_id = cursor.lastrowid
+            self._conn.executemany(
+                    'INSERT INTO results (build_id, test, status, duration) VALUES (?, ?, ?, ?)',
+                    [(build_id, name, status, duration) for name, status, duration in results])
+        return build_id
+
+    def remove_old_builds(self, max_age=DEFAULT_MAX_AGE, now=None):
+        """Removes builds (and their results) older than ``max_age`` seconds.
+
+        Returns:
+            int: Number of builds removed.
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - max_age
+        with self._conn:
+            self._conn.execute('DELETE FROM results WHERE build_id IN '
+                    '(SELECT id FROM builds WHERE timestamp < ?)', (cutoff,))
+            cursor = self._conn.execute('DELETE FROM builds WHERE timestamp < ?', (cutoff,))
+        return cursor.rowcount
+
+    def get_configs(self):
+        """Returns all configurations that have results in the store."""
+        rows = self._conn.execute('SELECT DISTINCT config FROM builds ORDER BY config')
+        return [row[0] for row in rows]
+
+    def get_slowest_tests(self, config=None, limit=10, recent=20):
+        """Returns the tests with the longest average duration.
+
+        Failed runs are ignored, since a failure (e.g., a timeout) does not
+        represent the normal duration of the test.
+
+        Returns:
+            List[Tuple[str, float, int]]: Name, average duration, and number
+                of runs for each test, slowest first.
+        """
+        builds = self._get_recent_builds(config, recent)
+        durations = dict()
+        for build_id, test, status, duration in self._get_results(builds):
+            if status != 'failed' and duration is not None:
+                durations.setdefault(test, []).append(duration)
+        result = [(test, sum(values) / len(values), len(values))
+                for test, values in durations.iteritems()]
+        result.sort(key=lambda x: (-x[1], x[0]))
+        return result[:limit]
+
+    def get_duration_regressions(self, ratio=1.5, min_duration=1.0, recent=5, baseline=20):
+        """Returns tests whose duration has increased recently.
+
+        For each configuration, the average duration of a test over the
+        ``recent`` latest builds is compared to the average over the
+        ``baseline`` builds before those.
+
+        Args:
+            ratio (float): Minimum relative increase to report.
+            min_duration (float): Tests shorter than this (in seconds) in the
+                recent builds are not reported, since their timings are noisy.
+
+        Returns:
+            List[Tuple[str, str, float, float]]: Name, configuration, baseline
+                duration, and recent duration for each regressed test, largest
+                relative increase first.
+        """
+        result = []
+        for config in self.get_configs():
+            builds = self._get_recent_builds(config, recent + baseline)
+            recent_builds = set(builds[:recent])
+            durations = dict()
+            for build_id, test, status, duration in self._get_results(builds):
+                if status == 'failed' or duration is None:
+                    continue
+                values = durations.setdefault(test, ([], []))
+                values[0 if build_id in recent_builds else 1].append(duration)
+            for test, (recent_values, baseline_values) in durations.iteritems():
+                if not recent_values or not baseline_values:
+                    continue
+                recent_avg = sum(recent_values) / len(recent_values)
+                baseline_avg = sum(baseline_values) / len(baseline_values)
+                if recent_avg >= min_duration and recent_avg >= ratio * baseline_avg:
+                    result.append((test, config, baseline_avg, recent_avg))
+        result.sort(key=lambda x: (-x[3] / max(x[2], 1e-6), x[0], x[1]))
+        return result
+
+    def get_flakiness_scores(self, config=None, min_runs=5, recent=50):
+        """Returns a flakiness score for tests that have not been stable.
+
+        The score is the fraction of runs that were flaky (failed, but passed
+        when rerun) or that flipped between passing and failing compared to
+        the previous run in the same configuration.  Consistently failing
+        tests get a low score, unlike with the plain failure rate.
+
+        Args:
+            min_runs (int): Tests with fewer runs are not scored.
+
+        Returns:
+            List[Tuple[str, float, int]]: Name, score (between 0 and 1), and
+                number of runs for each test with a non-zero score, highest
+                first.
+        """
+        configs = [config] if config is not None else self.get_configs()
+        counts = dict()
+        for cfg in configs:
+            # Process the builds oldest first to find the flips.
+            builds = list(reversed(self._get_recent_builds(cfg, recent)))
+            order = dict([(build_id, index) for index, build_id in enumerate(builds)])
+            runs = dict()
+            for build_id, test, status, duration in self._get_results(builds):
+                if status != 'notrun':
+                    runs.setdefault(test, []).append((order[build_id], status))
+            for test, statuses in runs.iteritems():
+                statuses.sort()
+                unstable = 0
+                previous = None
+                for index, status in statuses:
+                    if status == 'flaky' or (previous is not None and status != previous):
+                        unstable += 1
+                    previous = 'passed' if status == 'flaky' else status
+                total = counts.setdefault(test, [0, 0])
+                total[0] += unstable
+                total[1] += len(statuses)
+        result = [(test, float(unstable) / runs, runs)
+                for test, (unstable, runs) in counts.iteritems()
+                if runs >= min_runs and unstable > 0]
+        result.sort(key=lambda x: (-x[1], x[0]))
+        return result
+
+    def get_failure_frequency(self, config=None, recent=50):
+        """Returns how often tests have failed in each configuration.
+
+        Flaky runs do not count as failures.
+
+        Returns:
+            List[Tuple[str, str, int, int]]: Name, configuration, number of
+                failed runs, and number of runs for each test that has failed,
+                most frequently failing first.
+        """
+        configs = [config] if config is not None else self.get_configs()
+        result = []
+        for cfg in configs:
+            counts = dict()
+            builds = self._get_recent_builds(cfg, recent)
+            for build_id, test, status, duration in self._get_results(builds):
+                if status == 'notrun':
+                    continue
+                count = counts.setdefault(test, [0, 0])
+                if status == 'failed':
+                    count[0] += 1
+                count[1] += 1
+            result.extend([(test, cfg, failures, runs)
+                for test, (failures, runs) in counts.iteritems() if failures > 0])
+        result.sort(key=lambda x: (-float(x[2]) / x[3], -x[3], x[0], x[1]))
+        return result
+
+    def get_recently_failed_tests(self, config, recent=10):
+        """Returns tests that have failed (or been flaky) in recent builds.
+
+        Returns:
+            List[str]: Names of the tests, most recently failed first.
+        """
+        builds = self._get_recent_builds(config, recent)
+        order = dict([(build_id, index) for index, build_id in enumerate(builds)])
+        latest = dict()
+        for build_id, test, status, duration in self._get_results(builds):
+            if status in ('failed', 'flaky'):
+                latest[test] = min(latest.get(test, len(builds)), order[build_id])
+        return sorted(latest.iterkeys(), key=lambda x: (latest[x], x))
+
+    def export(self, fp):
+        """Writes the contents of the store as SQL statements to a file object."""
+        for line in self._conn.iterdump():
+            fp.write(line + '\n')
+
+    def import_dump(self, fp):
+        """Merges builds from an export produced by export().
+
+        Builds get new identifiers, so exports from several nodes can be
+        imported into the same store.
+        """
+        other = sqlite3.connect(':memory:')
+        try:
+            other.executescript(fp.read())
+            for build in other.execute('SELECT id, timestamp, config, revision, branch, job_type '
+                    'FROM builds ORDER BY timestamp'):
+                results = other.execute('SELECT test, status, duration FROM results '
+                        'WHERE build_id = ?', (build[0],))
+                self.add_build(build[2], build[3], results, branch=build[4],
+                        job_type=build[5], timestamp=build[1])
+        finally:
+            other.close()
+
+    def _get_recent_builds(self, config, count):
+        """Returns identifiers of the latest builds, newest first."""
+        if config is None:
+            rows = self._conn.execute('SELECT id FROM builds ORDER BY timestamp DESC, id DESC '
+                    'LIMIT ?', (count,))
+        else:
+            rows = self._conn.execute('SELECT id FROM builds WHERE config = ? '
+                    'ORDER BY timestamp DESC, id DESC LIMIT ?', (config, count))
+        return [row[0] for row in rows]
+
+    def _get_results(self, builds):
+        if not builds:
+            return []
+        placeholders = ', '.join(['?'] * len(builds))
+        return self._conn.execute('SELECT build_id, test, status, duration FROM results '
+                'WHERE build_id IN ({0})'.format(placeholders), builds)
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="""\
+            Query, export, or import releng test result history
+            """)
+    parser.add_argument('--db', required=True, help='Path to the database')
+    parser.add_argument('--config', help='Only consider the given configuration')
+    parser.add_argument('--export', metavar='FILE', help='Export the database as SQL')
+    parser.add_argument('--import', dest='import_file', metavar='FILE',
+            help='Merge builds from an SQL export')
+    parser.add_argument('--slowest', action='store_true', help='Print the slowest tests')
+    parser.add_argument('--regressions', action='store_true',
+            help='Print tests whose duration has regressed')
+    parser.add_argument('--flaky', action='store_true', help='Print flakiness scores')
+    parser.add_argument('--failures', action='store_true', help='Print failure frequencies')
+    args = parser.parse_args(args)
+    history = TestHistory(args.db)
+    try:
+        if args.import_file:
+            with open(args.import_file, 'r') as fp:
+                history.import_dump(fp)
+        if args.export:
+            with open(args.export, 'w') as fp:
+                history.export(fp)
+        if args.slowest:
+            for test, duration, runs in history.get_slowest_tests(args.config):
+                print('{0:8.2f} s  {1} ({2} runs)'.format(duration, test, runs))
+        if args.regressions:
+            for test, config, before, after in history.get_duration_regressions():
+                if args.config is None or config == args.config:
+                    print('{0:8.2f} s -> {1:8.2f} s  {2} [{3}]'.format(before, after, test, config))
+        if args.flaky:
+            for test, score, runs in history.get_flakiness_scores(args.config):
+                print('{0:5.2f}  {1} ({2} runs)'.format(score, test, runs))
+        if args.failures:
+            for test, config, failures, runs in history.get_failure_frequency(args.config):
+                print('{0}/{1}  {2} [{3}]'.format(failures, runs, test, config))
+    finally:
+        history.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+Selection of tests affected by a change
+
+For per-patchset (Gerrit) builds, running only the tests that can be affected
+by the change saves most of the test time for changes that do not touch the
+core libraries.  The selection uses the dependency information that the build
+system records while compiling (the Ninja deps log): each compiled source file
+and header maps to the targets whose objects depend on it, and each CTest test
+maps to the target that builds its executable.
+
+The selection is conservative: if any changed file is not known to the
+dependency information (e.g., CMake files or test input data), or affects a
+target that is not a test executable (e.g., libgromacs, which all tests link
+against), all tests are run.
+"""
+from __future__ import print_function
+
+import json
+import os.path
+import re
+
+from common import CommandError, Generator
+
+# Tests that are always run when only a subset of the tests is selected.
+DEFAULT_SMOKE_TESTS = ('MdrunTests',)
+
+# Changed files that cannot affect any test.
+_IGNORED_FILE_RE = re.compile(r'^(docs/|.*\.(rst|md)$)')
+
+_OBJECT_TARGET_RE = re.compile(r'(?:^|/)CMakeFiles/([^/]+)\.dir/')
+
+def parse_ninja_deps(lines, build_dir, source_root):
+    """Parses output of ``ninja -t deps``.
+
+    Args:
+        lines (Iterable[str]): Output lines.
+        build_dir (str): Build directory (relative dependency paths are
+            relative to this).
+        source_root (str): Root of the source tree.  Dependencies outside it
+            (e.g., system headers) are ignored.
+
+    Returns:
+        Dict[str, Set[str]]: For each source file (relative to
+            ``source_root``), the targets whose objects depend on it.
+    """
+    result = dict()
+    source_root = os.path.normpath(source_root) + os.sep
+    target = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            match = _OBJECT_TARGET_RE.search(line.split(':', 1)[0])
+            target = match.group(1) if match else None
+            continue
+        if target is None:
+            continue
+        path = os.path.normpath(os.path.join(build_dir, line.strip()))
+        if path.startswith(source_root):
+            result.setdefault(path[len(source_root):], set()).add(target)
+    return result
+
+def parse_ctest_tests(text):
+    """Parses output of ``ctest --show-only=json-v1``.
+
+    Returns:
+        Dict[str, str]: For each test name, the name of the target that
+            builds the test executable (assumed to be the executable name).
+    """
+    data = json.loads(text)
+    result = dict()
+    for test in data.get('tests', []):
+        command = test.get('command')
+        if not command:
+            continue
+        executable = re.split(r'[\\/]', command[0])[-1]
+        if executable.endswith('.exe'):
+            executable = executable[:-4]
+        result[test['name']] = executable
+    return result
+
+def select_tests(changed_files, file_targets, test_targets, smoke_tests):
+    """Selects the tests affected by a change.
+
+    Args:
+        changed_files (List[str]): Changed files, relative to the source root.
+        file_targets (Dict[str, Set[str]]): Result from parse_ninja_deps().
+        test_targets (Dict[str, str]): Result from parse_ctest_tests().
+        smoke_tests (List[str]): Tests that are always selected.
+
+    Returns:
+        List[str] or None: Names of the selected tests, or None if all tests
+            need to be run.
+    """
+    test_executables = set(test_targets.itervalues())
+    affected = set()
+    for path in changed_files:
+        if _IGNORED_FILE_RE.match(path):
+            continue
+        targets = file_targets.get(path)
+        if not targets or not targets.issubset(test_executables):
+            return None
+        affected.update(targets)
+    selected = set(smoke_tests).intersection(test_targets)
+    selected.update([name for name, target in test_targets.iteritems() if target in affected])
+    if len(selected) == len(test_targets):
+        return None
+    return sorted(selected)
+
+def get_affected_tests(changed_files, file_targets, test_targets):
+    """Returns the tests whose executables directly depend on changed files.
+
+    Unlike select_tests(), this ignores changes to other targets, so the
+    result can be used to prioritize tests also when all tests are run.
+
+    Returns:
+        List[str]: Names of the affected tests.
+    """
+    affected = set()
+    for path in changed_files:
+        affected.update(file_targets.get(path, ()))
+    return sorted([name for name, target in test_targets.iteritems() if target in affected])
+
+def format_test_regex(tests):
+    """Returns a regex for ``ctest -R`` that matches exactly the given tests."""
+    return '^({0})$'.format('|'.join([re.escape(x) for x in tests]))
+
+class TestImpactSelector(object):
+    """Selects tests affected by the change being built.
+
+    Dependency information is taken from the Ninja deps log in the build
+    directory, and kept in a node-local cache per branch, so that it is
+    available also for builds that did not compile the sources themselves.
+
+    Attributes:
+        affected_tests (List[str] or None): After select(), tests whose
+            executables directly depend on the changed files (None if this
+            could not be determined).
+    """
+
+    def __init__(self, executor, cmd_runner, env, source_root, build_dir, cache_path):
+        """Creates the selector.
+
+        Args:
+            executor (Executor): Executor to access files.
+            cmd_runner (CommandRunner): Runner for git, ninja, and ctest.
+            env (BuildEnvironment): Build environment.
+            source_root (str): Root of the source tree of the changed project.
+            build_dir (str): Build directory.
+            cache_path (str): Path to the cached dependency information.
+        """
+        self._executor = executor
+        self._cmd_runner = cmd_runner
+        self._env = env
+        self._source_root = source_root
+        self._build_dir = build_dir
+        self._cache_path = cache_path
+        self.affected_tests = None
+
+    def select(self, smoke_tests):
+        """Returns the tests to run, or None if all tests need to be run."""
+        console = self._executor.console
+        changed_files = self._get_changed_files()
+        test_targets = self._get_test_targets()
+        file_targets = self._get_file_targets()
+        if changed_files is None or test_targets is None or file_targets is None:
+            print('Test impact analysis not possible, running all tests', file=console)
+            return None
+        self.affected_tests = get_affected_tests(changed_files, file_targets, test_targets)
+        tests = select_tests(changed_files, file_targets, test_targets, smoke_tests)
+        if tests is None:
+            print('Change may affect all tests, running all tests', file=console)
+        else:
+            print('Running {0} of {1} tests affected by the change: {2}'.format(
+                len(tests), len(test_targets), ', '.join(tests)), file=console)
+        return tests
+
+    def _get_changed_files(self):
+        cmd = ['git', 'diff', '--name-only', 'HEAD^', 'HEAD']
+        try:
+            output = self._cmd_runner.check_output(cmd, cwd=self._source_root)
+        except CommandError:
+            return None
+        if output is None:
+            return None
+        return [x.strip() for x in output.splitlines() if x.strip()]
+
+    def _get_test_targets(self):
+        cmd = [self._env.ctest_command, '--show-only=json-v1']
+        try:
+            output = self._cmd_runner.check_output(cmd, cwd=self._build_dir)
+            return parse_ctest_tests(output)
+        except (CommandError, TypeError, ValueError):
+            return None
+
+    def _get_file_targets(self):
+        ninja = None
+        if self._env.generator == Generator.NINJA:
+            ninja = self._env._find_ninja()
+        if ninja:
+            try:
+                output = self._cmd_runner.check_output([ninja, '-t', 'deps'], cwd=self._build_dir)
+            except CommandError:
+                output = None
+            if output:
+                file_targets = parse_ninja_deps(output.splitlines(),
+                        self._build_dir, self._source_root)
+                if file_targets:
+                    self._save_cache(file_targets)
+                    return file_targets
+        return self._load_cache()
+
+    def _save_cache(self, file_targets):
+        data = dict([(path, sorted(targets)) for path, targets in file_targets.iteritems()])
+        self._executor.write_file(self._cache_path, json.dumps(data))
+
+    def _load_cache(self):
+        try:
+            data = json.loads(''.join(self._executor.read_file(self._cache_path)))
+        except (IOError, ValueError):
+            return None
+        return dict([(path, set(targets)) for path, targets in data.iteritems()])
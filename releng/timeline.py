@@ -0,0 +1,70 @@
+"""
+Timeline of the build phases
+
+Records the phases of the build (checkout, configuration, building targets,
+running tests, etc.) and the external commands run as nested spans, and
+writes them in the Chrome trace event format.  The resulting file can be
+opened in a trace viewer (e.g., chrome://tracing or Perfetto) to see where
+the time in a build went, including time spent in the releng scripts
+themselves between the commands.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+class Timeline(object):
+    """Records spans of the build phases.
+
+    Spans are recorded as complete events ('ph': 'X'); a trace viewer nests
+    them based on their start times and durations.
+    """
+
+    def __init__(self, factory):
+        self._executor = factory.executor
+        self._events = []
+        self._pid = os.getpid()
+        self._start = time.time()
+
+    @contextlib.contextmanager
+    def span(self, name, category='releng', args=None):
+        """Records a span covering the body of a with statement.
+
+        Args:
+            name (str): Name of the span shown in the trace viewer.
+            category (Optional[str]): Category of the span (e.g., ``cmd`` for
+                external commands).
+            args (Optional[Dict[str, str]]): Additional information shown for
+                the span.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._add_event(name, category, start, time.time(), args)
+
+    def _add_event(self, name, category, start, end, args):
+        event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int((start - self._start) * 1e6),
+                'dur': int((end - start) * 1e6),
+                'pid': self._pid,
+                'tid': 1
+            }
+        if args:
+            event['args'] = args
+        self._events.append(event)
+
+    def write(self, path):
+        """Writes the recorded spans as a Chrome trace event JSON file."""
+        # Sort the events so that enclosing spans come before the spans
+        # nested in them.
+        events = sorted(self._events, key=lambda x: (x['ts'], -x['dur']))
+        contents = json.dumps({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms'
+            })
+        self._executor.write_file(path, contents)
@@ -2,7 +2,9 @@
 Misc. utility functions.
 """
 
+import os
 import sys
+import time
 
 def flush_output():
     """Ensures all output is flushed before an external process is started.
@@ -40,3 +42,111 @@ def write_property_file(executor, path, values):
     """
     contents = ''.join(['{0} = {1}\n'.format(key, value) for key, value in values.iteritems() if value is not None])
     executor.write_file(path, contents)
+
+# Seconds between attempts to acquire a lock on Windows.
+_LOCK_POLL_INTERVAL = 0.5
+
+class FileLock(object):
+    """Cross-process lock based on a lock file.
+
+    On Unix, the lock uses flock(), which supports both shared and exclusive
+    locks, and is automatically released if the process dies.
+    On Windows, shared locks are not supported: all locks are exclusive, so
+    a "shared" lock excludes other holders as well.  Blocking acquisition
+    is done by polling, since msvcrt gives up on a blocking lock after
+    about ten seconds.
+
+    Can be used as a context manager; the lock is then acquired (blocking)
+    on entry if not already held, and released on exit.
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self._shared = shared
+        self._fp = None
+
+    @property
+    def is_locked(self):
+        return self._fp is not None
+
+    def acquire(self, blocking=True):
+        """Acquires the lock.
+
+        Args:
+            blocking (Optional[bool]): If ``False`` and the lock is held by
+                another process, returns immediately.
+
+        Returns:
+            bool: Whether the lock was acquired.
+        """
+        assert self._fp is None
+        fp = open(self.path, 'a+')
+        try:
+            if not self._lock(fp, blocking):
+                fp.close()
+                return False
+        except:
+            fp.close()
+            raise
+        self._fp = fp
+        return True
+
+    def release(self):
+        """Releases the lock if it is held."""
+        if self._fp is None:
+            return
+        try:
+            self._unlock(self._fp)
+        finally:
+            self._fp.close()
+            self._fp = None
+
+    def _lock(self, fp, blocking):
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    fp.seek(0)
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+                    return True
+                except IOError:
+                    if not blocking:
+                        return False
+                time.sleep(_LOCK_POLL_INTERVAL)
+        import fcntl
+        mode = fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX
+        if not blocking:
+            mode |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp.fileno(), mode)
+        except IOError:
+            if blocking:
+                raise
+            return False
+        return True
+
+    def _unlock(self, fp):
+        if os.name == 'nt':
+            import msvcrt
+            fp.seek(0)
+            msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def __enter__(self):
+        if not self.is_locked:
+            self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+def format_size(size):
+    """Formats a size in bytes in a human-readable form."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f} TiB'.format(size)
@@ -6,11 +6,19 @@ commands related to setting up and inspecting the workspace.
 """
 from __future__ import print_function
 
+import json
 import os.path
 import tarfile
+import time
 
 from common import BuildError, CommandError, ConfigurationError
-from common import Project
+from common import CacheKind, Project
+
+# Worktrees (in other workspaces) of the node-local object stores that have not
+# been checked out for this many seconds are deleted at the end of a build.
+_WORKTREE_MAX_AGE = 14 * 24 * 3600
+# File in each object store that records when its worktrees were last used.
+_WORKTREE_USAGE_FILE = 'releng-worktrees.json'
 
 class CheckedOutProject(object):
     """Information about a checked-out project.
@@ -40,6 +48,11 @@ class Workspace(object):
     need to be post-processed in Jenkins) are provided. Implements
     functionality for updating commits with new files.
 
+    Projects checked out from git are by default cloned into the workspace.
+    If the ``CHECKOUT_BACKEND`` environment variable is set to ``worktree``,
+    each project instead has a single object store per node (managed as a
+    node-local cache), and the workspace gets a linked worktree of it.
+
     Attributes:
         root (str): Root directory of the workspace.
         install_dir (str): Directory for test installation.
@@ -49,7 +62,13 @@ class Workspace(object):
         self._executor = factory.executor
         self._cmd_runner = factory.cmd_runner
         self._gerrit = factory.gerrit
+        self._caches = factory.caches
         self._default_project = factory.default_project
+        backend = factory.env.get('CHECKOUT_BACKEND', None)
+        if backend not in (None, '', 'clone', 'worktree'):
+            raise ConfigurationError('unknown CHECKOUT_BACKEND: ' + backend)
+        self._use_worktrees = (backend == 'worktree')
+        self._worktree_stores = dict()
         self._checkouts = dict()
         self._build_dir = None
         self._out_of_source = None
@@ -80,6 +99,15 @@ class Workspace(object):
         sha1, title = self._cmd_runner.check_output(cmd, cwd=project_dir).strip().split(None, 1)
         return title, sha1
 
+    def _get_git_tree_hash(self, project):
+        """Returns the SHA1 of the HEAD tree for a project that has been
+        checked out from git, or None if the project is from a tarball."""
+        project_info = self._get_checkout_info(project)
+        if project_info.is_tarball:
+            return None
+        cmd = ['git', 'rev-parse', 'HEAD^{tree}']
+        return self._cmd_runner.check_output(cmd, cwd=project_info.root).strip()
+
     def _ensure_empty_dir(self, path):
         """Ensures that the given directory exists and is empty."""
         self._executor.ensure_dir_exists(path, ensure_empty=True)
@@ -212,6 +240,9 @@ class Workspace(object):
             tar.extractall(self.root)
 
     def _do_git_checkout(self, project, refspec):
+        if self._use_worktrees:
+            self._do_git_worktree_checkout(project, refspec)
+            return
         project_dir = os.path.join(self.root, project)
         self._executor.ensure_dir_exists(project_dir)
         runner = self._cmd_runner
@@ -222,6 +253,113 @@ class Workspace(object):
         runner.check_call(['git', 'gc'], cwd=project_dir)
         self._run_git_clean(project_dir)
 
+    def _do_git_worktree_checkout(self, project, refspec):
+        """Checks out a project as a linked worktree of a node-local object store.
+
+        The object store is shared by all workspaces on the node, so updating
+        it, adding the worktree, and recording when the worktree was last
+        used is done while holding a lock.
+        """
+        project_dir = os.path.join(self.root, project)
+        store_dir = self._caches.get_cache_dir(CacheKind.GIT_MIRROR, project + '.git')
+        runner = self._cmd_runner
+        with self._executor.lock_file(os.path.join(store_dir, 'releng.lock')):
+            if not os.path.isfile(os.path.join(store_dir, 'HEAD')):
+                runner.check_call(['git', 'init', '--bare', '-q'], cwd=store_dir)
+            runner.check_call(['git', 'fetch', self._gerrit.get_git_url(project), refspec.fetch], cwd=store_dir)
+            sha1 = refspec.checkout
+            if sha1 == 'FETCH_HEAD':
+                # FETCH_HEAD is shared between all workspaces, so it needs to
+                # be resolved before releasing the lock.
+                cmd = ['git', 'rev-parse', 'FETCH_HEAD^{commit}']
+                sha1 = runner.check_output(cmd, cwd=store_dir).strip()
+            self._executor.remove_path(project_dir)
+            runner.check_call(['git', 'worktree', 'prune'], cwd=store_dir)
+            runner.check_call(['git', 'worktree', 'add', '--detach', project_dir, sha1], cwd=store_dir)
+            runner.check_call(['git', 'gc', '--auto'], cwd=store_dir)
+            usage = self._read_worktree_usage(store_dir)
+            usage[os.path.realpath(project_dir)] = time.time()
+            self._write_worktree_usage(store_dir, usage)
+        self._worktree_stores.setdefault(store_dir, set()).add(project_dir)
+
+    def _read_worktree_usage(self, store_dir):
+        """Returns last-use times of the worktrees of an object store.
+
+        The store lock must be held.
+
+        Returns:
+            Dict[str, float]: Time of the last checkout, keyed by the real
+                path of the worktree.
+        """
+        try:
+            return json.loads(''.join(self._executor.read_file(
+                os.path.join(store_dir, _WORKTREE_USAGE_FILE))))
+        except (IOError, ValueError):
+            return dict()
+
+    def _write_worktree_usage(self, store_dir, usage):
+        self._executor.write_file(os.path.join(store_dir, _WORKTREE_USAGE_FILE),
+                json.dumps(usage))
+
+    def _prune_worktrees(self):
+        """Prunes stale worktrees from object stores used in this build.
+
+        Called at the end of the build.  Worktrees in other workspaces that
+        no build has checked out for _WORKTREE_MAX_AGE are deleted, and
+        worktrees whose directories no longer exist (e.g., because the
+        workspace has been wiped or the project has since been checked out
+        again) are removed from the object store.  The worktrees of the
+        current build are kept for post-build steps in Jenkins, and are
+        replaced by the next checkout in the same workspace.
+
+        Failures only print a note, so that they do not affect the build
+        result or the rest of the post-build steps.
+        """
+        console = self._executor.console
+        for store_dir in sorted(self._worktree_stores):
+            try:
+                with self._executor.lock_file(os.path.join(store_dir, 'releng.lock')):
+                    self._remove_stale_worktrees(store_dir, self._worktree_stores[store_dir])
+                    self._cmd_runner.check_call(['git', 'worktree', 'prune'], cwd=store_dir)
+            except (CommandError, IOError, OSError) as e:
+                print('Failed to prune worktrees of {0}: {1}'.format(store_dir, e),
+                        file=console)
+        self._worktree_stores = dict()
+
+    def _remove_stale_worktrees(self, store_dir, used):
+        """Deletes worktrees of an object store that have not been used recently.
+
+        git does not track when a worktree was last used, so the time of each
+        checkout is recorded in a file in the object store (see
+        _do_git_worktree_checkout()).  Worktrees created before the file
+        existed count as used now.  The store lock must be held.
+
+        Args:
+            store_dir (str): Object store to process.
+            used (Set[str]): Worktrees checked out by the current build.
+        """
+        usage = self._read_worktree_usage(store_dir)
+        used = set([os.path.realpath(x) for x in used])
+        output = self._cmd_runner.check_output(
+                ['git', 'worktree', 'list', '--porcelain'], cwd=store_dir)
+        worktrees = [line[len('worktree '):] for line in (output or '').splitlines()
+                if line.startswith('worktree ')]
+        now = time.time()
+        result = dict()
+        for path in worktrees:
+            path = os.path.realpath(path)
+            if path == os.path.realpath(store_dir):
+                continue
+            last_used = now if path in used else usage.get(path, now)
+            if now - last_used > _WORKTREE_MAX_AGE:
+                print('Removing worktree unused for {0} days: {1}'.format(
+                    int((now - last_used) // (24 * 3600)), path),
+                    file=self._executor.console)
+                self._executor.remove_path(path)
+            else:
+                result[path] = last_used
+        self._write_worktree_usage(store_dir, result)
+
     def _run_git_clean(self, project_dir):
         self._cmd_runner.check_call(['git', 'clean', '-ffdxq'], cwd=project_dir)
 